@@ -15,10 +15,26 @@ logger.addHandler(logging.NullHandler())
 import os
 import sys
 import getopt
+import glob
 import signal
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from lib.loggingConfigurator import loggingConfigurator
 from lib.CfgHandler import CfgHandler, CfgFileLoadingFailed
-from bootloader import bootloader, BootloaderException, PortOpenFailed, ResetFailed, PicNotDetected
+from bootloader import bootloader, BootloaderException, PortOpenFailed, ResetFailed, PicNotDetected, FlashingInterrupted
+from firmwarecache import FirmwareCache, SharedFirmwareCache
+from ledger import FlashLedger
+from checkpoint import FlashCheckpoint
+from resetmemory import ResetMemory
+from calibration import LinkCalibration, calibrateLink
+from transmitter import estimateTransferTime
+from eventdriver import AsyncBootloader, SerialLoop
+from daemon import FlashDaemon, PortWorker, DaemonException, submitRequest
+from metrics import FlashMetrics, formatTextfile, summaryJson, writeFile
+from history import FlashHistory, REPORTS, formatReport
+from serialtrace import SerialRecorder, SerialReplay
+from lib.statefile import safeName
 
 
 class NoFirmwareFound(BootloaderException):
@@ -29,6 +45,14 @@ class NoFirmwareFound(BootloaderException):
     pass
 
 
+class HistoryNotConfigured(BootloaderException):
+
+    '''
+    Класс исключений для ситуации, когда база данных журнала загрузок прошивки не задана в конфигурационном файле
+    '''
+    pass
+
+
 class Application(object):
 
     '''
@@ -54,10 +78,35 @@ Options are:
 -v, --loglevel=      debug output loglevel. Could be either DEBUG,INFO,WARNING,ERROR or CRITICAL
 -f, --firmware=      filename of PIC firmware file to be bootloaded (Intel HEX)
 -p, --progress=      name of the file to save flashing progress information to
--d, --device=        name of serial port to connect via
--b, --baud=          baud rate to use with serial port
+-d, --device=        name of serial port to connect via. Several ports separated by commas or a glob pattern
+                     (e.g. /dev/ttyUSB*) flash the devices concurrently
+-b, --baud=          baud rate to use with serial port (overrides baud rate found by calibrate command)
 -t, --timeout=       serial port reading timeout (seconds)
-	''' % app_name
+-s, --stream         send rows to PIC while firmware file is still being parsed
+-i, --device-id=     device identifier used to keep per-device state (serial port name by default)
+-D, --delta          send only rows changed since the last successful flashing of the device
+-r, --resume         continue interrupted flashing of the same firmware from the first unacknowledged row
+--record=            file to record serial traffic to (port name is appended when several ports are used)
+--replay=            replay recorded serial traffic from file instead of using serial port
+--replay-speed=      replay speed factor (1 reproduces recorded PIC reply delays, 0 replays without delays)
+--dry-run            show rows to be sent, bytes and estimated transfer time without using serial port
+                     (-D and -r apply; PIC model is given by --pic)
+--event-loop         serve several ports from one thread with the non-blocking driver instead of a thread per port
+                     (PIC is reset by command only)
+--pic=               PIC model code reported by bootloader (e.g. 0x31 for 16F876A/877A), used with --dry-run and diff
+
+Commands are:
+diff OLD NEW         show row-level difference between two firmware files and estimated time saved by --delta
+                     (PIC model is given by --pic)
+daemon               keep configured serial ports open and accept flashing jobs via Unix socket
+submit FIRMWARE [PORT]
+                     queue flashing job to running daemon (-D and -r apply) and show its progress
+status               show job queues of running daemon
+calibrate            find the fastest baud rate PIC bootloader replies at and use it for the port in later runs
+history [REPORT] [HOURS]
+                     show report on flashing history for the last HOURS (default 24). Reports are:
+%s
+	''' % (app_name, '\n'.join("                       {:<9}{}".format(name, REPORTS[name][0]) for name in sorted(REPORTS)))
 
     ## Имя конфигурационного файла (добавляется расширение .yaml; файл ищется в /etc и в текущем каталоге)
     _CFG_BASENAME = 'pic_loader'
@@ -81,8 +130,79 @@ Options are:
     _device_name = None
     ## Скорость порта
     _device_baud = None
+    ## Параметры настройки порта для уменьшения задержки приема [dict] (если не заданы, порт не настраивается)
+    _low_latency = None
+    ## Признак скорости порта, заданной в командной строке (имеет приоритет над подобранной командой calibrate)
+    _baud_fixed = False
+    ## Скорости, проверяемые при подборе скорости порта
+    _calibration_bauds = [115200, 57600, 38400, 19200, 9600]
     ## Таймаут чтения из порта
     _device_timeout = 1
+    ## Таймауты ожидания ответов МК по операциям: определение типа МК, сброс, подтверждение записи строки
+    ## (не заданные -- равны таймауту чтения из порта) [dict]
+    _timeouts = {}
+    ## Признак потокового режима передачи прошивки (строки передаются в МК по мере разбора hex-файла)
+    _stream = False
+    ## Признак разностной загрузки прошивки (передаются только строки, изменившиеся с момента последней загрузки)
+    _delta = False
+    ## Максимальное количество повторных попыток записи строки при отсутствии подтверждения
+    _write_retries = 3
+    ## Задержка перед первой повторной попыткой записи строки, с (перед каждой следующей удваивается)
+    _write_retry_delay = 0.05
+    ## Признак продолжения прерванной загрузки прошивки
+    _resume = False
+    ## Признак обслуживания нескольких портов в одном потоке неблокирующим драйвером (вместо потока на каждый порт)
+    _event_loop = False
+    ## Признак вывода плана загрузки прошивки без обращения к порту
+    _dry_run = False
+    ## Код модели МК для плана загрузки без обращения к порту
+    _pic_code = None
+    ## Ссылка на объект bootloader
+    _bootloader = None
+    ## Ссылка на сервер загрузки прошивки (в режиме daemon) [FlashDaemon]
+    _daemon = None
+    ## Имя файла unix-сокета сервера загрузки прошивки
+    _socket_path = '/run/pic_loader/pic_loader.sock'
+    ## Имя файла для сохранения метрик загрузки в формате JSON (если не задано, не сохраняются)
+    _metrics_json = None
+    ## Имя файла для сохранения метрик загрузки в текстовом формате Prometheus (node_exporter textfile collector)
+    _metrics_textfile = None
+    ## Имя файла базы данных журнала загрузок прошивки (если не задано, журнал не ведется)
+    _history_database = None
+    ## Время загрузки конфигурационного файла, с
+    _config_time = 0.0
+    ## Коды завершения загрузки по портам (в многопортовом режиме) [dict]
+    _port_exit_codes = {}
+    ## Имя файла для записи обмена через порт
+    _record_filename = None
+    ## Имя файла записанного обмена, воспроизводимого вместо работы с портом
+    _replay_filename = None
+    ## Коэффициент ускорения воспроизведения записанного обмена
+    _replay_speed = 1.0
+    ## Объекты bootloader, выполняющие загрузку прошивки (по одному на порт) [list]
+    _bootloaders = []
+    ## Идентификатор устройства (используется для хранения состояния устройства; по умолчанию -- имя порта)
+    _device_id = None
+    ## Каталог для хранения состояния устройств между запусками (если не задан, состояние не сохраняется)
+    _state_directory = None
+    ## Команда и ее аргументы, заданные в командной строке [list]
+    _arguments = []
+    ## Скорость порта, используемая для оценок времени передачи, если скорость не задана
+    _DEFAULT_BAUD = 57600
+    ## Каталог кэша подготовленных образов прошивки (если не задан, кэш не используется)
+    _cache_directory = None
+    ## Максимальный объем кэша подготовленных образов прошивки, байт
+    _cache_max_size = 16 * 1024 * 1024
+    ## Период проверки завершения параллельной загрузки, с (позволяет обрабатывать сигналы в основном потоке)
+    _POLL_INTERVAL = 0.5
+    ## Коды завершения и сообщения для исключений, прерывающих загрузку прошивки
+    _EXIT_CODES = (
+      (PortOpenFailed, 2, "failed to open serial port"),
+      (ResetFailed, 3, "failed to reset PIC"),
+      (PicNotDetected, 4, "failed to detect PIC"),
+      (NoFirmwareFound, 5, "no firmware file specified"),
+      (FlashingInterrupted, 6, "flashing interrupted, run with --resume to continue"),
+    )
 
     def __init__(self):
         '''
@@ -108,8 +228,9 @@ Options are:
         try:
             options, arguments = getopt.gnu_getopt(
               sys.argv[1:],
-             'hv:f:p:d:b:t:',
-             'help loglevel= firmware= progress= device= baud= timeout='.split()
+             'hv:f:p:d:b:t:si:Dr',
+             'help loglevel= firmware= progress= device= baud= timeout= stream device-id= delta resume record= replay= replay-speed= '
+             'dry-run pic= event-loop'.split()
             )
         except getopt.GetoptError, e:
             logger.error("Illegal option (%s)" % e)
@@ -130,17 +251,53 @@ Options are:
                 # Имя файла прошивки
                 self._firmware_filename = value
             elif option in ('-d', '--device'):
-                # Имя порта
+                # Имя порта (или несколько имен через запятую, или шаблон имени)
                 self._device_name = value
             elif option in ('-b', '--baud'):
                 # Скорость порта
                 self._device_baud = int(value)
+                self._baud_fixed = True
             elif option in ('-t', '--timeout'):
                 # Таймаут чтения из порта
                 self._device_timeout = int(value)
             elif option in ('-p', '--progress'):
                 # Имя файла для сохранения информации о прогрессе
                 self._progress_info_filename = value
+            elif option in ('-s', '--stream'):
+                # Потоковый режим передачи прошивки
+                self._stream = True
+            elif option in ('-i', '--device-id'):
+                # Идентификатор устройства
+                self._device_id = value
+            elif option in ('-D', '--delta'):
+                # Разностная загрузка прошивки
+                self._delta = True
+            elif option in ('-r', '--resume'):
+                # Продолжение прерванной загрузки прошивки
+                self._resume = True
+            elif option == '--record':
+                # Запись обмена через порт
+                self._record_filename = value
+            elif option == '--replay':
+                # Воспроизведение записанного обмена
+                self._replay_filename = value
+            elif option == '--replay-speed':
+                self._replay_speed = float(value)
+            elif option == '--dry-run':
+                # План загрузки без обращения к порту
+                self._dry_run = True
+            elif option == '--event-loop':
+                # Обслуживание нескольких портов в одном потоке
+                self._event_loop = True
+            elif option == '--pic':
+                # Код модели МК
+                try:
+                    self._pic_code = int(value, 0)
+                except ValueError:
+                    logger.error("Illegal PIC model code '{}'".format(value))
+                    raise SystemExit(4)
+        # Команда и ее аргументы
+        self._arguments = arguments
 
     def _SIGTERMHandler(self, signum, frame):
         '''
@@ -151,13 +308,30 @@ Options are:
         @param frame   Текущий stack frame
         '''
 
+        loaders = self._bootloaders + (self._daemon.loaders() if self._daemon else [])
+        # Идет передача прошивки -- завершаем ее после подтверждения записи текущей строки
+        transferring = [loader for loader in loaders if loader.isTransferring()]
+        if transferring:
+            logger.warning("SIGTERM received, stopping after current row")
+            for loader in transferring:
+                loader.requestStop()
+            # Сервер останавливается, дождавшись завершения заданий
+            if not self._daemon:
+                return
+
         raise SystemExit
 
-    def _startLoading(self):
+    def _startLoading(self, loader, firmware_filename, stream=False, delta=False, resume=False, device_id=None):
         '''
         Отправляет прошивку в МК
 
-        @param self    Ссылка на экземпляр класса
+        @param self               Ссылка на экземпляр класса
+        @param loader             Объект bootloader с открытым портом [bootloader]
+        @param firmware_filename  Имя файла прошивки [string]
+        @param stream             Признак потоковой передачи прошивки [bool]
+        @param delta              Признак разностной загрузки [bool]
+        @param resume             Признак продолжения прерванной загрузки [bool]
+        @param device_id          Идентификатор устройства (для запоминания сработавшего способа сброса МК) [string]
         '''
 
         # Получаем последовательность сброса МК из настроек
@@ -172,7 +346,9 @@ Options are:
             try:
                 # Пытаемся обнаружить МК (на случай, если загрузчик уже запущен)
                 logger.info("Trying to determine whether bootloader is running...")
-                self._bootloader.detectPic()
+                with loader.metrics.phase('detect'):
+                    loader.detectPic()
+                loader.reset_method = 'running'
                 return True
             except PicNotDetected:  # МК не обнаружен
                 logger.warning("Bootloader is not running")
@@ -188,13 +364,16 @@ Options are:
                 return False
             try:
                 # Сбрасываем МК командой
-                self._bootloader.resetPic(
-                  reset_seq,
-                  reply_seq=self._cfg['pic'].get('reset-reply-sequence', None),
-                  max_attempts=self._cfg['pic'].get('reset-max-attempts', 3)
-                )
+                with loader.metrics.phase('reset'):
+                    loader.resetPic(
+                      reset_seq,
+                      reply_seq=self._cfg['pic'].get('reset-reply-sequence', None),
+                      max_attempts=self._cfg['pic'].get('reset-max-attempts', 3)
+                    )
                 # Пытаемся обнаружить МК повторно
-                self._bootloader.detectPic()
+                with loader.metrics.phase('detect'):
+                    loader.detectPic()
+                loader.reset_method = 'command'
                 return True
             except PicNotDetected:  # МК не обнаружен
                 return False
@@ -210,28 +389,697 @@ Options are:
                 logger.warning("HW reset port not specified")
                 return False
             try:
-                # Выполняем аппаратный сброс
-                self._bootloader.resetPicHW(reset_device)
-                # Пытаемся обнаружить МК
-                self._bootloader.detectPic()
+                # Выполняем аппаратный сброс; МК обнаруживается сразу после сброса
+                with loader.metrics.phase('reset_hw'):
+                    self._resetPicHW(loader, reset_device)
+                loader.reset_method = 'hardware'
                 return True
             except PicNotDetected:  # МК не обнаружен
                 return False
 
+        # Способы перевода МК в режим загрузчика; первым пробуем способ, сработавший при последней загрузке в устройство
+        methods = {'running': detect_bootloader, 'command': detect_sw, 'hardware': detect_hw}
+        order = ['running', 'command', 'hardware']
+        memory = self._createResetMemory(device_id)
+        if memory:
+            order = memory.order(order)
+            # Работающий загрузчик примет последовательность сброса за кадр записи, поэтому перед сбросом командой
+            # всегда проверяем, не запущен ли загрузчик (таймаут этой проверки короткий)
+            if order.index('command') < order.index('running'):
+                order.remove('running')
+                order.insert(order.index('command'), 'running')
+            logger.debug("Trying reset methods in order: {}".format(', '.join(order)))
+        detected = next((name for name in order if methods[name]()), None)
+        if memory:
+            memory.update(detected)
+
         # Удалось обнаружить МК каким-либо способом?
-        if detect_bootloader() or detect_sw() or detect_hw():
+        if detected:
             # Имя файла прошивки задано?
-            if self._firmware_filename:
+            if firmware_filename:
                 # Отправляем прошивку в МК
-                self._bootloader.bootload(self._firmware_filename)
+                loader.bootload(
+                  firmware_filename,
+                  stream=stream,
+                  delta=delta,
+                  resume=resume
+                )
             else:
                 raise NoFirmwareFound
         else:
             raise PicNotDetected
 
+    def _resetPicHW(self, loader, reset_device):
+        '''
+        Выполняет аппаратный сброс МК с параметрами импульса, заданными в конфигурационном файле, и определение типа МК
+
+        @param self          Ссылка на экземпляр класса
+        @param loader        Объект bootloader с открытым портом [bootloader]
+        @param reset_device  Имя порта, сигналом DTR которого выполняется сброс [string]
+        '''
+
+        loader.resetPicHW(
+          reset_device,
+          pulse=self._cfg['serial'].get('reset-pulse', 1.0),
+          settle=self._cfg['serial'].get('reset-settle', 1.0)
+        )
+
+    def _createFirmwareCache(self):
+        '''
+        Создает кэш подготовленных образов прошивки, если его каталог задан в конфигурационном файле
+
+        @param self    Ссылка на экземпляр класса
+        @return Кэш образов [FirmwareCache] или None
+        '''
+
+        if not self._cache_directory:
+            return None
+        logger.debug("Using firmware cache '{}' (max size {} bytes)".format(self._cache_directory, self._cache_max_size))
+        return FirmwareCache(self._cache_directory, self._cache_max_size)
+
+    def _createLedger(self, device_id):
+        '''
+        Создает журнал содержимого ПЗУ устройства, если каталог для хранения состояния задан в конфигурационном файле
+
+        @param self       Ссылка на экземпляр класса
+        @param device_id  Идентификатор устройства [string]
+        @return Журнал устройства [FlashLedger] или None
+        '''
+
+        if not self._state_directory:
+            if self._delta:
+                logger.warning("State directory is not defined in configuration file, delta flashing is not possible")
+            return None
+        return FlashLedger(self._state_directory, device_id)
+
+    def _createResetMemory(self, device_id):
+        '''
+        Создает хранилище способа сброса МК, сработавшего при последней загрузке, если каталог для хранения состояния
+        задан в конфигурационном файле
+
+        @param self       Ссылка на экземпляр класса
+        @param device_id  Идентификатор устройства [string]
+        @return Хранилище способа сброса [ResetMemory] или None
+        '''
+
+        # Воспроизведение записанного обмена не должно изменять сохраненное состояние устройства
+        if not self._state_directory or not device_id or self._replay_filename:
+            return None
+        return ResetMemory(self._state_directory, device_id)
+
+    def _createCheckpoint(self, device_id):
+        '''
+        Создает контрольную точку загрузки прошивки, если каталог для хранения состояния задан в конфигурационном файле
+
+        @param self       Ссылка на экземпляр класса
+        @param device_id  Идентификатор устройства [string]
+        @return Контрольная точка [FlashCheckpoint] или None
+        '''
+
+        if not self._state_directory:
+            return None
+        return FlashCheckpoint(self._state_directory, device_id)
+
+    def _runCommand(self, arguments):
+        '''
+        Выполняет команду, заданную в командной строке
+
+        @param self        Ссылка на экземпляр класса
+        @param arguments   Команда и ее аргументы [list]
+        '''
+
+        command = arguments[0]
+        if command == 'diff' and len(arguments) == 3:
+            self._showDiff(*arguments[1:])
+        elif command == 'daemon' and len(arguments) == 1:
+            self._runDaemon()
+        elif command == 'submit' and len(arguments) in (2, 3):
+            self._submitJob(*arguments[1:])
+        elif command == 'status' and len(arguments) == 1:
+            self._showDaemonStatus()
+        elif command == 'calibrate' and len(arguments) == 1:
+            self._calibrate()
+        elif command == 'history' and len(arguments) <= 3:
+            self._showHistory(*arguments[1:])
+        else:
+            logger.error("Illegal command or wrong number of arguments: {}".format(' '.join(arguments)))
+            raise SystemExit(4)
+
+    def _runDaemon(self):
+        '''
+        Запускает сервер загрузки прошивки, обслуживающий заданные порты, и обрабатывает задания до получения SIGTERM
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        ports = self._expandDevices(self._device_name)
+        firmware_cache = SharedFirmwareCache(self._createFirmwareCache())
+
+        def device_id(port):
+            # Заданный идентификатор устройства используется, только если обслуживается единственный порт
+            return (self._device_id or port) if len(ports) == 1 else port
+
+        def create_loader(port):
+            return lambda: self._createBootloader(port, device_id(port), None, firmware_cache)
+
+        # Метрики последнего задания каждого порта (файлы метрик перезаписываются после каждого задания)
+        job_metrics = {}
+        metrics_lock = threading.Lock()
+
+        def write_metrics(loader, port, code):
+            with metrics_lock:
+                job_metrics[port] = ({'port': port}, loader.metrics, code)
+                self._saveMetrics([job_metrics[name] for name in sorted(job_metrics)])
+
+        def run_job(loader, job):
+            # Метрики и журнал загрузок ведутся для каждого задания отдельно
+            loader.metrics = FlashMetrics()
+            loader.reset_method = None
+            try:
+                self._startLoading(loader, job.firmware, delta=job.delta, resume=job.resume, device_id=device_id(job.port))
+            except Exception, e:
+                code = self._describeError(e)[0]
+                write_metrics(loader, job.port, code)
+                self._recordHistory(loader, job.port, device_id(job.port), code)
+                raise
+            write_metrics(loader, job.port, 0)
+            self._recordHistory(loader, job.port, device_id(job.port), 0)
+
+        workers = [PortWorker(port, create_loader(port), run_job, self._describeError) for port in ports]
+        self._daemon = FlashDaemon(self._socket_path, workers)
+        logger.message("{} daemon started. PID is {}".format(self.app_name, os.getpid()))
+        self._daemon.serve()
+
+    def _submitJob(self, firmware_filename, port=None):
+        '''
+        Передает задание на загрузку прошивки серверу и выводит ход его выполнения
+
+        @param self               Ссылка на экземпляр класса
+        @param firmware_filename  Имя файла прошивки [string]
+        @param port               Имя порта (может не задаваться, если сервер обслуживает единственный порт) [string]
+        '''
+
+        request = {
+          'command': 'flash',
+          'firmware': os.path.abspath(firmware_filename),
+          'port': port,
+          'delta': self._delta,
+          'resume': self._resume,
+        }
+        code = 255
+        for event in submitRequest(self._socket_path, request):
+            if event['event'] == 'error':
+                raise DaemonException(event['message'])
+            elif event['event'] == 'queued':
+                sys.stdout.write("Job {} queued for '{}' at position {}\n".format(event['job'], event['port'], event['position']))
+            elif event['event'] == 'started':
+                sys.stdout.write("Job {} started\n".format(event['job']))
+            elif event['event'] == 'progress':
+                sys.stdout.write("Job {} progress {}%\n".format(event['job'], event['percentage']))
+            elif event['event'] == 'finished':
+                sys.stdout.write("Job {} finished in {:.1f}s: {}\n".format(event['job'], event['elapsed'], event['message']))
+                code = event['code']
+            sys.stdout.flush()
+
+        if code:
+            raise SystemExit(code)
+
+    def _showDaemonStatus(self):
+        '''
+        Выводит состояние очередей заданий сервера загрузки прошивки
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        for event in submitRequest(self._socket_path, {'command': 'status'}):
+            for port, state in sorted(event['ports'].iteritems()):
+                current = state['current']
+                if current:
+                    sys.stdout.write("{}: job {} '{}' {}%".format(port, current['job'], current['firmware'], current['percentage']))
+                else:
+                    sys.stdout.write("{}: idle".format(port))
+                sys.stdout.write(", {} queued\n".format(len(state['queued'])))
+
+    def _calibrate(self):
+        '''
+        Подбирает для каждого порта наибольшую скорость, на которой отвечает загрузчик, и сохраняет ее
+        для последующих запусков
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if not self._state_directory:
+            logger.warning("State directory is not defined in configuration file, baud rate will not be remembered")
+        reset_device = self._cfg['serial'].get('reset-device', None)
+        ports = self._expandDevices(self._device_name)
+        failed = 0
+        for port in ports:
+            device_id = (self._device_id or port) if len(ports) == 1 else port
+            loader = self._createBootloader(port, device_id, None, None)
+            try:
+                # Загрузчик ожидает запрос лишь короткое время после сброса -- сбрасываем МК на каждой скорости
+                if reset_device:
+                    detect = lambda: self._resetPicHW(loader, reset_device)
+                else:
+                    detect = loader.detectPic
+                baud, results = calibrateLink(loader, self._calibration_bauds, detect)
+            finally:
+                loader.closeSerial()
+
+            for rate, rtt in results:
+                sys.stdout.write("{}  {:>7}  {}\n".format(port, rate, '{:.1f} ms'.format(rtt * 1000) if rtt is not None else 'no reply'))
+            if not baud:
+                logger.error("Port '{}': bootloader does not reply at any of baud rates {}".format(
+                  port, ', '.join(str(rate) for rate in self._calibration_bauds)))
+                failed += 1
+                continue
+            sys.stdout.write("{}: using {} baud\n".format(port, baud))
+            if self._state_directory:
+                LinkCalibration(self._state_directory, device_id).save(baud, results)
+
+        if failed:
+            raise PicNotDetected
+
+    def _deviceBaud(self, device_id):
+        '''
+        Возвращает скорость порта устройства: заданную в командной строке, подобранную командой calibrate
+        или заданную в конфигурационном файле
+
+        @param self       Ссылка на экземпляр класса
+        @param device_id  Идентификатор устройства [string]
+        @return Скорость порта [int]
+        '''
+
+        if self._baud_fixed or not self._state_directory:
+            return self._device_baud
+        baud = LinkCalibration(self._state_directory, device_id).baud()
+        if baud:
+            logger.debug("Using baud rate {} found by calibration for device '{}'".format(baud, device_id))
+            return baud
+        return self._device_baud
+
+    def _showHistory(self, report='runs', hours='24'):
+        '''
+        Выводит отчет по журналу загрузок прошивки
+
+        @param self    Ссылка на экземпляр класса
+        @param report  Имя отчета (ключ REPORTS) [string]
+        @param hours   Длительность интервала, за который формируется отчет, ч [string]
+        '''
+
+        if not self._history_database:
+            raise HistoryNotConfigured
+        if report not in REPORTS:
+            logger.error("Unknown history report '{}', known reports are: {}".format(report, ', '.join(sorted(REPORTS))))
+            raise SystemExit(4)
+        try:
+            since = time.time() - float(hours) * 3600
+        except ValueError:
+            logger.error("Illegal number of hours '{}'".format(hours))
+            raise SystemExit(4)
+
+        columns, rows = FlashHistory(self._history_database).report(report, since)
+        sys.stdout.write(formatReport(columns, rows))
+
+    def _showDiff(self, old_filename, new_filename):
+        '''
+        Выводит построчное различие двух файлов прошивки и оценку времени, сэкономленного разностной загрузкой
+
+        @param self          Ссылка на экземпляр класса
+        @param old_filename  Имя исходного файла прошивки [string]
+        @param new_filename  Имя нового файла прошивки [string]
+        '''
+
+        # Размещение строк и формат кадров зависят от модели МК
+        if self._pic_code is None:
+            logger.error("PIC model code must be specified with --pic for diff")
+            raise SystemExit(4)
+
+        loader = bootloader()
+        loader.selectPic(self._pic_code)
+        changed, added, removed, unchanged = loader.diffFirmware(old_filename, new_filename)
+
+        status = dict([(row, 'changed') for row in changed] + [(row, 'added') for row in added] + [(row, 'removed') for row in removed])
+        for row in sorted(status):
+            sys.stdout.write("{:#06x}  {}\n".format(loader.rowAddress(row), status[row]))
+
+        # Оценка времени передачи: полная загрузка передает все строки нового образа, разностная -- только измененные
+        baud = self._device_baud or self._DEFAULT_BAUD
+        frame_size = loader.frameSize()
+        full_time = estimateTransferTime(len(changed) + len(added) + len(unchanged), frame_size, baud)
+        delta_time = estimateTransferTime(len(changed) + len(added), frame_size, baud)
+        sys.stdout.write("Rows: {} changed, {} added, {} removed, {} unchanged\n".format(
+            len(changed), len(added), len(removed), len(unchanged)))
+        sys.stdout.write("Estimated flashing time at {} baud: full {:.2f}s, delta {:.2f}s, saved {:.2f}s\n".format(
+            baud, full_time, delta_time, full_time - delta_time))
+
+    def _showPlan(self):
+        '''
+        Выводит план загрузки прошивки в устройство: строки, которые будут переданы, количество байт и оценку времени
+        передачи. Порт не используется, модель МК задается опцией --pic; журнал устройства и контрольная точка читаются,
+        но не изменяются
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if not self._firmware_filename:
+            raise NoFirmwareFound
+        if self._pic_code is None:
+            logger.error("PIC model code must be specified with --pic for dry run")
+            raise SystemExit(4)
+
+        device_id = self._device_id or self._device_name
+        loader = bootloader(
+          firmware_cache=self._createFirmwareCache(),
+          ledger=self._createLedger(device_id),
+          checkpoint=self._createCheckpoint(device_id)
+        )
+        loader.selectPic(self._pic_code)
+        pic_mem, plan = loader.planFlashing(self._firmware_filename, delta=self._delta, resume=self._resume)
+
+        status = dict([(row, 'send') for row in plan.rows] + [(row, 'skip') for row in plan.skipped] +
+                      [(row, 'erased') for row in plan.elided])
+        for row in sorted(status):
+            sys.stdout.write("{:#06x}  {}\n".format(loader.rowAddress(row), status[row]))
+
+        baud = self._deviceBaud(device_id) or self._DEFAULT_BAUD
+        sys.stdout.write("Rows: {} to send, {} already in flash memory, {} erased rows elided\n".format(
+          len(plan.rows), len(plan.skipped), len(plan.elided)))
+        sys.stdout.write("Bytes: {} ({} firmware bytes, {}-byte frames)\n".format(
+          plan.byteCount(), sum(pic_mem.rowCount(row) for row in plan.rows), plan.frame_size))
+        sys.stdout.write("Estimated transfer time at {} baud: {:.2f}s\n".format(baud, plan.estimateTime(baud)))
+
+    def _createBootloader(self, port, device_id, progress_info_filename, firmware_cache, record_filename=None,
+                          loader_class=bootloader):
+        '''
+        Создает объект bootloader и открывает порт (или воспроизведение записанного обмена, если оно задано)
+
+        @param self                    Ссылка на экземпляр класса
+        @param port                    Имя порта [string]
+        @param device_id               Идентификатор устройства [string]
+        @param progress_info_filename  Имя файла для сохранения информации о прогрессе [string]
+        @param firmware_cache          Кэш подготовленных образов прошивки [FirmwareCache или SharedFirmwareCache]
+        @param record_filename         Имя файла для записи обмена через порт [string]
+        @param loader_class            Класс загрузчика [bootloader или AsyncBootloader]
+        @return Объект bootloader [bootloader]
+        '''
+
+        # Воспроизведение записанного обмена не должно изменять сохраненное состояние устройства
+        if self._replay_filename:
+            loader = bootloader(progress_info_filename, firmware_cache=firmware_cache)
+            loader.setRetryPolicy(self._write_retries, self._write_retry_delay)
+            loader.setTimeouts(**self._timeouts)
+            loader.attachSerial(SerialReplay(self._replay_filename, self._replay_speed))
+            return loader
+
+        loader = loader_class(
+          progress_info_filename,
+          firmware_cache=firmware_cache,
+          ledger=self._createLedger(device_id),
+          checkpoint=self._createCheckpoint(device_id)
+        )
+        loader.setRetryPolicy(self._write_retries, self._write_retry_delay)
+        loader.setTimeouts(**self._timeouts)
+        loader.openSerial(port, self._deviceBaud(device_id), self._device_timeout, self._low_latency)
+        if record_filename:
+            loader.attachSerial(SerialRecorder(loader.serial, record_filename))
+        return loader
+
+    @staticmethod
+    def _expandDevices(device_name):
+        '''
+        Формирует список портов из имени порта, заданного в настройках или командной строке.
+        Имена нескольких портов разделяются запятыми, шаблоны имен (например, /dev/ttyUSB*) раскрываются
+
+        @param device_name  Имя порта, список имен через запятую или шаблон [string]
+        @return Имена портов без повторов в порядке перечисления [list]
+        '''
+
+        ports = []
+        for name in (device_name or '').split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if glob.has_magic(name):
+                matched = sorted(glob.glob(name))
+                if not matched:
+                    logger.warning("No serial ports match '{}'".format(name))
+                names = matched
+            else:
+                names = [name]
+            ports.extend(port for port in names if port not in ports)
+
+        return ports or [device_name]
+
+    def _runParallel(self, ports):
+        '''
+        Загружает прошивку одновременно в устройства, подключенные к нескольким портам.
+        Для каждого порта создается отдельный объект bootloader, выполняющийся в отдельном потоке; hex-файл разбирается
+        один раз для каждого типа МК, подготовленный образ используется всеми потоками только для чтения
+
+        @param self    Ссылка на экземпляр класса
+        @param ports   Имена портов [list]
+        @return Результаты загрузки в виде кортежей (порт, код завершения, сообщение, время загрузки) [list]
+        '''
+
+        if self._device_id:
+            logger.warning("Device identifier is ignored when several ports are used, port names identify devices")
+        if self._stream:
+            logger.warning("Streaming mode is ignored when several ports are used, firmware is parsed once for all ports")
+            self._stream = False
+
+        firmware_cache = SharedFirmwareCache(self._createFirmwareCache())
+        self._bootloaders = []
+        if self._event_loop:
+            return self._runEventLoop(ports, firmware_cache)
+        pool = ThreadPool(len(ports))
+        try:
+            result = pool.map_async(lambda port: self._flashPort(port, firmware_cache), ports)
+            # Ожидание с таймаутом позволяет обрабатывать сигналы в основном потоке
+            while not result.ready():
+                result.wait(self._POLL_INTERVAL)
+            return result.get()
+        finally:
+            pool.close()
+
+    def _runEventLoop(self, ports, firmware_cache):
+        '''
+        Загружает прошивку одновременно в устройства, подключенные к нескольким портам, обслуживая все порты в одном
+        потоке неблокирующим драйвером (AsyncBootloader). МК сбрасывается только командой: аппаратный сброс
+        и запомненный способ сброса не используются
+
+        @param self            Ссылка на экземпляр класса
+        @param ports           Имена портов [list]
+        @param firmware_cache  Разделяемый кэш подготовленных образов прошивки [SharedFirmwareCache]
+        @return Результаты загрузки в виде кортежей (порт, код завершения, сообщение, время загрузки) [list]
+        '''
+
+        if self._record_filename:
+            logger.warning("Serial traffic recording is not supported by the event loop driver, ignoring")
+
+        started = time.time()
+        # Время завершения и исключения, прервавшие загрузку, по портам
+        finished = {}
+        errors = {}
+
+        def timed(port, coroutine):
+            try:
+                yield coroutine
+            finally:
+                finished[port] = time.time()
+
+        loop = SerialLoop()
+        tasks = []
+        try:
+            for port in ports:
+                progress_info_filename = None
+                if self._progress_info_filename:
+                    progress_info_filename = "{}.{}".format(self._progress_info_filename, safeName(port))
+                try:
+                    loader = self._createBootloader(port, port, progress_info_filename, firmware_cache,
+                                                    loader_class=AsyncBootloader)
+                except Exception, e:
+                    errors[port] = e
+                    finished[port] = time.time()
+                    continue
+                self._bootloaders.append(loader)
+                coroutine = loader.flashAsync(
+                  self._firmware_filename,
+                  reset_seq=self._cfg['pic'].get('reset-sequence', None),
+                  reply_seq=self._cfg['pic'].get('reset-reply-sequence', None),
+                  max_attempts=self._cfg['pic'].get('reset-max-attempts', 3),
+                  delta=self._delta,
+                  resume=self._resume
+                )
+                tasks.append((port, loop.spawn(loader.fileno(), timed(port, coroutine), name=port)))
+
+            # Ожидание с таймаутом позволяет обрабатывать сигналы
+            while not loop.run(self._POLL_INTERVAL):
+                pass
+        finally:
+            for loader in self._bootloaders:
+                loader.closeSerial()
+
+        errors.update((port, task.exception()) for port, task in tasks if task.exception())
+        results = []
+        for port in ports:
+            if port in errors:
+                code, message = self._describeError(errors[port])
+                logger.error("Port '{}': {}".format(port, message))
+            else:
+                code, message = 0, "OK"
+                logger.info("Port '{}': firmware loaded".format(port))
+            results.append((port, code, message, finished[port] - started))
+        return results
+
+    def _flashPort(self, port, firmware_cache):
+        '''
+        Загружает прошивку в устройство, подключенное к указанному порту (выполняется в рабочем потоке)
+
+        @param self            Ссылка на экземпляр класса
+        @param port            Имя порта [string]
+        @param firmware_cache  Разделяемый кэш подготовленных образов прошивки [SharedFirmwareCache]
+        @return Результат загрузки в виде кортежа (порт, код завершения, сообщение, время загрузки) [tuple]
+        '''
+
+        started = time.time()
+        progress_info_filename = record_filename = None
+        if self._progress_info_filename:
+            progress_info_filename = "{}.{}".format(self._progress_info_filename, safeName(port))
+        if self._record_filename:
+            record_filename = "{}.{}".format(self._record_filename, safeName(port))
+        try:
+            loader = self._createBootloader(port, port, progress_info_filename, firmware_cache, record_filename)
+            self._bootloaders.append(loader)
+            try:
+                self._startLoading(loader, self._firmware_filename, delta=self._delta, resume=self._resume, device_id=port)
+            finally:
+                loader.closeSerial()
+        except Exception, e:
+            code, message = self._describeError(e)
+            logger.error("Port '{}': {}".format(port, message))
+            return port, code, message, time.time() - started
+
+        logger.info("Port '{}': firmware loaded".format(port))
+        return port, 0, "OK", time.time() - started
+
+    def _describeError(self, exc):
+        '''
+        Возвращает код завершения и сообщение для исключения, прервавшего загрузку прошивки
+
+        @param self    Ссылка на экземпляр класса
+        @param exc     Исключение [Exception]
+        @return Код завершения и сообщение [tuple(int, string)]
+        '''
+
+        for exc_type, code, message in self._EXIT_CODES:
+            if isinstance(exc, exc_type):
+                return code, message
+        return 255, "failed due to exception {} ({})".format(type(exc).__name__, exc)
+
+    @staticmethod
+    def _showResults(results):
+        '''
+        Выводит таблицу результатов загрузки прошивки в несколько устройств
+
+        @param results  Результаты загрузки в виде кортежей (порт, код завершения, сообщение, время загрузки) [list]
+        '''
+
+        width = max(len('PORT'), *(len(port) for port, _, _, _ in results))
+        sys.stdout.write("{:<{}}  {:>4}  {:>8}  {}\n".format('PORT', width, 'CODE', 'TIME', 'RESULT'))
+        for port, code, message, elapsed in results:
+            sys.stdout.write("{:<{}}  {:>4}  {:>7.1f}s  {}\n".format(port, width, code, elapsed, message))
+        failed = sum(1 for _, code, _, _ in results if code)
+        sys.stdout.write("{} ports: {} succeeded, {} failed\n".format(len(results), len(results) - failed, failed))
+
     def run(self, argv):
         '''
-        Осуществляет запуск приложения
+        Осуществляет запуск приложения и сохраняет метрики загрузки прошивки
+
+        @param self				Ссылка на экземпляр класса
+        @param argv				Список аргументов командной строки [list]
+        '''
+
+        exit_code = 0
+        try:
+            self._run(argv)
+        except SystemExit, e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+            raise
+        finally:
+            self._writeMetrics(exit_code)
+            self._writeHistory(exit_code)
+
+    def _writeMetrics(self, exit_code):
+        '''
+        Сохраняет метрики загрузки прошивки в файлы, заданные в конфигурационном файле
+
+        @param self				Ссылка на экземпляр класса
+        @param exit_code        Код завершения приложения [int]
+        '''
+
+        if not self._bootloaders:
+            return
+
+        runs = []
+        for loader in self._bootloaders:
+            port = loader.serial.port if loader.serial else self._device_name
+            # В многопортовом режиме код завершения определяется для каждого порта
+            code = self._port_exit_codes.get(port, exit_code)
+            loader.metrics.addPhase('config', self._config_time)
+            runs.append(({'port': port}, loader.metrics, code))
+        self._saveMetrics(runs)
+
+    def _saveMetrics(self, runs):
+        '''
+        Записывает метрики загрузок прошивки в файлы, заданные в конфигурационном файле
+
+        @param self				Ссылка на экземпляр класса
+        @param runs             Загрузки в виде списка кортежей (метки, метрики, код завершения) [list]
+        '''
+
+        if self._metrics_json:
+            writeFile(self._metrics_json, summaryJson(runs))
+        if self._metrics_textfile:
+            writeFile(self._metrics_textfile, formatTextfile(runs))
+
+    def _writeHistory(self, exit_code):
+        '''
+        Добавляет в журнал загрузок прошивки записи о загрузке во все устройства
+
+        @param self				Ссылка на экземпляр класса
+        @param exit_code        Код завершения приложения [int]
+        '''
+
+        # Воспроизведение записанного обмена не является загрузкой прошивки в устройство
+        if self._replay_filename:
+            return
+        for loader in self._bootloaders:
+            port = loader.serial.port if loader.serial else self._device_name
+            if len(self._bootloaders) == 1:
+                self._recordHistory(loader, port, self._device_id or port, exit_code)
+            else:
+                self._recordHistory(loader, port, port, self._port_exit_codes.get(port, exit_code))
+
+    def _recordHistory(self, loader, port, device_id, exit_code):
+        '''
+        Добавляет в журнал загрузок прошивки запись о загрузке, если база данных журнала задана в конфигурационном файле
+
+        @param self				Ссылка на экземпляр класса
+        @param loader           Объект bootloader, выполнивший загрузку [bootloader]
+        @param port             Имя порта [string]
+        @param device_id        Идентификатор устройства [string]
+        @param exit_code        Код завершения загрузки [int]
+        '''
+
+        if not self._history_database:
+            return
+        baud = getattr(loader.serial, 'baudrate', None) or self._device_baud
+        FlashHistory(self._history_database).addRun(port, device_id, loader, exit_code, baud)
+
+    def _run(self, argv):
+        '''
+        Выполняет загрузку прошивки или команду, заданную в командной строке
 
         @param self				Ссылка на экземпляр класса
         @param argv				Список аргументов командной строки [list]
@@ -239,19 +1087,51 @@ Options are:
 
         try:
             # Загрузка параметров из конфигурационного файла
+            started = time.time()
             self._loadConfig()
+            self._config_time = time.time() - started
             # Разбор опций командной строки
             self._parseCmdLine(argv)
+            # Задана команда?
+            if self._arguments:
+                self._runCommand(self._arguments)
+                return
+            # Задан вывод плана загрузки?
+            if self._dry_run:
+                self._showPlan()
+                return
+            # При воспроизведении записанного обмена порт не используется
+            ports = [self._device_name] if self._replay_filename else self._expandDevices(self._device_name)
+            # Задано несколько портов -- загружаем прошивку во все устройства одновременно
+            if len(ports) > 1:
+                logger.message("{} started. PID is {}".format(self.app_name, os.getpid()))
+                results = self._runParallel(ports)
+                self._port_exit_codes = dict((port, code) for port, code, _, _ in results)
+                self._showResults(results)
+                exit_code = max(code for _, code, _, _ in results)
+                if exit_code:
+                    raise SystemExit(exit_code)
+                logger.message("%s exited" % self.app_name)
+                return
             # Иниализируем bootloader
-            self._bootloader = bootloader(self._progress_info_filename)
-            self._bootloader.openSerial(
+            self._bootloader = self._createBootloader(
               self._device_name,
-              self._device_baud,
-              self._device_timeout
+              self._device_id or self._device_name,
+              self._progress_info_filename,
+              self._createFirmwareCache(),
+              self._record_filename
             )
+            self._bootloaders = [self._bootloader]
             logger.message("{} started. PID is {}".format(self.app_name, os.getpid()))
             # Запуск загрузки прошивки
-            self._startLoading()
+            self._startLoading(
+              self._bootloader,
+              self._firmware_filename,
+              stream=self._stream,
+              delta=self._delta,
+              resume=self._resume,
+              device_id=self._device_id or self._device_name
+            )
         except KeyboardInterrupt:
             logger.message("%s interrupted" % self.app_name)
         except CfgFileLoadingFailed:
@@ -268,6 +1148,17 @@ Options are:
         except NoFirmwareFound:
             logger.error("No firmware file specified")
             raise SystemExit(5)
+        except FlashingInterrupted:
+            logger.error("Flashing interrupted, run with --resume to continue")
+            raise SystemExit(6)
+        except DaemonException, e:
+            logger.error(str(e))
+            raise SystemExit(7)
+        except HistoryNotConfigured:
+            logger.error("History database is not defined in configuration file")
+            raise SystemExit(1)
+        except SystemExit:
+            raise
         except:
             logger.critical("Bootloading process failed due to exception {} ({})".format(*sys.exc_info()[:2]))
             raise SystemExit(255)
@@ -299,12 +1190,46 @@ Options are:
                 )
                 # Имя файла прошивки
                 self._firmware_filename = self._cfg['pic'].get('firmware', None)
+                # Потоковый режим передачи прошивки
+                self._stream = self._cfg['pic'].get('stream', self._stream)
+                # Повторные попытки записи строки
+                self._write_retries = self._cfg['pic'].get('write-retries', self._write_retries)
+                self._write_retry_delay = self._cfg['pic'].get('write-retry-delay', self._write_retry_delay)
+                # Идентификатор устройства
+                self._device_id = self._cfg['pic'].get('device-id', self._device_id)
+                # Имя файла unix-сокета сервера загрузки прошивки
+                self._socket_path = self._cfg.get('daemon', {}).get('socket', self._socket_path)
+                # Файлы для сохранения метрик загрузки
+                self._metrics_json = self._cfg.get('metrics', {}).get('json', self._metrics_json)
+                self._metrics_textfile = self._cfg.get('metrics', {}).get('textfile', self._metrics_textfile)
+                # База данных журнала загрузок прошивки
+                self._history_database = self._cfg.get('history', {}).get('database', self._history_database)
+                # Каталог для хранения состояния устройств
+                self._state_directory = self._cfg.get('state', {}).get('directory', self._state_directory)
                 # Имя порта
                 self._device_name = self._cfg['serial'].get('device', self._device_name)
                 # Скорость порта
                 self._device_baud = self._cfg['serial'].get('baud', self._device_baud)
+                # Настройка порта для уменьшения задержки приема
+                if self._cfg['serial'].get('low-latency', False):
+                    self._low_latency = {
+                      'latency_timer': self._cfg['serial'].get('latency-timer', 1),
+                      'buffer_size': self._cfg['serial'].get('buffer-size'),
+                    }
+                # Скорости, проверяемые при подборе скорости порта
+                self._calibration_bauds = self._cfg['serial'].get('calibrate-bauds', self._calibration_bauds)
                 # Таймаут чтения из порта
                 self._device_timeout = self._cfg['serial'].get('timeout', self._device_timeout)
+                # Таймауты ожидания ответов МК по операциям
+                self._timeouts = {
+                  'probe': self._cfg['serial'].get('probe-timeout'),
+                  'reset': self._cfg['serial'].get('reset-timeout'),
+                  'ack': self._cfg['serial'].get('ack-timeout'),
+                }
+                # Параметры кэша подготовленных образов прошивки
+                cache_cfg = self._cfg.get('cache', {})
+                self._cache_directory = cache_cfg.get('directory', self._cache_directory)
+                self._cache_max_size = cache_cfg.get('max-size', self._cache_max_size)
         except:
             raise
 
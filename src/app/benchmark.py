@@ -0,0 +1,302 @@
+# coding: utf-8
+'''
+@package app.benchmark
+Bootloader для микроконтроллеров PIC: измерение производительности разбора hex-файлов, подготовки образа,
+формирования кадров и загрузки прошивки в эмулятор
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from bootloader import bootloader
+from emulator import TinyBootloaderEmulator
+from pictype import pic_device
+
+
+## Размеры синтетических образов: {имя:(код модели МК, объем данных, байт)}
+IMAGE_SIZES = {
+  '4K': (0x32, 0x1000),
+  '8K': (0x31, 0x2000),
+  '128K': (0x4A, 0x20000),
+}
+
+## Измеряемые этапы в порядке выполнения
+CASES = ('parse', 'prepare', 'framing', 'flash')
+
+## Увеличение прироста пикового объема памяти, не считающееся регрессией (погрешность измерения), КБ
+MEMORY_NOISE_KB = 1024
+
+## Количество байт данных в записи синтетического hex-файла
+_RECORD_SIZE = 16
+
+
+def makeHex(size, seed=0):
+    '''
+    Формирует синтетический hex-файл: вектор сброса с переходом на начало программы и случайные данные
+
+    @param size  Объем данных, байт [int]
+    @param seed  Начальное значение генератора случайных чисел [int]
+    @return Содержимое hex-файла [string]
+    '''
+
+    rnd = random.Random(seed)
+    data = bytearray(rnd.getrandbits(8) for _ in xrange(size))
+    # clrf PCLATH; goto 0x10
+    data[0:4] = bytearray((0x8a, 0x01, 0x10, 0x28))
+
+    lines = []
+    upper = 0
+    for addr in xrange(0, size, _RECORD_SIZE):
+        # Адреса за пределами 64 КБ задаются записью расширенного линейного адреса
+        if addr >> 16 != upper:
+            upper = addr >> 16
+            lines.append(_record(0, 0x04, bytearray(((upper >> 8) & 255, upper & 255))))
+        lines.append(_record(addr & 0xFFFF, 0x00, data[addr:addr + _RECORD_SIZE]))
+    lines.append(_record(0, 0x01, bytearray()))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _record(addr, record_type, data):
+    '''
+    Формирует запись hex-файла
+
+    @param addr         Адрес (младшие 16 бит) [int]
+    @param record_type  Тип записи [int]
+    @param data         Данные [bytearray]
+    @return Строка записи [string]
+    '''
+
+    record = bytearray((len(data), (addr >> 8) & 255, addr & 255, record_type)) + data
+    record.append(-sum(record) & 255)
+    return ':' + str(record).encode('hex').upper()
+
+
+def _detectedLoader(device_id):
+    '''
+    Создает объект bootloader, настроенный на указанную модель МК так же, как после ее обнаружения
+
+    @param device_id  Код модели МК [int]
+    @return Объект bootloader [bootloader]
+    '''
+
+    loader = bootloader()
+    loader._identify(chr(device_id) + 'K')
+    return loader
+
+
+def _runParse(loader, filename):
+    '''
+    Измеряет этап: разбор hex-файла
+
+    @param loader    Объект bootloader, настроенный на модель МК [bootloader]
+    @param filename  Имя hex-файла [string]
+    @return Длительность, с [float]
+    '''
+
+    start = time.time()
+    loader.loadHex(filename)
+    return time.time() - start
+
+
+def _runPrepare(loader, filename):
+    '''
+    Измеряет этап: перемещение вектора сброса и формирование перечня передаваемых строк (без разбора файла)
+
+    @param loader    Объект bootloader, настроенный на модель МК [bootloader]
+    @param filename  Имя hex-файла [string]
+    @return Длительность, с [float]
+    '''
+
+    image = loader.loadHex(filename)
+    start = time.time()
+    loader.moveResetVector(image)
+    list(loader._imageRows(image))
+    return time.time() - start
+
+
+def _runFraming(loader, filename):
+    '''
+    Измеряет этап: формирование кадров всех передаваемых строк
+
+    @param loader    Объект bootloader, настроенный на модель МК [bootloader]
+    @param filename  Имя hex-файла [string]
+    @return Длительность, с [float]
+    '''
+
+    image = loader.loadHex(filename)
+    loader.moveResetVector(image)
+    rows = [row for row, _ in loader._imageRows(image)]
+    start = time.time()
+    for row in rows:
+        bytes(loader._buildFrame(loader.rowAddress(row), image.row(row)))
+    return time.time() - start
+
+
+def _runCase(case, size_name, filename, repeats, baud=None, row_latency=0.0):
+    '''
+    Выполняет измерение этапа указанное количество раз
+
+    @param case         Этап [string]
+    @param size_name    Размер образа (ключ IMAGE_SIZES) [string]
+    @param filename     Имя синтетического hex-файла [string]
+    @param repeats      Количество повторов [int]
+    @param baud         Скорость порта эмулятора (для этапа flash) [int] или None
+    @param row_latency  Время записи строки эмулятором, с [float]
+    @return Длительности повторов, с [list]
+    '''
+
+    device_id = IMAGE_SIZES[size_name][0]
+    loader = _detectedLoader(device_id)
+    if case != 'flash':
+        run = {'parse': _runParse, 'prepare': _runPrepare, 'framing': _runFraming}[case]
+        return [run(loader, filename) for _ in xrange(repeats)]
+
+    emulator = TinyBootloaderEmulator(device_id, baud, row_latency)
+    port = emulator.start()
+    try:
+        loader.openSerial(port, baud or 115200, 1)
+        times = []
+        for _ in xrange(repeats):
+            start = time.time()
+            loader.bootload(filename)
+            times.append(time.time() - start)
+        loader.closeSerial()
+    finally:
+        emulator.stop()
+    return times
+
+
+def _measure(case, size_name, filename, repeats, baud, row_latency):
+    '''
+    Выполняет измерение в дочернем процессе, чтобы учесть пиковый объем памяти только этого этапа. Дочерний процесс
+    наследует память родительского, поэтому учитывается прирост пикового объема памяти относительно объема
+    на момент начала измерения
+
+    @param case         Этап [string]
+    @param size_name    Размер образа (ключ IMAGE_SIZES) [string]
+    @param filename     Имя синтетического hex-файла [string]
+    @param repeats      Количество повторов [int]
+    @param baud         Скорость порта эмулятора (для этапа flash) [int] или None
+    @param row_latency  Время записи строки эмулятором, с [float]
+    @return Результат измерения: длительности, минимальная, медианная и средняя длительность, объем памяти в начале
+            измерения, пиковый объем памяти и его прирост [dict]
+    '''
+
+    # База данных моделей МК загружается до запуска дочернего процесса, чтобы ее объем не входил в прирост памяти этапа
+    pic_device(IMAGE_SIZES[size_name][0])
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        # ru_maxrss в Linux -- в килобайтах; в начале работы дочернего процесса равен объему унаследованной памяти
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            result = {'times': _runCase(case, size_name, filename, repeats, baud, row_latency)}
+        except:
+            result = {'error': "{} ({})".format(*sys.exc_info()[:2])}
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result.update(rss_start_kb=rss_start, maxrss_kb=rss_peak, rss_increase_kb=rss_peak - rss_start)
+        with os.fdopen(write_fd, 'wb') as f:
+            f.write(json.dumps(result))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    result = json.loads(output) if output else {'error': 'benchmark process crashed'}
+
+    times = result.get('times')
+    if times:
+        ordered = sorted(times)
+        result.update(
+          min=ordered[0],
+          median=ordered[len(ordered) // 2],
+          mean=sum(ordered) / len(ordered),
+        )
+    return result
+
+
+def runBenchmarks(sizes=None, cases=None, repeats=5, baud=None, row_latency=0.0):
+    '''
+    Выполняет измерения для указанных размеров образов и этапов
+
+    @param sizes        Размеры образов (ключи IMAGE_SIZES) [list] или None (все)
+    @param cases        Этапы (элементы CASES) [list] или None (все)
+    @param repeats      Количество повторов каждого измерения [int]
+    @param baud         Скорость порта эмулятора для этапа flash [int] или None (без задержек передачи)
+    @param row_latency  Время записи строки эмулятором, с [float]
+    @return Результаты в виде {'этап/размер':результат, ...} вместе с описанием окружения [dict]
+    '''
+
+    results = {}
+    for size_name in sizes or sorted(IMAGE_SIZES, key=lambda name: IMAGE_SIZES[name][1]):
+        fd, filename = tempfile.mkstemp(prefix='pic_bench_', suffix='.hex')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(makeHex(IMAGE_SIZES[size_name][1]))
+            for case in cases or CASES:
+                name = '{}/{}'.format(case, size_name)
+                result = results[name] = _measure(case, size_name, filename, repeats, baud, row_latency)
+                if 'error' in result:
+                    logger.error("{}: failed due to {}".format(name, result['error']))
+                else:
+                    logger.info("{}: median {:.4f}s, min {:.4f}s, max RSS {} KB (+{} KB)".format(
+                      name, result['median'], result['min'], result['maxrss_kb'], result['rss_increase_kb']))
+        finally:
+            os.unlink(filename)
+
+    return {
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'repeats': repeats,
+      'baud': baud,
+      'row_latency': row_latency,
+      'results': results,
+    }
+
+
+def compareResults(current, baseline, threshold=0.1):
+    '''
+    Сравнивает результаты измерений с базовыми: медианное время и прирост пикового объема памяти. Увеличение прироста
+    памяти в пределах MEMORY_NOISE_KB регрессией не считается
+
+    @param current    Текущие результаты (см. runBenchmarks()) [dict]
+    @param baseline   Базовые результаты [dict]
+    @param threshold  Допустимое относительное увеличение медианного времени и прироста памяти [float]
+    @return Сравнение в виде списка кортежей (измерение, показатель ('time' или 'memory'), базовое значение, текущее
+            значение, отношение, признак регрессии) [list]
+    '''
+
+    comparison = []
+    for name, result in sorted(current['results'].iteritems()):
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        if 'median' in base and 'median' in result:
+            ratio = result['median'] / base['median'] if base['median'] else float('inf')
+            comparison.append((name, 'time', base['median'], result['median'], ratio, ratio > 1 + threshold))
+        # Базовые результаты, полученные до учета прироста памяти, по памяти не сравниваются
+        if 'rss_increase_kb' in base and 'rss_increase_kb' in result:
+            base_kb, current_kb = base['rss_increase_kb'], result['rss_increase_kb']
+            ratio = float(current_kb) / base_kb if base_kb else float('inf') if current_kb else 1.0
+            regression = current_kb - base_kb > max(base_kb * threshold, MEMORY_NOISE_KB)
+            comparison.append((name, 'memory', base_kb, current_kb, ratio, regression))
+
+    return comparison
@@ -12,11 +12,21 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+import hashlib
+import os
 import serial
 import sys
 import time
+from contextlib import contextmanager
 from lib.myexception import MyException
-from pictype import pic_type
+from pictype import pic_device
+from flashimage import FlashImage
+from transmitter import FramePipeline, TransferStats
+from ledger import rowHash, imageRowHashes, diffImages
+from metrics import FlashMetrics
+from flashplan import FlashPlan, erasedRowHashes
+from lowlatency import LowLatencyTuning
+import intelhex
 
 
 class BootloaderException(MyException):
@@ -75,12 +85,27 @@ class FlashWriteFailed(BootloaderException):
     pass
 
 
+class FlashingInterrupted(BootloaderException):
+
+    '''
+    Класс исключений для ситуации, когда загрузка прошивки остановлена по запросу (например, по сигналу SIGTERM)
+    '''
+    pass
+
+
 class bootloader(object):
 
     '''
     Инкапсулирует функционал загрузки прошивки в МК
     '''
 
+    ## Последовательный порт (открывается функцией self.openSerial()) [serial.Serial]
+    serial = None
+    ## Настройка порта для уменьшения задержки приема (если применялась) [LowLatencyTuning]
+    _tuning = None
+    ## Порт, сигналом DTR которого выполняется аппаратный сброс МК (открывается при первом сбросе) [serial.Serial]
+    _reset_serial = None
+
     # Параметры МК (устанавливаются функцией self.detectPic())
     ## Тип МК
     _type = None
@@ -88,20 +113,74 @@ class bootloader(object):
     _family = None
     ## Максимальный адрес ПЗУ
     _max_flash = None
+    ## Параметры модели МК из базы данных моделей [PicDevice]
+    _device = None
     ## Имя файла для сохранения информации о прогрессе
     _progress_info_filename = None
-
-    def __init__(self, progress_info_filename=None):
+    ## Кэш подготовленных образов прошивки [FirmwareCache]
+    _firmware_cache = None
+    ## Статистика последней передачи прошивки [TransferStats]
+    transfer_stats = None
+    ## Метрики загрузки прошивки (длительность этапов, задержка подтверждений) [FlashMetrics]
+    metrics = None
+    ## Хэш (SHA-1) содержимого последнего загруженного файла прошивки
+    firmware_hash = None
+    ## Время от отправки запроса определения типа МК до получения ответа при последнем определении, с
+    probe_rtt = None
+    ## Способ, которым МК переведен в режим загрузчика перед последней загрузкой (устанавливается приложением)
+    reset_method = None
+    ## Журнал содержимого ПЗУ устройства [FlashLedger]
+    _ledger = None
+    ## Контрольная точка загрузки прошивки [FlashCheckpoint]
+    _checkpoint = None
+    ## Признак запроса остановки загрузки
+    _stop_requested = False
+    ## Признак выполнения передачи строк образа в МК
+    _transferring = False
+    ## Максимальное количество повторных попыток записи строки
+    _write_retries = 0
+    ## Задержка перед первой повторной попыткой записи строки, с
+    _retry_delay = 0
+    ## Функция, вызываемая при изменении процента выполнения загрузки [callable(percentage)]
+    _progress_callback = None
+    ## Таймаут ожидания ответа на запрос определения типа МК, с (None -- таймаут чтения порта)
+    _probe_timeout = None
+    ## Таймаут ожидания ответа МК на последовательность сброса, с (None -- таймаут чтения порта)
+    _reset_timeout = None
+    ## Таймаут ожидания подтверждения записи строки, с (None -- таймаут чтения порта)
+    _ack_timeout = None
+
+    ## Запрос определения типа МК
+    _DETECT_REQUEST = chr(0xC1)
+    ## Семейства МК, загрузка прошивки в которые поддерживается
+    _SUPPORTED_FAMILIES = ("16F8XX", "18F")
+    ## Размер строки записи в ПЗУ МК (в байтах), если модель МК еще не определена
+    _DEFAULT_ROW_SIZE = 0x40
+    ## Размер образа ПЗУ (в байтах), если максимальный адрес ПЗУ еще не определен
+    _DEFAULT_IMAGE_SIZE = 0x10000
+    ## Период повторения запроса определения типа МК после аппаратного сброса, с
+    _HW_POLL_INTERVAL = 0.05
+    ## Количество кадров, подготавливаемых заранее во время ожидания подтверждения записи
+    _PIPELINE_DEPTH = 4
+
+    def __init__(self, progress_info_filename=None, firmware_cache=None, ledger=None, checkpoint=None):
         '''
         Конструктор
 
         @param self     Ссылка на экземпляр класса
         @param progress_info_filename 	Имя файла для сохранения информации о прогрессе [string]
+        @param firmware_cache  Кэш подготовленных образов прошивки [FirmwareCache]
+        @param ledger   Журнал содержимого ПЗУ устройства [FlashLedger]
+        @param checkpoint  Контрольная точка загрузки прошивки [FlashCheckpoint]
         '''
 
         self._progress_info_filename = progress_info_filename
+        self._firmware_cache = firmware_cache
+        self._ledger = ledger
+        self._checkpoint = checkpoint
+        self.metrics = FlashMetrics()
 
-    def openSerial(self, port, baud, timeout=1):
+    def openSerial(self, port, baud, timeout=1, low_latency=None):
         '''
         Открывает последовательный порт для подключения к МК
 
@@ -109,6 +188,8 @@ class bootloader(object):
         @param port     Имя последовательного порта [string]
         @param baud     Скорость порта [int]
         @param timeout  Таймаут чтения данных из порта (в секундах) [float]
+        @param low_latency  Параметры настройки порта для уменьшения задержки приема (аргументы LowLatencyTuning) [dict]
+                            или None (порт не настраивается)
         '''
 
         try:
@@ -119,20 +200,117 @@ class bootloader(object):
         else:
             logger.info("Serial port '{}' opened with baud rate {}; read timeout {}s".format(port, baud, timeout))
 
-    def resetPicHW(self, port):
+        if low_latency is not None:
+            self._tuning = LowLatencyTuning(self.serial, **low_latency)
+            self._tuning.apply()
+
+    def setBaud(self, baud):
         '''
-        Выполняет аппаратный сброс МК путем установки сигнала и сброса DTR в последовательном порту
+        Изменяет скорость открытого последовательного порта
+
+        @param self     Ссылка на экземпляр класса
+        @param baud     Скорость порта [int]
+        '''
+
+        self.serial.baudrate = baud
+        logger.debug("Serial port baud rate set to {}".format(baud))
+
+    def attachSerial(self, port):
+        '''
+        Использует указанный объект в качестве последовательного порта (например, обертку, записывающую обмен,
+        или воспроизведение записанного обмена)
+
+        @param self     Ссылка на экземпляр класса
+        @param port     Объект с интерфейсом serial.Serial (методы read, write, flushInput, close)
+        '''
+
+        self.serial = port
+
+    def closeSerial(self):
+        '''
+        Закрывает последовательный порт
+
+        @param self     Ссылка на экземпляр класса
+        '''
+
+        if self._tuning:
+            self._tuning.restore()
+            self._tuning = None
+        if self.serial:
+            self.serial.close()
+        if self._reset_serial:
+            if self._reset_serial is not self.serial:
+                self._reset_serial.close()
+            self._reset_serial = None
+
+    def _resetLine(self, port):
+        '''
+        Возвращает порт, сигналом DTR которого выполняется аппаратный сброс МК. Порт открывается при первом обращении
+        и остается открытым до закрытия последовательного порта (повторное открытие изменяет состояние DTR)
+
+        @param self     Ссылка на экземпляр класса
+        @param port     Имя порта [string]
+        @return Порт [serial.Serial]
+        '''
+
+        if self._reset_serial is None or self._reset_serial.port != port:
+            # Сброс выполняется сигналом DTR самого последовательного порта
+            if self.serial is not None and getattr(self.serial, 'port', None) == port:
+                self._reset_serial = self.serial
+            else:
+                device = serial.Serial()
+                device.port = port
+                # Открытие порта не должно начинать сброс
+                device.setDTR(False)
+                device.open()
+                self._reset_serial = device
+
+        return self._reset_serial
+
+    def resetPicHW(self, port, pulse=1.0, settle=1.0):
+        '''
+        Выполняет аппаратный сброс МК импульсом сигнала DTR в последовательном порту и определение типа МК: сразу после
+        окончания импульса загрузчику периодически отправляется запрос определения типа МК до получения ответа
+
         @param self     Ссылка на экземпляр класса
         @param port     Имя последовательного порта, на котором будет выполняться манипуляция сигналом DTR [string]
+        @param pulse    Длительность импульса сброса, с [float]
+        @param settle   Максимальное время ожидания ответа загрузчика после сброса, с [float]
+        @raise PicNotDetected  В случае, если загрузчик не ответил за время ожидания или ответ не удалось разобрать
         '''
 
         logger.info("Reseting PIC with hardware reset...")
 
-        device = serial.Serial(port, 9600)
+        try:
+            device = self._resetLine(port)
+        except serial.SerialException:
+            logger.error("Failed to open HW reset port '{}'".format(port))
+            raise PicNotDetected("Failed to open HW reset port", initial_exc=sys.exc_info()[0])
         device.setDTR(True)
-        time.sleep(1)
+        time.sleep(pulse)
         device.setDTR(False)
-        device.close()
+        # Ответы прикладной программы, полученные до сброса, не нужны
+        self.serial.flushInput()
+
+        # Загрузчик ожидает запрос лишь короткое время после сброса, поэтому запрос повторяется до получения ответа
+        deadline = time.time() + settle
+        received = ''
+        while True:
+            sent = time.time()
+            self.serial.write(self._DETECT_REQUEST)
+            # Ответ может прийти частями в ответ на разные запросы
+            reply, chunk = self._readReply(lambda data: self._findIdentity(received + data),
+                                           max(0, min(self._HW_POLL_INTERVAL, deadline - time.time())))
+            received += chunk
+            if reply:
+                self.probe_rtt = time.time() - sent
+                logger.debug("Bootloader answered {:.3f}s after reset".format(time.time() - deadline + settle))
+                self._identify(reply)
+                return
+            if time.time() >= deadline:
+                break
+
+        self._identify(received[-2:])
 
     def resetPic(self, reset_seq, reply_seq=None, max_attempts=3):
         '''
@@ -146,41 +324,122 @@ class bootloader(object):
         '''
 
         logger.info("Reseting PIC with {} sequence...".format(repr(reset_seq)))
-        # Отправляем последовательность для сброса
-        self.serial.write(reset_seq)
-        # Ответная последовательность указана?
-        if reply_seq:
-            i = 0
-            reply = ''
-            # Ожидаем ответную последовательность в течение max_attempts попыток
-            while reply != reply_seq:
-                # Это не первая попытка?
-                if i > 0:
-                    logger.warning('Failed to read PIC reply sequence on attempt #{}. Retrying...'.format(i))
-                    # Отправляем последовательность для сброса
-                    self.serial.write(reset_seq)
-                i += 1
-                # Пытаемся считать ответную последовательность
-                reply = self.serial.read(len(reply_seq))
-                logger.debug('Received {} bytes'.format(len(reply)))
-                # Выполнено максимальное разрешенное количество попыток?
-                if(i == max_attempts):
-                    logger.error('Failed to reset PIC by command during {} attempt(s)'.format(max_attempts))
-                    raise ResetFailed
+        for attempt in xrange(max_attempts):
+            # Это не первая попытка?
+            if attempt > 0:
+                logger.warning('Failed to read PIC reply sequence on attempt #{}. Retrying...'.format(attempt))
+            # Отправляем последовательность для сброса
+            self.serial.write(reset_seq)
+            # Ответная последовательность не указана?
+            if not reply_seq:
+                return
+            # Ожидаем ответную последовательность, пропуская предшествующие ей байты
+            found, received = self._readReply(lambda data: reply_seq in data, self._reset_timeout)
+            logger.debug('Received {} bytes'.format(len(received)))
+            if found:
+                return
+
+        logger.error('Failed to reset PIC by command during {} attempt(s)'.format(max_attempts))
+        raise ResetFailed
 
     def detectPic(self):
         '''
         Выполняет определение типа МК. На МК в момент определения должен выполняться код bootloader'а
 
         @param self     Ссылка на экземпляр класса
-        @raise PicNotDetected  В случае, если не удалось определить модель МК по значению, полученному от загрузчика
+        @raise PicNotDetected  В случае, если не удалось определить модель МК по значению, полученному от загрузчика,
+                               или загрузка прошивки в МК этого семейства не поддерживается
         '''
 
         logger.info("Detecting PIC...")
         # Отправляем запрос прошивке TinyBootloader
-        self.serial.write(chr(0xC1))
-        # Ответ должен содержать 2 байта
-        ret = self.serial.read(2)
+        sent = time.time()
+        self.serial.write(self._DETECT_REQUEST)
+        # Ответ (2 байта) ищется в потоке принятых данных по мере их поступления
+        reply, received = self._readReply(self._findIdentity, self._probe_timeout)
+        if reply:
+            self.probe_rtt = time.time() - sent
+        # Ответ не найден -- причину сообщает разбор последних принятых байт
+        self._identify(reply or received[-2:])
+
+    @staticmethod
+    def _findIdentity(data):
+        '''
+        Ищет в принятых данных ответ загрузчика на запрос определения типа МК: код известной модели МК и символ 'K'
+
+        @param data    Принятые данные [string]
+        @return Ответ загрузчика [string] или None, если ответ не найден
+        '''
+
+        position = data.find('K', 1)
+        while position > 0:
+            if pic_device(ord(data[position - 1])):
+                if position > 1:
+                    logger.debug("Skipped {} bytes before PIC reply".format(position - 1))
+                return data[position - 1:position + 1]
+            position = data.find('K', position + 1)
+        return None
+
+    def _readReply(self, match, timeout=None):
+        '''
+        Читает данные из порта по мере поступления, пока в них не будет найден ожидаемый ответ или не истечет таймаут.
+        Байты, предшествующие ответу (помехи, вывод прикладной программы), пропускаются
+
+        @param self     Ссылка на экземпляр класса
+        @param match    Функция, возвращающая найденный ответ по принятым данным [callable(string)]
+        @param timeout  Время ожидания ответа, с [float] или None (таймаут чтения порта)
+        @return Найденный ответ (None, если не найден) и все принятые данные [tuple(object, string)]
+        '''
+
+        received = ''
+        with self._readTimeout(timeout):
+            deadline = time.time() + self.serial.timeout
+            while True:
+                # Ждем первого байта, затем забираем все уже принятые
+                chunk = self.serial.read(1)
+                if chunk:
+                    waiting = self.serial.inWaiting()
+                    if waiting:
+                        chunk += self.serial.read(waiting)
+                received += chunk
+                result = match(received)
+                if result:
+                    return result, received
+                remaining = deadline - time.time()
+                if not chunk or remaining <= 0:
+                    return None, received
+                # Ожидание после помех не должно выходить за пределы таймаута
+                if remaining < self.serial.timeout:
+                    self.serial.timeout = remaining
+
+    @contextmanager
+    def _readTimeout(self, timeout):
+        '''
+        Временно устанавливает таймаут чтения из порта
+
+        @param self     Ссылка на экземпляр класса
+        @param timeout  Таймаут, с [float] или None (таймаут не изменяется)
+        '''
+
+        previous = self.serial.timeout
+        if timeout is not None:
+            self.serial.timeout = timeout
+        try:
+            yield
+        finally:
+            if self.serial.timeout != previous:
+                self.serial.timeout = previous
+
+    def _identify(self, ret):
+        '''
+        Определяет тип МК по ответу загрузчика на запрос определения
+
+        @param self     Ссылка на экземпляр класса
+        @param ret      Ответ загрузчика [string]
+        @raise PicNotDetected  В случае, если не удалось определить модель МК по значению, полученному от загрузчика,
+                               или загрузка прошивки в МК этого семейства не поддерживается
+        '''
+
         # Длина ответа отличается?
         if len(ret) != 2:
             raise PicNotDetected("Incorrect PIC reply length")
@@ -190,16 +449,62 @@ class bootloader(object):
             raise PicNotDetected("Wrong PIC reply")
 
         # Определяем тип МК
-        self._type, self._max_flash, self._family = pic_type(ord(ret[0]))
+        self._device = pic_device(ord(ret[0]))
         # Удалось определить?
-        if self._type:
+        if self._device:
+            self._type, self._max_flash, self._family = self._device.name, self._device.max_flash, self._device.family
             logger.info("Detected PIC type {0} ({2} family), max flash address is {1}".format(
                 self._type, self._max_flash, self._family))
-            if self._family != "16F8XX":
+            if self._family not in self._SUPPORTED_FAMILIES:
                 logger.error("Unsupported PIC family {}".format(self._family))
-                PicNotDetected("Unsupported PIC family")
+                raise PicNotDetected("Unsupported PIC family")
         else:
+            self._type = self._max_flash = self._family = None
+            raise PicNotDetected("Unknown PIC type")
+
+    def selectPic(self, pic_code):
+        '''
+        Задает модель МК без обращения к порту (например, для составления плана загрузки)
+
+        @param self      Ссылка на экземпляр класса
+        @param pic_code  Код модели МК, передаваемый загрузчиком в ответ на запрос определения [int]
+        @raise PicNotDetected  Если модель МК неизвестна или загрузка прошивки в МК этого семейства не поддерживается
+        '''
+
+        if not 0 <= pic_code < 256:
             raise PicNotDetected("Unknown PIC type")
+        self._identify(chr(pic_code) + 'K')
+
+    def picType(self):
+        '''
+        Возвращает тип и семейство обнаруженного МК
+
+        @param self     Ссылка на экземпляр класса
+        @return Тип и семейство МК [tuple(string, string)]; (None, None), если МК еще не обнаружен
+        '''
+
+        return self._type, self._family
+
+    def _buildFrame(self, addr, data):
+        '''
+        Формирует кадр протокола TinyBootloader для записи блока данных: адрес, длина блока, данные и контрольная сумма
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес, начиная с которого необходимо записать данные [int]
+        @param data    Данные для записи [bytearray или list]
+        @return Кадр, готовый к отправке в порт [bytearray]
+        '''
+
+        # Адрес передается старшим байтом вперед (у PIC18F трехбайтный: TBLPTRU, TBLPTRH, TBLPTRL)
+        address_bytes = self._device.address_bytes if self._device else 2
+        frame = bytearray((addr >> (8 * i)) & 255 for i in reversed(xrange(address_bytes)))
+        # Длина записываемого блока и данные
+        frame.append(len(data))
+        frame.extend(data)
+        # Контрольная сумма дополняет сумму всех байт кадра до нуля
+        frame.append(-sum(frame) & 255)
+
+        return frame
 
     def _write_mem(self, addr, data):
         '''
@@ -207,50 +512,125 @@ class bootloader(object):
 
         @param self    Ссылка на экземпляр класса
         @param addr    Адрес, начиная с которого необходимо записать данные [int]
-        @param data    Данные для записи [string]
+        @param data    Данные для записи [bytearray или list]
         @raise FlashWriteFailed  В случае, если от загрузчика не получено подтверждение успешной записи блока данных
         '''
 
+        frame = bytes(self._buildFrame(addr, data))
+        attempt = 0
+        with self._readTimeout(self._ack_timeout):
+            while True:
+                self._transmitFrame(frame)
+                try:
+                    self._waitAck(addr)
+                    return
+                except FlashWriteFailed:
+                    attempt = self._prepareRetry(addr, attempt)
+
+    def setRetryPolicy(self, max_retries, delay=0):
+        '''
+        Задает количество повторных попыток записи строки при отсутствии подтверждения от загрузчика
+
+        @param self         Ссылка на экземпляр класса
+        @param max_retries  Максимальное количество повторных попыток записи каждой строки [int]
+        @param delay        Задержка перед первой повторной попыткой, с; перед каждой следующей удваивается [float]
+        '''
+
+        self._write_retries = max_retries
+        self._retry_delay = delay
+
+    def setTimeouts(self, probe=None, reset=None, ack=None):
+        '''
+        Задает таймауты ожидания ответов МК отдельно для каждой операции (None -- используется таймаут чтения порта)
+
+        @param self     Ссылка на экземпляр класса
+        @param probe    Таймаут ожидания ответа на запрос определения типа МК, с [float]
+        @param reset    Таймаут ожидания ответа на последовательность сброса, с [float]
+        @param ack      Таймаут ожидания подтверждения записи строки, с [float]
+        '''
+
+        self._probe_timeout = probe
+        self._reset_timeout = reset
+        self._ack_timeout = ack
+
+    def setProgressCallback(self, callback):
+        '''
+        Задает функцию, вызываемую при изменении процента выполнения загрузки прошивки
+
+        @param self      Ссылка на экземпляр класса
+        @param callback  Функция, принимающая процент выполнения [callable(percentage)] или None
+        '''
+
+        self._progress_callback = callback
+
+    def _nextRetry(self, addr, attempt):
+        '''
+        Проверяет, допустима ли повторная отправка кадра после ошибки записи, и учитывает ее в статистике
+
+        @param self     Ссылка на экземпляр класса
+        @param addr     Адрес блока (используется в сообщениях) [int]
+        @param attempt  Количество уже выполненных повторных попыток [int]
+        @return Номер следующей повторной попытки и задержка перед ней, с [tuple(int, float)]
+        @raise FlashWriteFailed  Если количество повторных попыток исчерпано
+        '''
+
+        if attempt >= self._write_retries:
+            logger.error("Failed to write memory block starting from position {:#06X} after {} retries".format(addr, attempt))
+            raise FlashWriteFailed("No acknowledgement for block at {:#06x}".format(addr))
+
+        attempt += 1
+        logger.warning("Retrying write of block at {:#06x} (attempt {} of {})".format(addr, attempt, self._write_retries))
+        if self.transfer_stats:
+            self.transfer_stats.retries += 1
+
+        return attempt, self._retry_delay * 2 ** (attempt - 1)
+
+    def _prepareRetry(self, addr, attempt):
+        '''
+        Подготавливает повторную отправку кадра после ошибки записи: выдерживает задержку и сбрасывает буфер чтения
+
+        @param self     Ссылка на экземпляр класса
+        @param addr     Адрес блока (используется в сообщениях) [int]
+        @param attempt  Количество уже выполненных повторных попыток [int]
+        @return Номер следующей повторной попытки [int]
+        @raise FlashWriteFailed  Если количество повторных попыток исчерпано
+        '''
+
+        attempt, delay = self._nextRetry(addr, attempt)
+        # Ожидаем, пока загрузчик завершит обработку ошибочного кадра, и отбрасываем его ответ
+        if delay:
+            time.sleep(delay)
+        self.serial.flushInput()
+
+        return attempt
+
+    def _transmitFrame(self, frame):
+        '''
+        Отправляет подготовленный кадр в МК
+
+        @param self    Ссылка на экземпляр класса
+        @param frame   Кадр (адрес, длина, данные, контрольная сумма) [string]
+        '''
+
         # Сбрасываем буфер чтения
         self.serial.flushInput()
-        # Разделяем адрес на старший/младший байты
-        addr_high = (addr / 256) & 255
-        addr_low = (addr & 255)
-        # Длина записываемого блока
-        data_len = len(data)
-
-        # Начало расчета контрольной суммы
-        checksum = addr_high + addr_low + data_len
-        # Используется PIC16?
-        if self._family in ("16F8XX", "16F8X"):
-            # Отправляем последовательность, состоящую из старшего байта адреса, младшего байта адреса и длины записываемого блока
-            self.serial.write(chr(addr_high) + chr(addr_low) + chr(data_len))
-        # Используется PIC18?
-        elif self._family == "18F":
-            # the pic receives 3 byte memory address
-            # U TBLPTRH TBLPTRL
-            # TODO: Check if U can be different to 0
-            # Адрес у PIC18F трехбайтный, отправляем последовательность, состоящую из 0, старшего байта адреса, младшего байта адреса и длины записываемого блока
-            self.serial.write(chr(0) + chr(addr_high) + chr(addr_low) + chr(data_len))
-
-        # Отправка данных
-        for i in xrange(0, data_len):
-            # Продолжаем расчет контрольной суммы
-            checksum = checksum + data[i]
-            # Отправляем байт данных
-            self.serial.write(chr(data[i]))
-        # Окончание расчета контрольной суммы
-        checksum = ((-checksum) & 255)
-        # Отправляем контрольную сумму
-        self.serial.write(chr(checksum))
+        # Отправляем кадр одной операцией записи
+        self.serial.write(frame)
+
+    def _waitAck(self, addr):
+        '''
+        Ожидает от загрузчика подтверждения записи блока данных
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес блока (используется в сообщениях) [int]
+        @raise FlashWriteFailed  В случае, если от загрузчика не получено подтверждение успешной записи блока данных
+        '''
 
         # Считываем ответ от загрузчика
         ret = self.serial.read(1)
         # Подтверждение успешной записи не получено?
         if ret != "K":
-            # Используется PIC16?
-            if self._family in ("16F8XX", "16F8X"):
-                logger.error("Error writing memory block starting from position {0:#06X}".format(addr))
+            logger.warning("Error writing memory block starting from position {0:#06X} (reply {1})".format(addr, repr(ret)))
             raise FlashWriteFailed()
 
     def _reportProgress(self, percentage):
@@ -266,6 +646,9 @@ class bootloader(object):
 
         logger.debug("Flashing progress is {:d}%".format(percentage))
 
+        if self._progress_callback:
+            self._progress_callback(percentage)
+
         # Имя файла для сохранения процента выполнения задано?
         if self._progress_info_filename:
             try:
@@ -280,73 +663,64 @@ class bootloader(object):
 
         @param self    Ссылка на экземпляр класса
         @param firmware_filename  Имя файла с прошивкой
-        @return Загруженные данные в виде {адрес:значение} [dict]
+        @return Образ ПЗУ МК [FlashImage]
         @raise FirmwareReadFailed  Если не удалось прочитать hex-файл
-        @raise FirmwareWrongFormat Если не формат записи в файле неверный
+        @raise FirmwareWrongFormat Если формат записи в файле неверный или не совпадает контрольная сумма записи
         '''
 
-        result = {}
+        return self._decodeHex(self._readFirmware(firmware_filename).splitlines(), firmware_filename)
+
+    def _readFirmware(self, firmware_filename):
+        '''
+        Читает содержимое файла прошивки
+
+        @param self    Ссылка на экземпляр класса
+        @param firmware_filename  Имя файла с прошивкой
+        @return Содержимое файла [string]
+        @raise FirmwareReadFailed  Если не удалось прочитать файл
+        '''
 
         logger.info("Loading firmware from file '{}'...".format(firmware_filename))
 
         # Читаем указанный файл
         try:
             with open(firmware_filename, 'rb') as f:
-                hexfile = f.readlines()
+                content = f.read()
         except:
             logger.error("Failed to open firmware file {}".format(firmware_filename))
             raise FirmwareReadFailed
 
-        def isFlashData(record):
-            '''
-            Анализирует запись из hex-файла и возвращает признак того, что она содержит данные ПЗУ
-            @param record  Запись (строка) hex-файла [string]
-            @raise FirmwareWrongFormat  Если формат записи не верный
-            '''
-
-            # Некорректное начало записи в hex-файле?
-            if record[0] not in (':', ';'):
-                raise FirmwareWrongFormat
+        self.firmware_hash = hashlib.sha1(content).hexdigest()
+        return content
 
-            # Тип записи
-            record_type = eval("0x" + rec[7:9])
+    def _newImage(self):
+        '''
+        Создает пустой образ ПЗУ МК
 
-            # Запись содержит данные конфигурации?
-            if record[0:15] == ':020000040030CA':
-                logger.warning("Config data found, skipping")
-                return False
-            # Запись содержит данные EEPROM?
-            elif record[0:15] == ':0200000400F00A':
-                logger.warning("EEPROM data found, skipping")
-                return False
-            elif record_type != 0:
-                logger.warning("Record of type {:#04x}, skipping".format(record_type))
-                return False
+        @param self    Ссылка на экземпляр класса
+        @return Образ ПЗУ МК [FlashImage]
+        '''
 
-            return True
+        if self._device:
+            return FlashImage(self._device.flash_size, self._device.row_size)
+        return FlashImage(self._DEFAULT_IMAGE_SIZE, self._DEFAULT_ROW_SIZE)
 
-        # Парсим hex-файл построчно
-        for rec in hexfile:
+    def _decodeHex(self, hexfile, firmware_filename):
+        '''
+        Разбирает строки hex-файла в образ ПЗУ МК
 
-            # Пропускаем записи, не содержащие данные ПЗУ
-            if not isFlashData(rec):
-                break
+        @param self    Ссылка на экземпляр класса
+        @param hexfile Строки hex-файла [iterable]
+        @param firmware_filename  Имя файла с прошивкой (используется в сообщениях)
+        @return Образ ПЗУ МК [FlashImage]
+        @raise FirmwareReadFailed  Если файл не содержит данных ПЗУ
+        @raise FirmwareWrongFormat Если формат записи в файле неверный или не совпадает контрольная сумма записи
+        '''
 
-            # Количество байт данных в записи
-            byte_count = eval("0x" + rec[1:3])
-            # Адрес, соответствующий первому байту данных в записи
-            address = eval("0x" + rec[3:7])
-            # Данные записи в текстовом виде начинаются с 10 символа (2 символа/байт)
-            text_data = rec[9:]
-
-            # Обрабатываем по 2 символа (т.е. побайтно)
-            for i in xrange(0, 2 * byte_count, 2):
-                # Извлекаем байт с преобразованием из текстового шестнадцатеричного значения в целое
-                data = eval("0x" + text_data[i:i + 2])
-                # Сохраняем команду в pic_mem
-                result[address] = data
-                # Инкрементируем адрес
-                address = address + 1
+        result = self._newImage()
+        # Разбираем файл целиком
+        for _ in self._decodeRecords(hexfile, firmware_filename, result):
+            pass
 
         # Ничего не загружено?
         if len(result) == 0:
@@ -355,187 +729,746 @@ class bootloader(object):
 
         return result
 
-    def bootload(self, firmware_filename):
+    def _decodeRecords(self, hexfile, firmware_filename, result):
+        '''
+        Разбирает строки hex-файла, записывая данные в образ ПЗУ МК по мере разбора
+
+        @param self    Ссылка на экземпляр класса
+        @param hexfile Строки hex-файла [iterable]
+        @param firmware_filename  Имя файла с прошивкой (используется в сообщениях)
+        @param result  Образ ПЗУ МК, в который записываются данные [FlashImage]
+        @return Генератор диапазонов адресов (начальный, конечный) записанных данных
+        @raise FirmwareWrongFormat Если формат записи в файле неверный или не совпадает контрольная сумма записи
+        '''
+
+        # Базовый адрес, заданный записью расширенного линейного (или сегментного) адреса
+        base_addr = 0
+        # Области, данные которых пропущены (предупреждение выводится один раз для каждой области)
+        skipped = set()
+
+        # Парсим hex-файл построчно
+        try:
+            for line_number, record_type, address, data in intelhex.iterRecords(hexfile):
+                # Запись содержит данные?
+                if record_type == intelhex.REC_DATA:
+                    address += base_addr
+                    region = self._addressRegion(address)
+                    # Данные за пределами ПЗУ (конфигурация, EEPROM) пропускаем
+                    if region != 'flash':
+                        if region not in skipped:
+                            skipped.add(region)
+                            if region:
+                                logger.warning("Data of {} region found at line {}, skipping".format(region, line_number))
+                            else:
+                                logger.warning("Data at address {:#x} (line {}) is beyond flash memory, skipping".format(
+                                  address, line_number))
+                        continue
+                    # Сохраняем данные записи; данные, выходящие за конец ПЗУ, отбрасываются
+                    if result.update(address, data):
+                        logger.warning("Data at line {} is beyond flash memory, skipping".format(line_number))
+                    yield address, address + len(data)
+                # Запись содержит расширенный линейный адрес (старшие 16 бит адреса)?
+                elif record_type == intelhex.REC_EXT_LINEAR_ADDR:
+                    if len(data) != 2:
+                        raise intelhex.HexRecordError(line_number, "extended linear address record must contain 2 bytes")
+                    base_addr = ((data[0] << 8) | data[1]) << 16
+                # Запись содержит расширенный сегментный адрес (сегмент, умножаемый на 16)?
+                elif record_type == intelhex.REC_EXT_SEGMENT_ADDR:
+                    if len(data) != 2:
+                        raise intelhex.HexRecordError(line_number, "extended segment address record must contain 2 bytes")
+                    base_addr = ((data[0] << 8) | data[1]) << 4
+                else:
+                    logger.warning("Record of type {:#04x} at line {}, skipping".format(record_type, line_number))
+        except intelhex.HexRecordError, e:
+            logger.error("Wrong format of firmware file {}: {}".format(firmware_filename, e))
+            raise FirmwareWrongFormat(str(e), initial_exc=e)
+
+    def _addressRegion(self, addr):
+        '''
+        Определяет область адресного пространства hex-файла, в которую попадает адрес
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес в hex-файле [int]
+        @return Имя области ('flash' -- ПЗУ программ) [string] или None
+        '''
+
+        if self._device:
+            return self._device.region(addr)
+        # Модель МК еще не определена: ПЗУ программ считаем размером с образ по умолчанию
+        return 'flash' if addr < self._DEFAULT_IMAGE_SIZE else None
+
+    @staticmethod
+    def _getResetVector(hex_data):
+        '''
+        Возвращает копию вектора сброса из полученных данных
+
+        @param  hex_data Образ ПЗУ МК [FlashImage]
+        @return Данные в виде {адрес:значение} [dict]
+        '''
+
+        result = {}
+        k = 0
+        # Цикл по первым 8 байтам
+        for i in xrange(0, 8, 2):
+            # Такой адрес присутствует в данных
+            if i in hex_data:
+                # Копируем
+                result[k] = hex_data[i]
+                result[k + 1] = hex_data[i + 1]
+                k += 2
+
+        return result
+
+    def _rewriteResetVector(self, hex_data):
+        '''
+        Заменяет в полученных данных исходный вектор сброса на переход в загрузчик (на команду, следующую
+        за перемещенным вектором сброса)
+
+        @param  self     Ссылка на экземпляр класса
+        @param  hex_data Образ ПЗУ МК [FlashImage]
+        '''
+
+        # Адрес входа в загрузчик, в словах (0x1fa0 для ПЗУ 8К слов)
+        entry = (self._relocatedVectorAddr() + self._device.vector_size) // 2
+        # movlw high(entry)
+        hex_data[0] = entry >> 8
+        hex_data[1] = 0x30
+        # movwf PCLATH
+        hex_data[2] = 0x8a
+        hex_data[3] = 0x00
+        # goto entry (младшие 11 бит адреса; старшие задаются PCLATH)
+        hex_data[4] = entry & 255
+        hex_data[5] = 0x28 | ((entry >> 8) & 0x07)
+
+    @staticmethod
+    def _checkResetVector(hex_data):
+        '''
+        Проверяет полученные данные на наличие в векторе сброса команды перехода и на необходимость дополнительной очистки PCLATH после перемещения вектора сброса
+
+        @param  hex_data Данные прошивки в виде {адрес:значение} [dict]
+        @return Признаки в виде (Bool,Bool)
+        '''
+
+        # Признак того, что команда перехода найдена
+        goto_found = False
+        # Признак того, что PCLATH не требует дополнительной инициализации
+        pclath = 0
+
+        # Цикл по первым 8 байтам
+        for i in xrange(0, 8, 2):
+            if hex_data.has_key(i):
+                # Преобразуем в 2х-байтное значение
+                code = hex_data[i + 1] * 0x100 + hex_data[i]
+                # Это команда goto?
+                if code & 0x3800 == 0x2800:
+                    goto_found = True
+                # Команда clrf PCLATH (обнуление)?
+                elif code == 0x018a:
+                    pclath = 2
+                # Команда bcf pclath,3 (сброс бита №3)?
+                elif code == 0x118a:
+                    pclath += 1
+                # Команда bcf pclath,4 (сброс бита №4)?
+                elif code == 0x120a:
+                    pclath = pclath + 1
+                # Команда movwf pclath ?
+                elif code == 0x008a:
+                    pclath = 2
+
+        return (goto_found, pclath != 2)
+
+    def _relocatedVectorAddr(self):
+        '''
+        Возвращает адрес перемещенного вектора сброса в hex-данных (в начале области загрузчика)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        return self._device.bootloaderAddr()
+
+    def rowAddress(self, row):
+        '''
+        Возвращает адрес в ПЗУ МК, соответствующий началу строки образа
+
+        @param self    Ссылка на экземпляр класса
+        @param row     Номер строки [int]
+        '''
+
+        addr = row * (self._device.row_size if self._device else self._DEFAULT_ROW_SIZE)
+        # Адрес в кадре записи задается в словах?
+        if not self._device or self._device.word_addressing:
+            addr //= 2
+        return addr
+
+    def _rowLimit(self):
+        '''
+        Возвращает количество строк образа, доступных для записи (за исключением кода загрузчика, но включая перемещенный вектор сброса)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        # Конечный адрес в hex-данных (перемещенный вектор сброса записывается вместе с прошивкой)
+        end_addr = self._relocatedVectorAddr() + self._device.vector_size
+        row_size = self._device.row_size
+        return (end_addr + row_size - 1) // row_size
+
+    def moveResetVector(self, hex_data):
+        '''
+        Заменяет в полученных данных исходный вектор сброса на переход в загрузчик, перемещая исходный вектор в область загрузчика
+
+        @param self      Ссылка на экземпляр класса
+        @param hex_data  Образ ПЗУ МК [FlashImage]
+        '''
+
+        # У PIC18F переход в загрузчик выполняется одной командой GOTO с абсолютным адресом
+        if self._family == "18F":
+            self._moveResetVector18F(hex_data)
+            return
+
+        # Сохраняем исходный вектор сброса
+        origResetVector = self._getResetVector(hex_data)
+        # Исходный вектор сброса заменяем на переход в загрузчик
+        self._rewriteResetVector(hex_data)
+        # Анализируем содержимое исходного вектора сброса
+        goto_found, pclath_need_init = self._checkResetVector(origResetVector)
+
+        # Команда GOTO не найдена?
+        if not goto_found:
+            logger.warning("GOTO not found in first 4 words! Check reset vector initialization in your program")
+        # Вектор сброса пустой или слишком длинный?
+        if len(origResetVector) == 0 or len(origResetVector) > 6:
+            logger.warning("Invalid reset vector. Check reset vector initialization in your program")
+
+        # Начало перемещенного вектора сброса в hex-данных
+        new_reset_addr = self._relocatedVectorAddr()
+
+        # Формируем вектор сброса, который будет выполнять загрузчик
+        # Требуется дополнительная инициализация PCLATH
+        if pclath_need_init:
+            logger.warning("PCLATH not fully initialised before goto")
+            # Добавляем команду обнуления PCLATH в начало вектора
+            hex_data[new_reset_addr + 0] = 0x8a
+            hex_data[new_reset_addr + 1] = 0x01
+            # Увеличиваем адрес на размер записанной команды
+            new_reset_addr += 2
+
+        # Копируем исходный вектор сброса
+        # Первая команда в исходном векторе сброса присутствует?
+        if origResetVector.has_key(0):
+            # Добавляем
+            hex_data[new_reset_addr + 0] = origResetVector[0]
+            hex_data[new_reset_addr + 1] = origResetVector[1]
+        # Вторая команда в исходном векторе сброса присутствует?
+        if origResetVector.has_key(2):
+            # Добавляем
+            hex_data[new_reset_addr + 2] = origResetVector[2]
+            hex_data[new_reset_addr + 3] = origResetVector[3]
+        # Третья команда в исходном векторе сброса присутствует?
+        if origResetVector.has_key(4):
+            # Добавляем
+            hex_data[new_reset_addr + 4] = origResetVector[4]
+            hex_data[new_reset_addr + 5] = origResetVector[5]
+
+        logger.info("Reset vector moved successfully")
+
+    def _moveResetVector18F(self, hex_data):
+        '''
+        Заменяет в полученных данных исходный вектор сброса PIC18F на переход в загрузчик, перемещая исходный вектор
+        (первые 4 слова) в начало области загрузчика
+
+        @param self      Ссылка на экземпляр класса
+        @param hex_data  Образ ПЗУ МК [FlashImage]
+        '''
+
+        vector_size = self._device.vector_size
+        new_reset_addr = self._relocatedVectorAddr()
+
+        # Старшие байты команд исходного вектора сброса
+        opcodes = [hex_data[i + 1] for i in xrange(0, vector_size, 2) if i + 1 in hex_data]
+        # Вектор сброса пустой?
+        if not opcodes:
+            logger.warning("Invalid reset vector. Check reset vector initialization in your program")
+        # Команда GOTO (0xEFxx) не найдена?
+        elif 0xEF not in opcodes:
+            logger.warning("GOTO not found in first 4 words! Check reset vector initialization in your program")
+        # Относительный переход (BRA, 0xD0xx-0xD7xx) после перемещения ведет по другому адресу
+        if any(opcode & 0xF8 == 0xD0 for opcode in opcodes):
+            logger.warning("BRA found in reset vector, it will jump to wrong address after relocation. Use GOTO instead")
+
+        # Копируем исходный вектор сброса
+        for i in xrange(vector_size):
+            if i in hex_data:
+                hex_data[new_reset_addr + i] = hex_data[i]
+
+        # Адрес входа в загрузчик (команда, следующая за перемещенным вектором сброса)
+        entry = new_reset_addr + vector_size
+        # goto entry: 0xEF00 | k[8:1], 0xF000 | k[20:9]
+        hex_data[0] = (entry >> 1) & 255
+        hex_data[1] = 0xEF
+        hex_data[2] = (entry >> 9) & 255
+        hex_data[3] = 0xF0 | ((entry >> 17) & 0x0F)
+
+        logger.info("Reset vector moved successfully")
+
+    def loadFirmware(self, firmware_filename, content=None):
+        '''
+        Загружает прошивку из указанного hex-файла и подготавливает образ к передаче в МК (перемещает вектор сброса).
+        Если задан кэш образов, подготовленный образ ищется в нем по содержимому файла и параметрам МК, и разбор файла не выполняется
+
+        @param self    Ссылка на экземпляр класса
+        @param firmware_filename  Имя файла с прошивкой
+        @param content Содержимое файла, если он уже прочитан (см. _readFirmware()) [string]
+        @return Образ ПЗУ МК [FlashImage]
+        @raise FirmwareReadFailed  Если не удалось прочитать hex-файл
+        @raise FirmwareWrongFormat Если формат записи в файле неверный
+        '''
+
+        if content is None:
+            content = self._readFirmware(firmware_filename)
+
+        # Кэш не используется?
+        if not self._firmware_cache:
+            pic_mem = self._decodeHex(content.splitlines(), firmware_filename)
+            self.moveResetVector(pic_mem)
+            return pic_mem
+
+        cache_key = self._firmware_cache.key(self.firmware_hash, self._family, self._max_flash,
+                                              self._device.row_size)
+        # Образ найден в кэше?
+        pic_mem = self._firmware_cache.get(cache_key)
+        if pic_mem is not None:
+            return pic_mem
+
+        try:
+            pic_mem = self._decodeHex(content.splitlines(), firmware_filename)
+            self.moveResetVector(pic_mem)
+        except:
+            self._firmware_cache.cancel(cache_key)
+            raise
+        self._firmware_cache.put(cache_key, pic_mem)
+
+        return pic_mem
+
+    def _imageRows(self, pic_mem, plan=None):
+        '''
+        Составляет перечень строк подготовленного образа, которые необходимо передать в МК
+
+        @param self     Ссылка на экземпляр класса
+        @param pic_mem  Образ ПЗУ МК [FlashImage]
+        @param plan     План загрузки, отбирающий строки [FlashPlan] или None (передаются все строки)
+        @return Строки в порядке передачи в виде кортежей (номер строки, процент выполнения после передачи строки) [list]
+        '''
+
+        return (plan or self._newPlan()).build(pic_mem, self._rowLimit())
+
+    def frameSize(self):
+        '''
+        Возвращает размер кадра записи строки: адрес, длина блока, данные строки и контрольная сумма
+
+        @param self    Ссылка на экземпляр класса
+        @return Размер кадра, байт [int]
+        '''
+
+        return self._device.address_bytes + self._device.row_size + 2
+
+    def _newPlan(self, chip_rows=None, skip_rows=None):
+        '''
+        Создает план загрузки прошивки в обнаруженный МК
+
+        @param self       Ссылка на экземпляр класса
+        @param chip_rows  Хэши строк ПЗУ по журналу устройства в виде {номер строки:хэш} [dict]
+        @param skip_rows  Хэши строк, которые не требуется передавать, в виде {номер строки:хэш} [dict]
+        @return План загрузки [FlashPlan]
+        '''
+
+        return FlashPlan(self.frameSize(), chip_rows, skip_rows,
+                         erasedRowHashes(self._device.row_size, self._device.word_mask))
+
+    def _streamRows(self, hexfile, firmware_filename, pic_mem, file_size):
+        '''
+        Разбирает строки hex-файла и возвращает строки образа, как только они заполнены, не дожидаясь окончания разбора.
+        Строка считается заполненной, когда разбор перешел к записям с большими адресами. Строка с вектором сброса
+        и строка с перемещенным вектором сброса возвращаются после окончания разбора (после перемещения вектора сброса),
+        так же как и строки, данные которых встретились в файле повторно после передачи
+
+        @param self       Ссылка на экземпляр класса
+        @param hexfile    Строки hex-файла [iterable]
+        @param firmware_filename  Имя файла с прошивкой (используется в сообщениях)
+        @param pic_mem    Образ ПЗУ МК, заполняемый при разборе [FlashImage]
+        @param file_size  Размер hex-файла (используется для расчета процента выполнения) [int]
+        @return Генератор кортежей (номер строки, процент выполнения после передачи строки)
+        @raise FirmwareReadFailed  Если файл не содержит данных ПЗУ
+        @raise FirmwareWrongFormat Если формат записи в файле неверный
+        '''
+
+        # Количество прочитанных байт hex-файла
+        bytes_read = [0]
+
+        def countedLines():
+            '''
+            Перебирает строки hex-файла, подсчитывая количество прочитанных байт
+            '''
+
+            for line in hexfile:
+                bytes_read[0] += len(line)
+                yield line
+
+        row_size = pic_mem.row_size
+        # Количество строк, доступных для записи
+        row_limit = self._rowLimit()
+        # Строки, передача которых откладывается до перемещения вектора сброса
+        deferred = set((0, self._relocatedVectorAddr() // row_size))
+        # Строки, в которые записаны данные, но которые еще не переданы
+        pending = set()
+        # Переданные строки
+        sent = set()
+        # Переданные строки, данные которых изменились после передачи
+        resend = set()
+
+        for start, end in self._decodeRecords(countedLines(), firmware_filename, pic_mem):
+            first_row = start // row_size
+            for row in xrange(first_row, (end - 1) // row_size + 1):
+                if row in sent:
+                    resend.add(row)
+                else:
+                    pending.add(row)
+
+            # Строки с меньшими адресами считаем заполненными
+            for row in sorted(r for r in pending if r < first_row):
+                pending.discard(row)
+                if row in deferred or row >= row_limit:
+                    continue
+                sent.add(row)
+                yield row, min(99, 100 * bytes_read[0] // max(file_size, 1))
+
+        # Ничего не загружено?
+        if len(pic_mem) == 0:
+            logger.error("No data found in file {}".format(firmware_filename))
+            raise FirmwareReadFailed
+
+        if resend:
+            logger.warning("HEX records are not in ascending address order, {} row(s) will be written again".format(len(resend)))
+
+        # Перемещаем вектор сброса и передаем оставшиеся строки
+        self.moveResetVector(pic_mem)
+        remaining = sorted(row for row in (pending | resend | deferred) if row < row_limit and pic_mem.rowCount(row))
+        for i, row in enumerate(remaining, 1):
+            yield row, 99 + i // len(remaining)
+
+    def _sendRows(self, pic_mem, rows):
+        '''
+        Передает в МК указанные строки образа
+
+        @param self       Ссылка на экземпляр класса
+        @param pic_mem    Образ ПЗУ МК [FlashImage]
+        @param rows       Строки для передачи в виде кортежей (номер строки, процент выполнения после передачи строки) [iterable]
+        '''
+
+        def buildFrame(row):
+            '''
+            Формирует кадр для передачи строки образа (незаполненные байты строки имеют значение 0xFF)
+            '''
+
+            addr = self.rowAddress(row)
+            return addr, self._buildFrame(addr, pic_mem.row(row))
+
+        stats = self.transfer_stats = TransferStats()
+        # Подтвержденная строка, информация о которой еще не сохранена, в виде (номер строки, данные, процент выполнения)
+        acked = None
+        started = last_ack = time.time()
+
+        self._stop_requested = False
+        self._transferring = True
+        try:
+            with self._readTimeout(self._ack_timeout):
+                # Кадры готовятся в отдельном потоке, пока МК записывает предыдущие
+                for row, addr, frame, percentage in FramePipeline(rows, buildFrame, self._PIPELINE_DEPTH):
+                    self._transmitFrame(frame)
+                    sent = time.time()
+                    stats.host_time += sent - last_ack
+                    # Сохраняем информацию о предыдущей строке, пока МК принимает и записывает текущую
+                    if acked:
+                        self._recordRow(*acked)
+                        acked = None
+                    # Ожидаем подтверждения; при ошибке повторяем отправку кадра
+                    attempt = 0
+                    while True:
+                        try:
+                            self._waitAck(addr)
+                            break
+                        except FlashWriteFailed:
+                            attempt = self._prepareRetry(addr, attempt)
+                            self._transmitFrame(frame)
+                    if attempt:
+                        stats.retried_rows += 1
+                    last_ack = time.time()
+                    stats.ack_wait += last_ack - sent
+                    self.metrics.observeAck(last_ack - sent)
+                    stats.rows += 1
+                    stats.bytes += len(frame)
+                    # Данные строки -- последние байты кадра перед контрольной суммой
+                    acked = (row, frame[-1 - pic_mem.row_size:-1], percentage)
+                    # Запрошена остановка? Текущая строка записана, прерываем загрузку
+                    if self._stop_requested:
+                        logger.warning("Flashing interrupted after row at {:#06x}".format(addr))
+                        raise FlashingInterrupted("Flashing interrupted")
+        finally:
+            self._transferring = False
+            if acked:
+                self._recordRow(*acked)
+            stats.elapsed = time.time() - started
+            stats.log()
+            self.metrics.addTransfer(stats)
+
+    def _recordRow(self, row, data, percentage):
+        '''
+        Сохраняет информацию о строке, запись которой подтверждена загрузчиком: процент выполнения и контрольную точку
+
+        @param self        Ссылка на экземпляр класса
+        @param row         Номер строки [int]
+        @param data        Переданные данные строки [string]
+        @param percentage  Процент выполнения после передачи строки [int]
+        '''
+
+        self._reportProgress(percentage)
+        if self._checkpoint:
+            self._checkpoint.update(row, rowHash(data))
+
+    def requestStop(self):
+        '''
+        Запрашивает остановку загрузки прошивки после подтверждения записи текущей строки (может вызываться из обработчика сигнала)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._stop_requested = True
+
+    def isTransferring(self):
+        '''
+        Возвращает признак того, что выполняется передача строк образа в МК
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        return self._transferring
+
+    def bootload(self, firmware_filename, stream=False, delta=False, resume=False):
         '''
         Выполняет загрузку прошивки из указанного файла на МК
 
         @param self					Ссылка на экземпляр класса
         @param firmware_filename	Имя файла с прошивкой
+        @param stream               Передавать строки образа в МК по мере разбора hex-файла [bool]
+        @param delta                Передавать только строки, отличающиеся от записанных в ПЗУ при последней загрузке (по журналу устройства) [bool]
+        @param resume               Продолжить прерванную загрузку той же прошивки с первой неподтвержденной строки (по контрольной точке) [bool]
+        @raise FlashingInterrupted  Если загрузка остановлена по запросу (см. requestStop())
         '''
 
-        def getResetVector(hex_data):
-            '''
-            Возвращает копию вектора сброса из полученных данных
+        chip_rows, skip_rows, content = self._beginFlashing(firmware_filename, delta, resume)
+        plan = self._newPlan(chip_rows, skip_rows)
 
-            @param  hex_data Данные прошивки в виде {адрес:значение} [dict]
-            @return Данные в виде {адрес:значение} [dict]
-            '''
+        # Потоковый режим?
+        if stream:
+            # Разбор файла и передача строк выполняются одновременно
+            with self.metrics.phase('stream'):
+                pic_mem = self._streamFirmware(firmware_filename, plan, content)
+        else:
+            # Загружаем прошивку и перемещаем вектор сброса
+            with self.metrics.phase('parse'):
+                pic_mem = self.loadFirmware(firmware_filename, content)
+            # Передаем строки образа по плану
+            with self.metrics.phase('transfer'):
+                self._sendRows(pic_mem, self._imageRows(pic_mem, plan))
 
-            result = {}
-            k = 0
-            # Цикл по первым 8 байтам
-            for i in xrange(0, 8, 2):
-                # Такой адрес присутствует в данных
-                if hex_data.has_key(i):
-                    # Копируем
-                    result[k] = hex_data[i]
-                    result[k + 1] = hex_data[i + 1]
-                    k += 2
+        self._completeFlashing(pic_mem, chip_rows, plan)
 
-            return result
+    def planFlashing(self, firmware_filename, delta=False, resume=False):
+        '''
+        Составляет план загрузки прошивки из указанного файла в обнаруженный (или заданный функцией selectPic()) МК,
+        не обращаясь к порту и не изменяя журнал устройства и контрольную точку
 
-        def rewriteResetVector(hex_data):
-            '''
-            Заменяет в полученных данных исходный вектор сброса на переход в загрузчик
+        @param self					Ссылка на экземпляр класса
+        @param firmware_filename	Имя файла с прошивкой
+        @param delta                Признак разностной загрузки [bool]
+        @param resume               Признак продолжения прерванной загрузки [bool]
+        @return Образ ПЗУ МК и план загрузки [tuple(FlashImage, FlashPlan)]
+        '''
 
-            @param  hex_data Данные прошивки в виде {адрес:значение} [dict]
-            '''
+        content = self._readFirmware(firmware_filename)
+        chip_rows, skip_rows, _ = self._flashingState(self.firmware_hash, delta, resume)
+        plan = self._newPlan(chip_rows, skip_rows)
+        pic_mem = self.loadFirmware(firmware_filename, content)
+        self._imageRows(pic_mem, plan)
+        return pic_mem, plan
 
-            # movlw 0x1f
-            hex_data[0] = 0x1f
-            hex_data[1] = 0x30
-            # movwf PCLATH
-            hex_data[2] = 0x8a
-            hex_data[3] = 0x00
-            # goto 0x7a0
-            hex_data[4] = 0xa0
-            hex_data[5] = 0x2F
-
-        def checkResetVector(hex_data):
-            '''
-            Проверяет полученные данные на наличие в векторе сброса команды перехода и на необходимость дополнительной очистки PCLATH после перемещения вектора сброса
+    def diffFirmware(self, old_filename, new_filename):
+        '''
+        Сравнивает построчно образы двух файлов прошивки, подготовленные к передаче в обнаруженный (или заданный
+        функцией selectPic()) МК
 
-            @param  hex_data Данные прошивки в виде {адрес:значение} [dict]
-            @return Признаки в виде (Bool,Bool)
-            '''
+        @param self          Ссылка на экземпляр класса
+        @param old_filename  Имя исходного файла прошивки [string]
+        @param new_filename  Имя нового файла прошивки [string]
+        @return Номера строк в виде (измененные, добавленные, удаленные, неизмененные) [tuple(list, list, list, list)]
+        @raise FirmwareReadFailed  Если не удалось прочитать hex-файл
+        @raise FirmwareWrongFormat Если формат записи в файле неверный
+        '''
 
-            # Признак того, что команда перехода найдена
-            goto_found = False
-            # Признак того, что PCLATH не требует дополнительной инициализации
-            pclath = 0
-
-            # Цикл по первым 8 байтам
-            for i in xrange(0, 8, 2):
-                if hex_data.has_key(i):
-                    # Преобразуем в 2х-байтное значение
-                    code = hex_data[i + 1] * 0x100 + hex_data[i]
-                    # Это команда goto?
-                    if code & 0x3800 == 0x2800:
-                        goto_found = True
-                    # Команда clrf PCLATH (обнуление)?
-                    elif code == 0x018a:
-                        pclath = 2
-                    # Команда bcf pclath,3 (сброс бита №3)?
-                    elif code == 0x118a:
-                        pclath += 1
-                    # Команда bcf pclath,4 (сброс бита №4)?
-                    elif code == 0x120a:
-                        pclath = pclath + 1
-                    # Команда movwf pclath ?
-                    elif code == 0x008a:
-                        pclath = 2
-
-            return (goto_found, pclath != 2)
-
-        def moveResetVector(hex_data):
-            '''
-            Заменяет в полученных данных исходный вектор сброса на переход в загрузчик
+        old_image = self.loadFirmware(old_filename)
+        new_image = self.loadFirmware(new_filename)
+        return diffImages(old_image, new_image, self._rowLimit())
 
-            @param  hex_data Данные прошивки в виде {адрес:значение} [dict]
-            '''
+    def _beginFlashing(self, firmware_filename, delta, resume):
+        '''
+        Подготавливает загрузку прошивки: определяет строки, которые не требуется передавать (по журналу устройства
+        и контрольной точке), делает журнал недействительным и создает новую контрольную точку. Контрольная точка
+        относится к содержимому файла прошивки, поэтому при ее использовании файл читается заранее, и прочитанное
+        содержимое передается для разбора (файл читается один раз)
+
+        @param self					Ссылка на экземпляр класса
+        @param firmware_filename	Имя файла с прошивкой
+        @param delta                Признак разностной загрузки [bool]
+        @param resume               Признак продолжения прерванной загрузки [bool]
+        @return Хэши строк ПЗУ по журналу, хэши строк, которые не требуется передавать, в виде {номер строки:хэш}
+                и содержимое файла прошивки, если оно прочитано (иначе None) [tuple(dict, dict, string)]
+        @raise FirmwareReadFailed  Если не удалось прочитать файл
+        '''
+
+        content = self._readFirmware(firmware_filename) if self._checkpoint else None
+        firmware_hash = self.firmware_hash if self._checkpoint else None
+        chip_rows, skip_rows, acked_rows = self._flashingState(firmware_hash, delta, resume)
+
+        # Содержимое ПЗУ будет изменено -- журнал становится недействительным до окончания загрузки
+        if self._ledger:
+            self._ledger.invalidate()
+        # Начинаем новую контрольную точку (с подтвержденными ранее строками, если загрузка продолжается)
+        if self._checkpoint:
+            self._checkpoint.start(firmware_hash, self._type, self._max_flash, acked_rows)
+
+        return chip_rows, skip_rows, content
+
+    def _flashingState(self, firmware_hash, delta, resume):
+        '''
+        Определяет содержимое ПЗУ устройства по журналу и строки, которые не требуется передавать (по журналу
+        устройства и контрольной точке), не изменяя их
+
+        @param self           Ссылка на экземпляр класса
+        @param firmware_hash  Хэш содержимого файла прошивки (для поиска контрольной точки) [string]
+        @param delta          Признак разностной загрузки [bool]
+        @param resume         Признак продолжения прерванной загрузки [bool]
+        @return Хэши строк ПЗУ по журналу, хэши строк, которые не требуется передавать, и хэши строк, подтвержденных
+                при прерванной загрузке, в виде {номер строки:хэш} [tuple(dict, dict, dict)]
+        '''
+
+        # Содержимое ПЗУ устройства по журналу
+        chip_rows = self._ledger.load(self._type, self._max_flash) if self._ledger else {}
+        # Строки, которые не требуется передавать
+        skip_rows = {}
+        if delta:
+            if chip_rows:
+                skip_rows.update(chip_rows)
+            else:
+                logger.warning("No flash ledger found for the device, flashing all rows")
+
+        # Строки, запись которых подтверждена при прерванной загрузке той же прошивки
+        acked_rows = {}
+        if resume:
+            if self._checkpoint:
+                acked_rows = self._checkpoint.load(firmware_hash, self._type, self._max_flash)
+                if acked_rows:
+                    logger.info("Resuming flashing, {} row(s) already written".format(len(acked_rows)))
+                    skip_rows.update(acked_rows)
+                else:
+                    logger.warning("No checkpoint found for the firmware, flashing all rows")
+            else:
+                logger.warning("Checkpoints are not available, flashing all rows")
+
+        return chip_rows, skip_rows, acked_rows
+
+    def _completeFlashing(self, pic_mem, chip_rows, plan):
+        '''
+        Завершает загрузку прошивки: удаляет контрольную точку и сохраняет журнал устройства
+
+        @param self       Ссылка на экземпляр класса
+        @param pic_mem    Загруженный образ ПЗУ МК [FlashImage]
+        @param chip_rows  Хэши строк ПЗУ по журналу до начала загрузки, в виде {номер строки:хэш} [dict]
+        @param plan       Выполненный план загрузки [FlashPlan]
+        '''
+
+        plan.log()
+        # Часть строк не передавалась -- последняя переданная строка могла не завершить загрузку
+        if plan.skipped or plan.elided:
+            self._reportProgress(100)
+        # Загрузка завершена -- контрольная точка больше не нужна
+        if self._checkpoint:
+            self._checkpoint.clear()
+
+        # Сохраняем журнал устройства: строки, не затронутые прошивкой, сохраняют прежнее содержимое
+        if self._ledger:
+            chip_rows.update(imageRowHashes(pic_mem, self._rowLimit()))
+            self._ledger.save(self._type, self._max_flash, chip_rows, self.firmware_hash)
+
+    def _hashedLines(self, f):
+        '''
+        Перебирает строки файла прошивки, вычисляя хэш его содержимого
+
+        @param self    Ссылка на экземпляр класса
+        @param f       Файл прошивки [file]
+        @return Генератор строк файла
+        '''
+
+        sha1 = hashlib.sha1()
+        for line in f:
+            sha1.update(line)
+            yield line
+        self.firmware_hash = sha1.hexdigest()
+
+    def _streamFirmware(self, firmware_filename, plan, content=None):
+        '''
+        Выполняет загрузку прошивки на МК в потоковом режиме: строки образа передаются по мере разбора hex-файла.
+        Если подготовленный образ найден в кэше, он передается целиком
+
+        @param self					Ссылка на экземпляр класса
+        @param firmware_filename	Имя файла с прошивкой
+        @param plan                 План загрузки, отбирающий передаваемые строки [FlashPlan]
+        @param content              Содержимое файла, если он уже прочитан (см. _readFirmware()) [string]
+        @return Образ ПЗУ МК [FlashImage]
+        '''
 
-            # Сохраняем исходный вектор сброса
-            origResetVector = getResetVector(hex_data)
-            # Исходный вектор сброса заменяем на переход в загрузчик
-            rewriteResetVector(hex_data)
-            # Анализируем содержимое исходного вектора сброса
-            goto_found, pclath_need_init = checkResetVector(origResetVector)
-
-            # Команда GOTO не найдена?
-            if not goto_found:
-                logger.warning("GOTO not found in first 4 words! Check reset vector initialization in your program")
-            # Вектор сброса пустой или слишком длинный?
-            if len(origResetVector) == 0 or len(origResetVector) > 6:
-                logger.warning("Invalid reset vector. Check reset vector initialization in your program")
-
-            # Начало перемещенного вектора сброса в hex-данных
-            new_reset_addr = 2 * self._max_flash - 200
-
-            # Формируем вектор сброса, который будет выполнять загрузчик
-            # Требуется дополнительная инициализация PCLATH
-            if pclath_need_init:
-                logger.warning("PCLATH not fully initialised before goto")
-                # Добавляем команду обнуления PCLATH в начало вектора
-                hex_data[new_reset_addr + 0] = 0x8a
-                hex_data[new_reset_addr + 1] = 0x01
-                # Увеличиваем адрес на размер записанной команды
-                new_reset_addr += 2
-
-            # Копируем исходный вектор сброса
-            # Первая команда в исходном векторе сброса присутствует?
-            if origResetVector.has_key(0):
-                # Добавляем
-                hex_data[new_reset_addr + 0] = origResetVector[0]
-                hex_data[new_reset_addr + 1] = origResetVector[1]
-            # Вторая команда в исходном векторе сброса присутствует?
-            if origResetVector.has_key(2):
-                # Добавляем
-                hex_data[new_reset_addr + 2] = origResetVector[2]
-                hex_data[new_reset_addr + 3] = origResetVector[3]
-            # Третья команда в исходном векторе сброса присутствует?
-            if origResetVector.has_key(4):
-                # Добавляем
-                hex_data[new_reset_addr + 4] = origResetVector[4]
-                hex_data[new_reset_addr + 5] = origResetVector[5]
-
-            logger.info("Reset vector moved successfully")
-
-        # Загружаем данные из log-файла
-        pic_mem = self.loadHex(firmware_filename)
-        # Перемещаем вектор сброса в данных
-        moveResetVector(pic_mem)
-
-        # Настройки для семейства 16F8XX:
-        pic_block_size = 0x20  # Размер блока для записи (в словах)
-        hex_block_size = 2 * \
-            pic_block_size  # Размер блока для записи (в байтах)
-
-        # Начальный и конечный адреса в ПЗУ МК (за исключением кода загрузчика, но включая перемещенный вектор сброса)
-        start_pic_addr = 0
-        end_pic_addr = self._max_flash - 100 + 4
-
-        # Общее количество байт в прошивке
-        bytes_total = len(pic_mem)
-        # Количество байт в прошивке, переданных в МК
-        bytes_sent = 0
-        # Адрес обрабатываемого байта в hex-данных
-        hex_pos = 0
-
-        # Перебираем адреса ПЗУ поблочно
-        for pic_pos in range(start_pic_addr, end_pic_addr, pic_block_size):
-
-            # Данные для передачи на МК (массив длиной hex_block_size байт)
-            mem_block = [0xFF] * hex_block_size
-            # Признак того, что необходимо передавать данный блок данных в МК
-            write_block = False
-
-            # Перебираем адреса hex-данных, соответствующие байтам из текущего блока
-            for j in range(0, hex_block_size):
-                # Рассчитываем адрес j-го байта в текущем блоке
-                hex_pos = 2 * pic_pos + j
-                # Байт с таким адресом присутствует в hex-данных?
-                if pic_mem.has_key(hex_pos):
-                    # Копируем его в данные для передачи на МК
-                    mem_block[j] = pic_mem[hex_pos]
-                    # Устанавливаем признак необходимости передачи текущего блока
-                    write_block = True
-                    bytes_sent += 1
-
-            # Нужно передавать текущий блок в МК?
-            if write_block:
-                # Передаем
-                self._write_mem(pic_pos, mem_block)
-                # Выводим информацию о прогрессе выполнения
-                percentage = int(float(bytes_sent) / bytes_total * 100)
-                self._reportProgress(percentage)
+        pic_mem = self._newImage()
 
+        # Кэш не используется и файл еще не прочитан -- читаем файл построчно
+        if not self._firmware_cache and content is None:
+            logger.info("Streaming firmware from file '{}'...".format(firmware_filename))
+            try:
+                f = open(firmware_filename, 'rb')
+                file_size = os.fstat(f.fileno()).st_size
+            except:
+                logger.error("Failed to open firmware file {}".format(firmware_filename))
+                raise FirmwareReadFailed
+            with f:
+                self._sendRows(pic_mem, plan.select(pic_mem, self._streamRows(self._hashedLines(f), firmware_filename, pic_mem, file_size)))
+            return pic_mem
+
+        # Для поиска в кэше необходимо содержимое файла целиком
+        if content is None:
+            content = self._readFirmware(firmware_filename)
+        # Файл прочитан заранее (для контрольной точки), кэш не используется
+        if not self._firmware_cache:
+            self._sendRows(pic_mem, plan.select(pic_mem, self._streamRows(content.splitlines(), firmware_filename, pic_mem, len(content))))
+            return pic_mem
+
+        cache_key = self._firmware_cache.key(self.firmware_hash, self._family, self._max_flash,
+                                              self._device.row_size)
+        cached = self._firmware_cache.get(cache_key)
+        if cached is not None:
+            self._sendRows(cached, self._imageRows(cached, plan))
+            return cached
+
+        try:
+            self._sendRows(pic_mem, plan.select(pic_mem, self._streamRows(content.splitlines(), firmware_filename, pic_mem, len(content))))
+        except:
+            self._firmware_cache.cancel(cache_key)
+            raise
+        self._firmware_cache.put(cache_key, pic_mem)
+        return pic_mem
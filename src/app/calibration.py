@@ -0,0 +1,94 @@
+# coding: utf-8
+'''
+@package app.calibration
+Bootloader для микроконтроллеров PIC: подбор скорости порта, на которой отвечает загрузчик устройства,
+и ее хранение между запусками
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import os
+import time
+from lib.statefile import safeName, loadState, saveState
+from bootloader import PicNotDetected
+
+
+class LinkCalibration(object):
+
+    '''
+    Результат подбора скорости порта устройства: выбранная скорость и задержка ответа загрузчика на каждой
+    из проверенных скоростей. Хранится в отдельном файле для каждого устройства
+    '''
+
+    def __init__(self, directory, device_id):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param directory  Каталог для хранения состояния устройств [string]
+        @param device_id  Идентификатор устройства (имя порта или заданный в настройках идентификатор) [string]
+        '''
+
+        self._device_id = device_id
+        self._filename = os.path.join(directory, 'link', safeName(device_id) + '.json')
+
+    def baud(self):
+        '''
+        Возвращает скорость, выбранную при последнем подборе
+
+        @param self    Ссылка на экземпляр класса
+        @return Скорость порта [int] или None, если подбор не выполнялся
+        '''
+
+        return loadState(self._filename, {}).get('baud')
+
+    def save(self, baud, results):
+        '''
+        Сохраняет результат подбора
+
+        @param self     Ссылка на экземпляр класса
+        @param baud     Выбранная скорость [int]
+        @param results  Результаты проверки скоростей в виде кортежей (скорость, задержка ответа, с или None) [list]
+        '''
+
+        if saveState(self._filename, {
+            'baud': baud,
+            'timestamp': time.time(),
+            'results': [{'baud': rate, 'rtt': rtt} for rate, rtt in results],
+        }):
+            logger.info("Baud rate {} saved for device '{}'".format(baud, self._device_id))
+
+
+def calibrateLink(loader, bauds, detect):
+    '''
+    Подбирает скорость порта: проверяет скорости, начиная с наибольшей, до первой, на которой загрузчик отвечает
+    на запрос определения типа МК
+
+    @param loader  Объект bootloader с открытым портом [bootloader]
+    @param bauds   Проверяемые скорости [list]
+    @param detect  Функция перевода МК в режим загрузчика и определения его типа на текущей скорости [callable()]
+    @return Выбранная скорость (None, если загрузчик не ответил ни на одной) и результаты проверки в виде кортежей
+            (скорость, задержка ответа, с или None) [tuple(int, list)]
+    '''
+
+    results = []
+    for baud in sorted(set(bauds), reverse=True):
+        loader.setBaud(baud)
+        loader.probe_rtt = None
+        try:
+            detect()
+        except PicNotDetected:
+            logger.info("No reply from bootloader at {} baud".format(baud))
+            results.append((baud, None))
+            continue
+        logger.info("Bootloader replied at {} baud in {:.1f} ms".format(baud, loader.probe_rtt * 1000))
+        results.append((baud, loader.probe_rtt))
+        return baud, results
+
+    return None, results
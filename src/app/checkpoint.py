@@ -0,0 +1,169 @@
+# coding: utf-8
+'''
+@package app.checkpoint
+Bootloader для микроконтроллеров PIC: контрольная точка загрузки прошивки для продолжения прерванной загрузки
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import json
+import os
+import sys
+from lib.statefile import safeName, removeState, syncDirectory
+
+
+class FlashCheckpoint(object):
+
+    '''
+    Контрольная точка загрузки прошивки: перечень строк образа, запись которых подтверждена загрузчиком, с хэшами их содержимого.
+    Хранится в отдельном файле для каждого устройства. Первая строка файла -- заголовок в формате JSON (хэш прошивки, тип МК),
+    далее -- по одной строке "номер_строки хэш" на каждую подтвержденную строку образа. Строки дописываются в конец файла,
+    поэтому при аварийном завершении может быть потеряна только последняя (неполная) строка, которая игнорируется при чтении.
+    Файл сбрасывается на диск после каждых SYNC_INTERVAL строк: при отключении питания теряются не более SYNC_INTERVAL
+    последних подтвержденных строк, которые при продолжении загрузки будут переданы повторно
+    '''
+
+    ## Количество подтвержденных строк, после записи которых файл сбрасывается на диск (fsync)
+    SYNC_INTERVAL = 16
+
+    def __init__(self, directory, device_id):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param directory  Каталог для хранения контрольных точек [string]
+        @param device_id  Идентификатор устройства (имя порта или заданный в настройках идентификатор) [string]
+        '''
+
+        self._device_id = device_id
+        self._filename = os.path.join(directory, 'checkpoint', safeName(device_id) + '.log')
+        # Файл, открытый для дописывания подтвержденных строк
+        self._file = None
+        # Количество строк, записанных после последнего сброса файла на диск
+        self._unsynced = 0
+
+    def load(self, firmware_hash, pic_type, max_flash):
+        '''
+        Загружает перечень подтвержденных строк для указанной прошивки
+
+        @param self           Ссылка на экземпляр класса
+        @param firmware_hash  Хэш загружаемого hex-файла [string]
+        @param pic_type       Тип МК [string]
+        @param max_flash      Максимальный адрес ПЗУ МК [int]
+        @return Хэши подтвержденных строк в виде {номер строки:хэш} [dict]; пустой, если контрольная точка относится к другой прошивке
+        '''
+
+        rows = {}
+        try:
+            with open(self._filename, 'rb') as f:
+                header = json.loads(f.readline())
+                if header != {'firmware': firmware_hash, 'type': pic_type, 'max_flash': max_flash}:
+                    logger.warning("Checkpoint of device '{}' belongs to another firmware or PIC type, ignoring".format(self._device_id))
+                    return {}
+                for line in f:
+                    fields = line.split()
+                    # Неполная последняя строка (запись была прервана)?
+                    if len(fields) != 2 or not line.endswith('\n'):
+                        break
+                    rows[int(fields[0])] = fields[1]
+        except IOError:
+            return {}
+        except ValueError:
+            logger.warning("Checkpoint of device '{}' is corrupted, ignoring".format(self._device_id))
+            return {}
+
+        return rows
+
+    def start(self, firmware_hash, pic_type, max_flash, rows=None):
+        '''
+        Создает новую контрольную точку (атомарно заменяя прежнюю) и открывает ее для записи подтвержденных строк
+
+        @param self           Ссылка на экземпляр класса
+        @param firmware_hash  Хэш загружаемого hex-файла [string]
+        @param pic_type       Тип МК [string]
+        @param max_flash      Максимальный адрес ПЗУ МК [int]
+        @param rows           Хэши уже подтвержденных строк в виде {номер строки:хэш} (при продолжении загрузки) [dict]
+        '''
+
+        self.close()
+        directory = os.path.dirname(self._filename)
+        tmp_filename = self._filename + '.tmp'
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_filename, 'wb') as f:
+                f.write(json.dumps({'firmware': firmware_hash, 'type': pic_type, 'max_flash': max_flash}) + '\n')
+                for row, value in sorted((rows or {}).iteritems()):
+                    f.write("{} {}\n".format(row, value))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_filename, self._filename)
+            syncDirectory(directory)
+            self._file = open(self._filename, 'ab', 0)
+            self._unsynced = 0
+        except (IOError, OSError):
+            logger.warning("Failed to create checkpoint '{}' due to {} exception ({})".format(self._filename, *sys.exc_info()[:2]))
+
+    def update(self, row, value):
+        '''
+        Добавляет в контрольную точку строку образа, запись которой подтверждена загрузчиком
+
+        @param self   Ссылка на экземпляр класса
+        @param row    Номер строки [int]
+        @param value  Хэш содержимого строки [string]
+        '''
+
+        if self._file:
+            try:
+                self._file.write("{} {}\n".format(row, value))
+                self._unsynced += 1
+                if self._unsynced >= self.SYNC_INTERVAL:
+                    self._sync()
+            except (IOError, OSError):
+                logger.warning("Failed to update checkpoint '{}'".format(self._filename))
+                self.close()
+
+    def _sync(self):
+        '''
+        Сбрасывает записанные строки на диск
+
+        @param self   Ссылка на экземпляр класса
+        @raise OSError  Если не удалось сбросить файл на диск
+        '''
+
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        '''
+        Закрывает файл контрольной точки
+
+        @param self   Ссылка на экземпляр класса
+        '''
+
+        if self._file:
+            try:
+                if self._unsynced:
+                    self._sync()
+            except OSError:
+                logger.warning("Failed to sync checkpoint '{}'".format(self._filename))
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        '''
+        Удаляет контрольную точку (после успешного завершения загрузки)
+
+        @param self   Ссылка на экземпляр класса
+        '''
+
+        # Файл удаляется -- сбрасывать его на диск не требуется
+        self._unsynced = 0
+        self.close()
+        removeState(self._filename)
@@ -0,0 +1,499 @@
+# coding: utf-8
+'''
+@package app.daemon
+Bootloader для микроконтроллеров PIC: сервер загрузки прошивки, принимающий задания через локальный unix-сокет
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import errno
+import itertools
+import json
+import os
+import socket
+import SocketServer
+import stat
+import threading
+import time
+from Queue import Queue
+from lib.myexception import MyException
+
+
+class DaemonException(MyException):
+
+    '''
+    Класс исключений для модуля
+    '''
+
+    pass
+
+
+class DaemonAlreadyRunning(DaemonException):
+
+    '''
+    Класс исключений для ситуации, когда сокет уже используется другим экземпляром сервера
+    '''
+
+    pass
+
+
+class DaemonNotRunning(DaemonException):
+
+    '''
+    Класс исключений для ситуации, когда не удалось подключиться к серверу
+    '''
+
+    pass
+
+
+class FlashJob(object):
+
+    '''
+    Задание на загрузку прошивки в устройство, подключенное к определенному порту.
+    События выполнения задания (постановка в очередь, начало, прогресс, завершение) помещаются в очередь,
+    из которой их читает обработчик соединения клиента, поставившего задание
+    '''
+
+    ## Генератор идентификаторов заданий
+    _ids = itertools.count(1)
+
+    def __init__(self, port, firmware, delta=False, resume=False):
+        '''
+        Конструктор
+
+        @param self      Ссылка на экземпляр класса
+        @param port      Имя порта [string]
+        @param firmware  Имя файла прошивки [string]
+        @param delta     Признак разностной загрузки [bool]
+        @param resume    Признак продолжения прерванной загрузки [bool]
+        '''
+
+        self.id = next(self._ids)
+        self.port = port
+        self.firmware = firmware
+        self.delta = delta
+        self.resume = resume
+        ## Состояние задания: queued, running, finished
+        self.state = 'queued'
+        ## Процент выполнения
+        self.percentage = 0
+        self._events = Queue()
+
+    def notify(self, event, **fields):
+        '''
+        Добавляет событие выполнения задания
+
+        @param self    Ссылка на экземпляр класса
+        @param event   Тип события [string]
+        @param fields  Дополнительные поля события
+        '''
+
+        fields.update(event=event, job=self.id, port=self.port)
+        self._events.put(fields)
+
+    def events(self):
+        '''
+        Перебирает события выполнения задания, ожидая их появления, до события завершения включительно
+
+        @param self    Ссылка на экземпляр класса
+        @return Генератор событий [dict]
+        '''
+
+        while True:
+            event = self._events.get()
+            yield event
+            if event['event'] == 'finished':
+                return
+
+    def describe(self):
+        '''
+        Возвращает описание задания
+
+        @param self    Ссылка на экземпляр класса
+        @return Описание задания [dict]
+        '''
+
+        return {'job': self.id, 'port': self.port, 'firmware': self.firmware, 'state': self.state, 'percentage': self.percentage}
+
+
+class PortWorker(threading.Thread):
+
+    '''
+    Рабочий поток, обслуживающий один порт: выполняет задания из очереди порта по одному.
+    Порт открывается при запуске потока, объект bootloader (и открытый им порт) сохраняется между успешно выполненными
+    заданиями. Если порт открыть не удалось или при выполнении задания произошла ошибка, порт закрывается и открывается
+    заново при выполнении следующего задания
+    '''
+
+    def __init__(self, port, create_loader, run_job, describe_error):
+        '''
+        Конструктор
+
+        @param self           Ссылка на экземпляр класса
+        @param port           Имя порта [string]
+        @param create_loader  Функция создания объекта bootloader с открытым портом [callable() -> bootloader]
+        @param run_job        Функция выполнения задания [callable(loader, job)]
+        @param describe_error  Функция, возвращающая код завершения и сообщение по исключению [callable(exc) -> (int, string)]
+        '''
+
+        threading.Thread.__init__(self, name='PortWorker-{}'.format(port))
+        self.daemon = True
+        self.port = port
+        ## Объект bootloader, работающий с портом [bootloader]
+        self.loader = None
+        ## Выполняемое задание [FlashJob]
+        self.current = None
+        self._create_loader = create_loader
+        self._run_job = run_job
+        self._describe_error = describe_error
+        self._queue = Queue()
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        '''
+        Ставит задание в очередь порта
+
+        @param self    Ссылка на экземпляр класса
+        @param job     Задание [FlashJob]
+        '''
+
+        with self._lock:
+            self._pending.append(job)
+            job.notify('queued', position=len(self._pending) + (1 if self.current else 0))
+        self._queue.put(job)
+
+    def pending(self):
+        '''
+        Возвращает задания, ожидающие выполнения
+
+        @param self    Ссылка на экземпляр класса
+        @return Задания в порядке очереди [list]
+        '''
+
+        with self._lock:
+            return list(self._pending)
+
+    def stop(self):
+        '''
+        Завершает поток после выполнения текущего задания
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._queue.put(None)
+
+    def run(self):
+        '''
+        Функция рабочего потока
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        # Порт открывается заранее, чтобы первое задание не ожидало открытия и настройки порта
+        try:
+            self.loader = self._create_loader()
+        except Exception, e:
+            logger.warning("Failed to open port '{}' ({}), will retry on next job".format(self.port, self._describe_error(e)[1]))
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            with self._lock:
+                self._pending.remove(job)
+                self.current = job
+            try:
+                self._execute(job)
+            finally:
+                with self._lock:
+                    self.current = None
+
+        if self.loader:
+            self.loader.closeSerial()
+
+    def _execute(self, job):
+        '''
+        Выполняет задание и сообщает о результате
+
+        @param self    Ссылка на экземпляр класса
+        @param job     Задание [FlashJob]
+        '''
+
+        started = time.time()
+        job.state = 'running'
+        job.notify('started')
+        logger.info("Job {}: flashing '{}' via '{}'".format(job.id, job.firmware, self.port))
+
+        def progress(percentage):
+            if percentage != job.percentage:
+                job.percentage = percentage
+                job.notify('progress', percentage=percentage)
+
+        try:
+            if not self.loader:
+                self.loader = self._create_loader()
+            self.loader.setProgressCallback(progress)
+            try:
+                self._run_job(self.loader, job)
+            finally:
+                self.loader.setProgressCallback(None)
+        except Exception, e:
+            code, message = self._describe_error(e)
+            # Состояние порта после ошибки неизвестно (например, адаптер отключен) -- откроем его заново
+            if self.loader:
+                self.loader.closeSerial()
+                self.loader = None
+        else:
+            code, message = 0, "OK"
+
+        job.state = 'finished'
+        job.notify('finished', code=code, message=message, elapsed=round(time.time() - started, 3))
+        logger.info("Job {}: {} (code {})".format(job.id, message, code))
+
+
+class JobRequestHandler(SocketServer.StreamRequestHandler):
+
+    '''
+    Обработчик соединения клиента. Клиент передает запрос -- строку в формате JSON -- и получает ответы, также
+    по одному JSON-объекту в строке. Запрос {"command": "flash", "firmware": ..., "port": ..., "delta": ..., "resume": ...}
+    ставит задание в очередь порта; в ответ передаются события выполнения задания до события "finished" включительно.
+    Запрос {"command": "status"} возвращает состояние очередей всех портов
+    '''
+
+    def handle(self):
+        '''
+        Обрабатывает запрос клиента
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request.get('command')
+        except (ValueError, AttributeError):
+            self._reply({'event': 'error', 'message': 'malformed request'})
+            return
+
+        if command == 'flash':
+            try:
+                job = self.server.submit(request)
+            except DaemonException, e:
+                self._reply({'event': 'error', 'message': str(e)})
+                return
+            for event in job.events():
+                # Клиент отключился -- задание выполняется до конца без передачи событий
+                if not self._reply(event):
+                    break
+        elif command == 'status':
+            self._reply({'event': 'status', 'ports': self.server.status()})
+        else:
+            self._reply({'event': 'error', 'message': "unknown command '{}'".format(command)})
+
+    def _reply(self, message):
+        '''
+        Передает клиенту сообщение
+
+        @param self     Ссылка на экземпляр класса
+        @param message  Сообщение [dict]
+        @return Признак успешной передачи [bool]
+        '''
+
+        try:
+            self.wfile.write(json.dumps(message, sort_keys=True) + '\n')
+            self.wfile.flush()
+            return True
+        except socket.error:
+            return False
+
+
+class FlashDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    '''
+    Сервер загрузки прошивки: держит открытыми порты, для каждого из которых запущен рабочий поток с очередью заданий,
+    и принимает задания от клиентов через локальный unix-сокет. Задания могут передавать только владелец сервера
+    и члены его группы: каталог сокета должен принадлежать владельцу сервера и не быть доступным для записи другим
+    пользователям, иначе сокет мог бы быть подменен
+    '''
+
+    daemon_threads = True
+    ## Права доступа к создаваемому каталогу сокета
+    SOCKET_DIR_MODE = 0750
+    ## Права доступа к сокету
+    SOCKET_MODE = 0660
+    ## Максимальное время ожидания завершения рабочих потоков при остановке сервера, с
+    _STOP_TIMEOUT = 10
+
+    def __init__(self, socket_path, workers):
+        '''
+        Конструктор
+
+        @param self         Ссылка на экземпляр класса
+        @param socket_path  Имя файла unix-сокета [string]
+        @param workers      Рабочие потоки обслуживаемых портов [list of PortWorker]
+        @raise DaemonAlreadyRunning  Если сокет уже используется другим экземпляром сервера
+        @raise DaemonException       Если каталог сокета небезопасен или по пути сокета находится другой файл
+        '''
+
+        self.socket_path = socket_path
+        self._workers = dict((worker.port, worker) for worker in workers)
+        self._ports = [worker.port for worker in workers]
+
+        self._prepareDirectory(os.path.dirname(os.path.abspath(socket_path)))
+        self._removeStaleSocket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, JobRequestHandler)
+        # Права доступа к сокету не должны зависеть от umask
+        os.chmod(socket_path, self.SOCKET_MODE)
+
+    @classmethod
+    def _prepareDirectory(cls, directory):
+        '''
+        Создает каталог сокета с правами SOCKET_DIR_MODE или проверяет, что существующий каталог принадлежит текущему
+        пользователю и не доступен для записи группе и другим пользователям
+
+        @param directory  Имя каталога [string]
+        @raise DaemonException  Если каталог небезопасен
+        '''
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, cls.SOCKET_DIR_MODE)
+            # Права доступа не должны зависеть от umask
+            os.chmod(directory, cls.SOCKET_DIR_MODE)
+            return
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise DaemonException("Socket directory '{}' must be owned by the current user and not writable by others"
+                                  .format(directory))
+
+    @staticmethod
+    def _removeStaleSocket(socket_path):
+        '''
+        Удаляет файл сокета, оставшийся после аварийного завершения сервера
+
+        @param socket_path  Имя файла unix-сокета [string]
+        @raise DaemonAlreadyRunning  Если сокет используется другим экземпляром сервера
+        @raise DaemonException       Если по пути сокета находится другой файл
+        '''
+
+        if not os.path.lexists(socket_path):
+            return
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise DaemonException("'{}' exists and is not a socket".format(socket_path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+        else:
+            raise DaemonAlreadyRunning("Socket '{}' is in use".format(socket_path))
+        finally:
+            probe.close()
+
+    def serve(self):
+        '''
+        Запускает рабочие потоки портов и обрабатывает запросы клиентов до завершения приложения
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        for port in self._ports:
+            self._workers[port].start()
+        logger.info("Listening on '{}', serving ports {}".format(self.socket_path, ', '.join(self._ports)))
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            for port in self._ports:
+                self._workers[port].stop()
+            for port in self._ports:
+                self._workers[port].join(self._STOP_TIMEOUT)
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def loaders(self):
+        '''
+        Возвращает объекты bootloader, созданные рабочими потоками
+
+        @param self    Ссылка на экземпляр класса
+        @return Объекты bootloader [list]
+        '''
+
+        return [self._workers[port].loader for port in self._ports if self._workers[port].loader]
+
+    def submit(self, request):
+        '''
+        Создает задание по запросу клиента и ставит его в очередь порта
+
+        @param self     Ссылка на экземпляр класса
+        @param request  Запрос клиента [dict]
+        @return Задание [FlashJob]
+        @raise DaemonException  Если файл прошивки не задан или порт не обслуживается сервером
+        '''
+
+        firmware = request.get('firmware')
+        if not firmware:
+            raise DaemonException("no firmware file specified")
+        port = request.get('port')
+        # Порт не задан -- допустимо, только если сервер обслуживает единственный порт
+        if not port and len(self._ports) == 1:
+            port = self._ports[0]
+        if port not in self._workers:
+            raise DaemonException("port '{}' is not served".format(port))
+
+        job = FlashJob(port, firmware, delta=bool(request.get('delta')), resume=bool(request.get('resume')))
+        self._workers[port].submit(job)
+        return job
+
+    def status(self):
+        '''
+        Возвращает состояние очередей заданий всех портов
+
+        @param self    Ссылка на экземпляр класса
+        @return Состояние в виде {порт:{'current':задание, 'queued':[задания]}} [dict]
+        '''
+
+        result = {}
+        for port in self._ports:
+            worker = self._workers[port]
+            current = worker.current
+            result[port] = {
+              'current': current.describe() if current else None,
+              'queued': [job.describe() for job in worker.pending()],
+            }
+        return result
+
+
+def submitRequest(socket_path, request):
+    '''
+    Передает запрос серверу загрузки прошивки и перебирает полученные ответы
+
+    @param socket_path  Имя файла unix-сокета [string]
+    @param request      Запрос [dict]
+    @return Генератор ответов сервера [dict]
+    @raise DaemonNotRunning  Если не удалось подключиться к серверу
+    '''
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error, e:
+        client.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            raise DaemonNotRunning("No daemon is listening on '{}'".format(socket_path))
+        raise
+
+    try:
+        client.sendall(json.dumps(request) + '\n')
+        replies = client.makefile('rb')
+        for line in replies:
+            yield json.loads(line)
+    finally:
+        client.close()
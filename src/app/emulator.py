@@ -0,0 +1,295 @@
+# coding: utf-8
+'''
+@package app.emulator
+Bootloader для микроконтроллеров PIC: эмулятор МК с загрузчиком TinyBootloader на псевдотерминале (для тестов и измерений)
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import errno
+import os
+import select
+import termios
+import threading
+import time
+import tty
+from pictype import pic_device
+
+
+class TinyBootloaderEmulator(object):
+
+    '''
+    Эмулятор МК с загрузчиком TinyBootloader. Работает с парой псевдотерминалов (os.openpty()): bootloader открывает
+    подчиненный терминал как последовательный порт, эмулятор обслуживает главный. Эмулятор отвечает на запрос 0xC1
+    кодом модели МК, принимает кадры записи, проверяет их контрольную сумму и записывает данные в эмулируемое ПЗУ.
+    Если задана последовательность сброса, эмулятор начинает работу в режиме прикладной программы и переходит
+    в режим загрузчика после получения этой последовательности. Время передачи байт на заданной скорости порта
+    и время записи строки в ПЗУ моделируются задержками; данные, переданные на скорости, отличной от заданной,
+    искажаются и не обрабатываются
+    '''
+
+    ## Ответ загрузчика на успешно принятый кадр
+    _ACK = 'K'
+    ## Ответ загрузчика на кадр с неверной контрольной суммой
+    _NAK = 'N'
+    ## Период проверки запроса остановки, с
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, device_id=0x31, baud=None, row_latency=0.0, reset_seq=None, reply_seq=None):
+        '''
+        Конструктор
+
+        @param self         Ссылка на экземпляр класса
+        @param device_id    Код модели МК, передаваемый в ответ на запрос 0xC1 (см. pic_devices.yaml) [int]
+        @param baud         Моделируемая скорость порта [int] или None (без задержек передачи)
+        @param row_latency  Время записи строки в ПЗУ, с [float]
+        @param reset_seq    Последовательность сброса МК [string] или None (загрузчик работает сразу)
+        @param reply_seq    Ответ МК на последовательность сброса [string]
+        @raise ValueError   Если код модели МК неизвестен
+        '''
+
+        device = pic_device(device_id)
+        if not device:
+            raise ValueError("Unknown PIC type {:#04x}".format(device_id))
+        self.device_id = device_id
+        self.family = device.family
+        self.max_flash = device.max_flash
+        self._baud = baud
+        self._byte_time = 10.0 / baud if baud else 0.0
+        self._row_latency = row_latency
+        self._reset_seq = reset_seq
+        self._reply_seq = reply_seq or ''
+        ## Длина адреса в кадре, байт
+        self._addr_size = device.address_bytes
+        ## Множитель перевода адреса кадра в смещение в ПЗУ (адрес задается в словах или в байтах)
+        self._addr_scale = 2 if device.word_addressing else 1
+        ## Содержимое эмулируемого ПЗУ (для 16F -- по 2 байта на слово, младший байт первым, как в hex-файле)
+        self.flash = bytearray('\xff' * device.flash_size)
+        ## Признак работы загрузчика (иначе работает прикладная программа, ожидающая последовательность сброса)
+        self.in_bootloader = not reset_seq
+
+        ## Количество принятых кадров
+        self.frames = 0
+        ## Количество кадров с неверной контрольной суммой
+        self.bad_frames = 0
+        ## Количество выполненных сбросов
+        self.resets = 0
+        ## Адреса записанных блоков в порядке записи
+        self.writes = []
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._buffer = bytearray()
+        ## Момент, до которого линия занята передачей ранее принятых байт
+        self._line_busy_until = 0.0
+
+    def open(self):
+        '''
+        Создает пару псевдотерминалов
+
+        @param self    Ссылка на экземпляр класса
+        @return Имя подчиненного терминала, используемого в качестве последовательного порта [string]
+        '''
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        return os.ttyname(self._slave)
+
+    def start(self):
+        '''
+        Создает псевдотерминалы (если они еще не созданы) и запускает обслуживание в отдельном потоке
+
+        @param self    Ссылка на экземпляр класса
+        @return Имя подчиненного терминала [string]
+        '''
+
+        if self._master is None:
+            self.open()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.serve, name='TinyBootloaderEmulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return os.ttyname(self._slave)
+
+    def stop(self):
+        '''
+        Останавливает обслуживание и закрывает псевдотерминалы
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def serve(self):
+        '''
+        Обрабатывает данные, поступающие от bootloader, до запроса остановки
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        while not self._stop.is_set():
+            try:
+                readable = select.select([self._master], [], [], self._POLL_INTERVAL)[0]
+                if not readable:
+                    continue
+                data = os.read(self._master, 4096)
+            except (OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                logger.debug("Emulator terminal closed ({})".format(e))
+                return
+            self._receive(bytearray(data))
+
+    def _receive(self, data):
+        '''
+        Учитывает время передачи принятых байт и обрабатывает накопленные данные
+
+        @param self    Ссылка на экземпляр класса
+        @param data    Принятые данные [bytearray]
+        '''
+
+        # На другой скорости МК принимает искаженные байты -- эмулируем отсутствие ответа
+        if self._baud and not self._speedMatches():
+            logger.debug("Emulator ignored {} bytes sent at wrong baud rate".format(len(data)))
+            return
+        # Байты поступают в порт МК не быстрее, чем позволяет скорость линии
+        self._line_busy_until = max(self._line_busy_until, time.time()) + len(data) * self._byte_time
+        self._buffer.extend(data)
+        if self.in_bootloader:
+            self._processFrames()
+        else:
+            self._processApplication()
+
+    def _speedMatches(self):
+        '''
+        Проверяет, совпадает ли скорость, установленная на подчиненном терминале, с моделируемой скоростью порта
+
+        @param self    Ссылка на экземпляр класса
+        @return Признак совпадения скоростей (True, если скорость определить не удалось) [bool]
+        '''
+
+        speed = getattr(termios, 'B{}'.format(self._baud), None)
+        try:
+            return speed is None or termios.tcgetattr(self._master)[5] == speed
+        except termios.error:
+            return True
+
+    def _processApplication(self):
+        '''
+        Эмулирует прикладную программу: ожидает последовательность сброса, отвечает на нее и запускает загрузчик
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        position = self._buffer.find(self._reset_seq)
+        if position < 0:
+            # Сохраняем только хвост, который может оказаться началом последовательности сброса
+            del self._buffer[:max(0, len(self._buffer) - len(self._reset_seq) + 1)]
+            return
+        del self._buffer[:position + len(self._reset_seq)]
+        self.resets += 1
+        self.in_bootloader = True
+        logger.debug("Emulator reset by command")
+        self._send(self._reply_seq)
+        self._processFrames()
+
+    def _processFrames(self):
+        '''
+        Обрабатывает запросы загрузчику, полностью находящиеся в буфере
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        while self._buffer:
+            # Запрос определения модели МК
+            if self._buffer[0] == 0xC1:
+                del self._buffer[0]
+                self._send(chr(self.device_id) + self._ACK)
+                continue
+
+            header = self._addr_size + 1
+            if len(self._buffer) < header:
+                return
+            size = header + self._buffer[header - 1] + 1
+            if len(self._buffer) < size:
+                return
+            frame = self._buffer[:size]
+            del self._buffer[:size]
+            self._processFrame(frame)
+
+    def _processFrame(self, frame):
+        '''
+        Проверяет кадр записи и записывает его данные в эмулируемое ПЗУ
+
+        @param self    Ссылка на экземпляр класса
+        @param frame   Кадр (адрес, длина, данные, контрольная сумма) [bytearray]
+        '''
+
+        self.frames += 1
+        if sum(frame) & 255:
+            self.bad_frames += 1
+            logger.debug("Emulator received frame with wrong checksum")
+            self._send(self._NAK)
+            return
+
+        addr = 0
+        for byte in frame[:self._addr_size]:
+            addr = (addr << 8) | byte
+        data = frame[self._addr_size + 1:-1]
+        # У 16F адрес задается в словах
+        offset = addr * self._addr_scale
+        if offset + len(data) > len(self.flash):
+            logger.debug("Emulator received frame beyond flash end ({:#06x})".format(addr))
+            self._send(self._NAK)
+            return
+
+        self.flash[offset:offset + len(data)] = data
+        self.writes.append(addr)
+        # Ответ передается после приема кадра целиком и записи строки в ПЗУ
+        self._line_busy_until += self._row_latency
+        self._send(self._ACK)
+
+    def _send(self, data):
+        '''
+        Передает ответ bootloader, выдерживая время приема запроса и передачи ответа на заданной скорости
+
+        @param self    Ссылка на экземпляр класса
+        @param data    Данные [string]
+        '''
+
+        if not data:
+            return
+        if self._byte_time or self._row_latency:
+            self._line_busy_until += len(data) * self._byte_time
+            delay = self._line_busy_until - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        os.write(self._master, data)
+
+    def row(self, addr, size):
+        '''
+        Возвращает содержимое эмулируемого ПЗУ
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес в единицах адресации кадров (для 16F -- в словах) [int]
+        @param size    Количество байт [int]
+        @return Данные [bytearray]
+        '''
+
+        offset = addr * self._addr_scale
+        return self.flash[offset:offset + size]
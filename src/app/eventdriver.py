@@ -0,0 +1,816 @@
+# coding: utf-8
+'''
+@package app.eventdriver
+Bootloader для микроконтроллеров PIC: неблокирующий драйвер загрузчика, позволяющий обслуживать много портов в одном потоке
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import errno
+import fcntl
+import os
+import select
+import sys
+import termios
+import threading
+import time
+import types
+from Queue import Queue
+from bootloader import bootloader, BootloaderException, ResetFailed, PicNotDetected, FlashingInterrupted
+from transmitter import TransferStats
+
+
+class DriverException(BootloaderException):
+
+    '''
+    Класс исключений для модуля
+    '''
+    pass
+
+
+class DeadlineExceeded(DriverException):
+
+    '''
+    Класс исключений для ситуации, когда задача не завершилась к назначенному сроку
+    '''
+    pass
+
+
+class TaskCancelled(DriverException):
+
+    '''
+    Класс исключений для ситуации, когда задача отменена
+    '''
+    pass
+
+
+class PortClosed(DriverException):
+
+    '''
+    Класс исключений для ситуации, когда порт закрыт или недоступен (например, отключен адаптер)
+    '''
+    pass
+
+
+class Read(object):
+
+    '''
+    Операция чтения из порта. Результат -- прочитанные данные; при истечении таймаута может быть прочитано меньше
+    указанного количества байт (как при чтении из serial.Serial)
+    '''
+
+    def __init__(self, size, timeout):
+        '''
+        Конструктор
+
+        @param self     Ссылка на экземпляр класса
+        @param size     Количество байт [int]
+        @param timeout  Таймаут чтения, с [float]
+        '''
+
+        self.size = size
+        self.timeout = timeout
+
+
+class Write(object):
+
+    '''
+    Операция записи в порт. Завершается, когда все данные переданы драйверу порта
+    '''
+
+    def __init__(self, data):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        @param data    Данные [string]
+        '''
+
+        self.data = data
+
+
+class Flush(object):
+
+    '''
+    Операция сброса буфера чтения порта
+    '''
+    pass
+
+
+class Sleep(object):
+
+    '''
+    Операция ожидания
+    '''
+
+    def __init__(self, delay):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        @param delay   Время ожидания, с [float]
+        '''
+
+        self.delay = delay
+
+
+class Call(object):
+
+    '''
+    Операция вызова функции в отдельном потоке -- для продолжительной работы, не связанной с портом (например, разбора
+    hex-файла), чтобы она не задерживала обслуживание других портов. Результат -- значение, возвращенное функцией;
+    исключение, возникшее в функции, передается в генератор. При отмене задачи или истечении ее срока функция
+    выполняется до конца, но ее результат не используется
+    '''
+
+    def __init__(self, func, *args):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        @param func    Функция [callable]
+        @param args    Аргументы функции
+        '''
+
+        self.func = func
+        self.args = args
+        ## Признак завершения функции
+        self.finished = threading.Event()
+        ## Значение, возвращенное функцией
+        self.value = None
+        ## Информация об исключении, возникшем в функции [tuple]
+        self.exc_info = None
+
+    def run(self):
+        '''
+        Выполняет функцию (в отдельном потоке)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.finished.set()
+
+
+class RowRecorder(object):
+
+    '''
+    Сохраняет информацию о строках, запись которых подтверждена загрузчиком (процент выполнения, контрольную точку),
+    в отдельном потоке, чтобы запись файлов (в т.ч. сброс контрольной точки на диск) не задерживала обслуживание портов
+    циклом SerialLoop. Строки сохраняются в порядке подтверждения
+    '''
+
+    def __init__(self, record):
+        '''
+        Конструктор. Запускает рабочий поток
+
+        @param self    Ссылка на экземпляр класса
+        @param record  Функция сохранения строки [callable(row, data, percentage)]
+        '''
+
+        self._record = record
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._worker, name='RowRecorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, row, data, percentage):
+        '''
+        Передает строку на сохранение (не ожидая его)
+
+        @param self        Ссылка на экземпляр класса
+        @param row         Номер строки [int]
+        @param data        Переданные данные строки [string]
+        @param percentage  Процент выполнения после передачи строки [int]
+        '''
+
+        self._queue.put((row, data, percentage))
+
+    def _worker(self):
+        '''
+        Функция рабочего потока: сохраняет строки до получения элемента None
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._record(*item)
+            except Exception:
+                logger.warning("Failed to record row {} due to {} exception ({})".format(item[0], *sys.exc_info()[:2]))
+
+    def close(self):
+        '''
+        Ожидает сохранения всех переданных строк и останавливает рабочий поток (повторный вызов допустим)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._queue.put(None)
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class Task(object):
+
+    '''
+    Задача, выполняемая циклом SerialLoop: генератор, работающий с одним портом.
+    Генератор передает циклу операции (Read, Write, Flush, Sleep, Call) и получает их результаты; вложенные генераторы
+    выполняются как подпрограммы (результат подпрограммы передается исключением StopIteration(результат)).
+    Отмена задачи и истечение ее срока передаются в генератор исключениями TaskCancelled и DeadlineExceeded
+    в точке ожидания текущей операции
+    '''
+
+    ## Период проверки завершения функции, вызванной операцией Call, с
+    _CALL_POLL_INTERVAL = 0.01
+
+    def __init__(self, fd, coroutine, deadline=None, name=None):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param fd         Файловый дескриптор порта [int]
+        @param coroutine  Генератор задачи [generator]
+        @param deadline   Срок завершения задачи (значение time.time()) [float] или None
+        @param name       Имя задачи (используется в сообщениях) [string]
+        '''
+
+        self.fd = fd
+        self.name = name or str(fd)
+        self.deadline = deadline
+        self._stack = [coroutine]
+        ## Ожидаемая операция
+        self._op = None
+        ## Момент, в который ожидание операции завершается по таймауту (значение time.time())
+        self._wakeup = None
+        self._inbuf = bytearray()
+        self._outbuf = ''
+        self._cancelled = False
+        self._done = False
+        self._exc_info = None
+
+    def cancel(self):
+        '''
+        Отменяет задачу (исключение TaskCancelled передается в генератор при следующем обращении к нему циклом)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if not self._done:
+            self._cancelled = True
+
+    def done(self):
+        '''
+        Возвращает признак завершения задачи
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        return self._done
+
+    def result(self):
+        '''
+        Проверяет результат завершенной задачи
+
+        @param self    Ссылка на экземпляр класса
+        @raise Исключение, которым завершилась задача
+        '''
+
+        if self._exc_info:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def exception(self):
+        '''
+        Возвращает исключение, которым завершилась задача
+
+        @param self    Ссылка на экземпляр класса
+        @return Исключение [Exception] или None
+        '''
+
+        return self._exc_info[1] if self._exc_info else None
+
+    def _resume(self, value=None, exc_info=None):
+        '''
+        Передает генератору результат операции (или исключение) и выполняет его до следующей операции,
+        которую нельзя завершить немедленно
+
+        @param self      Ссылка на экземпляр класса
+        @param value     Результат операции
+        @param exc_info  Информация об исключении для передачи в генератор [tuple]
+        '''
+
+        while True:
+            coroutine = self._stack[-1]
+            try:
+                if exc_info:
+                    op = coroutine.throw(*exc_info)
+                else:
+                    op = coroutine.send(value)
+            except StopIteration, e:
+                value, exc_info = e.args[0] if e.args else None, None
+                self._stack.pop()
+            except:
+                value, exc_info = None, sys.exc_info()
+                self._stack.pop()
+            else:
+                value, exc_info = None, None
+                # Вложенный генератор -- выполняем как подпрограмму
+                if isinstance(op, types.GeneratorType):
+                    self._stack.append(op)
+                    continue
+                self._op = op
+                self._wakeup = None
+                try:
+                    completed, value = self._start(op)
+                except:
+                    completed, exc_info = True, sys.exc_info()
+                if completed:
+                    self._op = None
+                    continue
+                return
+
+            # Генератор завершился -- результат передается вызвавшему генератору
+            if not self._stack:
+                self._finish(exc_info)
+                return
+
+    def _finish(self, exc_info=None):
+        '''
+        Завершает задачу
+
+        @param self      Ссылка на экземпляр класса
+        @param exc_info  Информация об исключении, которым завершилась задача [tuple]
+        '''
+
+        self._done = True
+        self._op = None
+        self._exc_info = exc_info
+        if exc_info:
+            logger.debug("Task '{}' failed due to {} exception ({})".format(self.name, *exc_info[:2]))
+
+    def _start(self, op):
+        '''
+        Начинает выполнение операции
+
+        @param self    Ссылка на экземпляр класса
+        @param op      Операция [Read, Write, Flush, Sleep или Call]
+        @return Признак завершения операции и ее результат [tuple(bool, object)]
+        '''
+
+        if isinstance(op, Read):
+            self._inbuf = bytearray()
+            self._wakeup = time.time() + op.timeout
+            return self._read()
+        elif isinstance(op, Write):
+            self._outbuf = op.data
+            return self._write()
+        elif isinstance(op, Flush):
+            try:
+                termios.tcflush(self.fd, termios.TCIFLUSH)
+            except termios.error:
+                pass
+            return True, None
+        elif isinstance(op, Sleep):
+            self._wakeup = time.time() + op.delay
+            return False, None
+        elif isinstance(op, Call):
+            thread = threading.Thread(target=op.run, name='Call-{}'.format(self.name))
+            thread.daemon = True
+            thread.start()
+            return False, None
+        raise TypeError("Unknown operation {!r}".format(op))
+
+    def _read(self):
+        '''
+        Читает из порта данные, доступные без ожидания
+
+        @param self    Ссылка на экземпляр класса
+        @return Признак завершения операции чтения и прочитанные данные [tuple(bool, string)]
+        '''
+
+        try:
+            data = os.read(self.fd, self._op.size - len(self._inbuf))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False, None
+            raise PortClosed("Failed to read from port '{}' ({})".format(self.name, e))
+        if not data:
+            raise PortClosed("Port '{}' closed".format(self.name))
+        self._inbuf.extend(data)
+        if len(self._inbuf) >= self._op.size:
+            return True, str(self._inbuf)
+        return False, None
+
+    def _write(self):
+        '''
+        Записывает в порт данные, которые драйвер порта может принять без ожидания
+
+        @param self    Ссылка на экземпляр класса
+        @return Признак завершения операции записи [tuple(bool, None)]
+        '''
+
+        try:
+            written = os.write(self.fd, self._outbuf)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return False, None
+            raise PortClosed("Failed to write to port '{}' ({})".format(self.name, e))
+        self._outbuf = self._outbuf[written:]
+        return not self._outbuf, None
+
+    def _poll(self, events, now):
+        '''
+        Продолжает выполнение задачи после опроса портов
+
+        @param self    Ссылка на экземпляр класса
+        @param events  События порта задачи (маска select.POLL*) [int]
+        @param now     Текущее время [float]
+        '''
+
+        if self._done:
+            return
+        if self._cancelled:
+            self._throw(TaskCancelled("Task '{}' cancelled".format(self.name)))
+            return
+        if self.deadline is not None and now >= self.deadline:
+            self._throw(DeadlineExceeded("Task '{}' missed its deadline".format(self.name)))
+            return
+
+        op = self._op
+        try:
+            completed, value = False, None
+            if isinstance(op, Read) and events:
+                completed, value = self._read()
+            elif isinstance(op, Write) and events:
+                completed, value = self._write()
+            elif isinstance(op, Call) and op.finished.is_set():
+                if op.exc_info:
+                    self._op = None
+                    self._resume(exc_info=op.exc_info)
+                    return
+                completed, value = True, op.value
+            if not completed and self._wakeup is not None and now >= self._wakeup:
+                # Таймаут чтения -- возвращаем прочитанное; ожидание завершено
+                completed, value = True, str(self._inbuf) if isinstance(op, Read) else None
+        except DriverException:
+            self._op = None
+            self._resume(exc_info=sys.exc_info())
+            return
+        if completed:
+            self._op = None
+            self._resume(value)
+
+    def _throw(self, exc):
+        '''
+        Передает исключение в генератор в точке ожидания текущей операции
+
+        @param self    Ссылка на экземпляр класса
+        @param exc     Исключение [Exception]
+        '''
+
+        self._cancelled = False
+        self._op = None
+        try:
+            raise exc
+        except:
+            self._resume(exc_info=sys.exc_info())
+
+    def _pollMask(self):
+        '''
+        Возвращает маску событий порта, ожидаемых задачей
+
+        @param self    Ссылка на экземпляр класса
+        @return Маска select.POLL* [int]
+        '''
+
+        if isinstance(self._op, Read):
+            return select.POLLIN
+        if isinstance(self._op, Write):
+            return select.POLLOUT
+        return 0
+
+    def _nextTimeout(self):
+        '''
+        Возвращает ближайший момент, в который задачу необходимо продолжить независимо от событий порта
+
+        @param self    Ссылка на экземпляр класса
+        @return Значение time.time() или None
+        '''
+
+        if self._cancelled:
+            return 0
+        times = [t for t in (self._wakeup, self.deadline) if t is not None]
+        # Завершение функции в отдельном потоке проверяется периодически
+        if isinstance(self._op, Call):
+            times.append(time.time() + self._CALL_POLL_INTERVAL)
+        return min(times) if times else None
+
+
+class SerialLoop(object):
+
+    '''
+    Цикл обработки событий для нескольких портов: ожидает готовности портов (select.poll) и таймаутов операций
+    и продолжает выполнение соответствующих задач. Все задачи выполняются в одном потоке
+    '''
+
+    def __init__(self):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._tasks = []
+
+    def spawn(self, fd, coroutine, deadline=None, name=None):
+        '''
+        Создает задачу и начинает ее выполнение (до первой операции, требующей ожидания)
+
+        @param self       Ссылка на экземпляр класса
+        @param fd         Файловый дескриптор порта [int]
+        @param coroutine  Генератор задачи [generator]
+        @param deadline   Срок завершения задачи (значение time.time()) [float] или None
+        @param name       Имя задачи [string]
+        @return Задача [Task]
+        @raise ValueError  Если с портом уже работает другая задача
+        '''
+
+        if any(task.fd == fd and not task.done() for task in self._tasks):
+            raise ValueError("Port {} is already used by another task".format(fd))
+        task = Task(fd, coroutine, deadline, name)
+        self._tasks.append(task)
+        task._resume()
+        return task
+
+    def run(self, timeout=None):
+        '''
+        Выполняет задачи до их завершения
+
+        @param self     Ссылка на экземпляр класса
+        @param timeout  Максимальное время работы цикла, с [float] или None
+        @return Признак завершения всех задач [bool]
+        '''
+
+        stop_at = time.time() + timeout if timeout is not None else None
+        while True:
+            self._tasks = [task for task in self._tasks if not task.done()]
+            if not self._tasks:
+                return True
+            if stop_at is not None and time.time() >= stop_at:
+                return False
+            self.runOnce(stop_at)
+
+    def runOnce(self, stop_at=None):
+        '''
+        Выполняет одну итерацию цикла: ожидает событий портов или ближайшего таймаута и продолжает задачи
+
+        @param self     Ссылка на экземпляр класса
+        @param stop_at  Момент, позже которого ожидание не продолжается (значение time.time()) [float] или None
+        '''
+
+        poller = select.poll()
+        wakeups = [stop_at] if stop_at is not None else []
+        for task in self._tasks:
+            mask = task._pollMask()
+            if mask:
+                poller.register(task.fd, mask)
+            wakeup = task._nextTimeout()
+            if wakeup is not None:
+                wakeups.append(wakeup)
+
+        timeout = None
+        if wakeups:
+            timeout = max(0, int((min(wakeups) - time.time()) * 1000 + 1))
+        try:
+            events = dict(poller.poll(timeout))
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = {}
+
+        now = time.time()
+        for task in list(self._tasks):
+            task._poll(events.get(task.fd, 0), now)
+
+
+class AsyncBootloader(bootloader):
+
+    '''
+    Загрузчик с неблокирующими операциями: методы с суффиксом Async -- генераторы, выполняемые циклом SerialLoop.
+    Формирование кадров, подготовка образа прошивки, журнал устройства и контрольные точки -- общие с bootloader
+    '''
+
+    ## Таймаут чтения из порта, с
+    _read_timeout = 1
+
+    def openSerial(self, port, baud, timeout=1, low_latency=None):
+        '''
+        Открывает последовательный порт в неблокирующем режиме
+
+        @param self     Ссылка на экземпляр класса
+        @param port     Имя последовательного порта [string]
+        @param baud     Скорость порта [int]
+        @param timeout  Таймаут чтения данных из порта (в секундах) [float]
+        @param low_latency  Параметры настройки порта для уменьшения задержки приема (см. bootloader.openSerial())
+        '''
+
+        bootloader.openSerial(self, port, baud, timeout, low_latency)
+        self._read_timeout = timeout
+        fd = self.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # При VMIN=0 (так порт настраивает pyserial) чтение без данных возвращает 0 байт, как при закрытии порта;
+        # при VMIN=1 неблокирующее чтение без данных завершается ошибкой EAGAIN
+        attrs = termios.tcgetattr(fd)
+        attrs[6][termios.VMIN] = 1
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+    def fileno(self):
+        '''
+        Возвращает файловый дескриптор порта (используется при создании задачи цикла SerialLoop)
+
+        @param self     Ссылка на экземпляр класса
+        @return Файловый дескриптор [int]
+        '''
+
+        return self.serial.fileno()
+
+    def resetPicAsync(self, reset_seq, reply_seq=None, max_attempts=3):
+        '''
+        Выполняет сброс МК отправкой указанной последовательности байт (см. bootloader.resetPic())
+
+        @param self          Ссылка на экземпляр класса
+        @param reset_seq     Последовательность символов для сброса МК [string]
+        @param reply_seq     Последовательность символов, которой МК должен ответить на сброс [string]
+        @param max_attempts  Максимально возможное количество попыток
+        @raise ResetFailed   В случае, если за указанное число попыток не удалось получить от МК требуемый ответ
+        '''
+
+        logger.info("Reseting PIC with {} sequence...".format(repr(reset_seq)))
+        for attempt in xrange(max_attempts):
+            if attempt > 0:
+                logger.warning('Failed to read PIC reply sequence on attempt #{}. Retrying...'.format(attempt))
+            yield Write(reset_seq)
+            if not reply_seq:
+                return
+            found, _ = yield self._readReplyAsync(lambda data: reply_seq in data, self._reset_timeout)
+            if found:
+                return
+
+        logger.error('Failed to reset PIC by command during {} attempt(s)'.format(max_attempts))
+        raise ResetFailed
+
+    def detectPicAsync(self):
+        '''
+        Выполняет определение типа МК (см. bootloader.detectPic())
+
+        @param self     Ссылка на экземпляр класса
+        @raise PicNotDetected  В случае, если не удалось определить модель МК по значению, полученному от загрузчика,
+                               или загрузка прошивки в МК этого семейства не поддерживается
+        '''
+
+        logger.info("Detecting PIC...")
+        yield Write(self._DETECT_REQUEST)
+        reply, received = yield self._readReplyAsync(self._findIdentity, self._probe_timeout)
+        self._identify(reply or received[-2:])
+
+    def _readReplyAsync(self, match, timeout=None):
+        '''
+        Читает данные из порта по мере поступления, пока в них не будет найден ожидаемый ответ или не истечет таймаут
+        (см. bootloader._readReply()). Результат -- найденный ответ (None, если не найден) и все принятые данные
+
+        @param self     Ссылка на экземпляр класса
+        @param match    Функция, возвращающая найденный ответ по принятым данным [callable(string)]
+        @param timeout  Время ожидания ответа, с [float] или None (таймаут чтения порта)
+        '''
+
+        received = ''
+        deadline = time.time() + (self._read_timeout if timeout is None else timeout)
+        while True:
+            chunk = yield Read(1, max(0, deadline - time.time()))
+            received += chunk
+            result = match(received)
+            if result:
+                raise StopIteration((result, received))
+            if not chunk or time.time() >= deadline:
+                raise StopIteration((None, received))
+
+    def writeMemAsync(self, addr, data):
+        '''
+        Отправляет блок данных для записи по указанному адресу в ПЗУ МК и ожидает подтверждения,
+        повторяя отправку при ошибке (см. bootloader._write_mem())
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес, начиная с которого необходимо записать данные [int]
+        @param data    Данные для записи [bytearray или list]
+        @raise FlashWriteFailed  Если подтверждение не получено за допустимое количество повторных попыток
+        '''
+
+        frame = bytes(self._buildFrame(addr, data))
+        attempt = 0
+        while True:
+            yield Flush()
+            yield Write(frame)
+            ret = yield Read(1, self._read_timeout if self._ack_timeout is None else self._ack_timeout)
+            if ret == "K":
+                break
+            logger.warning("Error writing memory block starting from position {0:#06X} (reply {1})".format(addr, repr(ret)))
+            attempt, delay = self._nextRetry(addr, attempt)
+            if delay:
+                yield Sleep(delay)
+
+        if attempt and self.transfer_stats:
+            self.transfer_stats.retried_rows += 1
+        if self.transfer_stats:
+            self.transfer_stats.rows += 1
+            self.transfer_stats.bytes += len(frame)
+
+    def bootloadAsync(self, firmware_filename, delta=False, resume=False):
+        '''
+        Выполняет загрузку прошивки из указанного файла на МК (см. bootloader.bootload(); потоковый режим не поддерживается).
+        Чтение и разбор hex-файла, составление плана загрузки, сохранение подтвержденных строк в контрольной точке
+        (RowRecorder) и сохранение журнала устройства выполняются в отдельных потоках, поэтому не задерживают
+        обслуживание других портов. При ошибке, отмене задачи или истечении ее срока строки, запись которых
+        подтверждена, сохраняются в контрольной точке до завершения задачи
+
+        @param self					Ссылка на экземпляр класса
+        @param firmware_filename	Имя файла с прошивкой
+        @param delta                Передавать только строки, отличающиеся от записанных в ПЗУ при последней загрузке [bool]
+        @param resume               Продолжить прерванную загрузку той же прошивки с первой неподтвержденной строки [bool]
+        @raise FlashingInterrupted  Если загрузка остановлена по запросу (см. requestStop())
+        '''
+
+        chip_rows, skip_rows, content = yield Call(self._beginFlashing, firmware_filename, delta, resume)
+        with self.metrics.phase('parse'):
+            pic_mem = yield Call(self.loadFirmware, firmware_filename, content)
+        plan = self._newPlan(chip_rows, skip_rows)
+        rows = yield Call(self._imageRows, pic_mem, plan)
+
+        stats = self.transfer_stats = TransferStats()
+        started = time.time()
+        self._stop_requested = False
+        self._transferring = True
+        recorder = RowRecorder(self._recordRow)
+        try:
+            for row, percentage in rows:
+                addr = self.rowAddress(row)
+                data = pic_mem.row(row)
+                sent = time.time()
+                yield self.writeMemAsync(addr, data)
+                stats.ack_wait += time.time() - sent
+                self.metrics.observeAck(time.time() - sent)
+                recorder.put(row, bytes(data), percentage)
+                if self._stop_requested:
+                    logger.warning("Flashing interrupted after row at {:#06x}".format(addr))
+                    raise FlashingInterrupted("Flashing interrupted")
+            # Ожидаем сохранения подтвержденных строк, не задерживая обслуживание других портов
+            yield Call(recorder.close)
+        finally:
+            # При ошибке или отмене задачи подтвержденные строки сохраняются до ее завершения
+            recorder.close()
+            self._transferring = False
+            stats.elapsed = time.time() - started
+            stats.log()
+            self.metrics.addTransfer(stats)
+            self.metrics.addPhase('transfer', stats.elapsed)
+
+        yield Call(self._completeFlashing, pic_mem, chip_rows, plan)
+
+    def flashAsync(self, firmware_filename, reset_seq=None, reply_seq=None, max_attempts=3, delta=False, resume=False):
+        '''
+        Обнаруживает МК (если загрузчик не запущен -- после сброса командой) и загружает в него прошивку
+
+        @param self					Ссылка на экземпляр класса
+        @param firmware_filename	Имя файла с прошивкой
+        @param reset_seq            Последовательность символов для сброса МК [string]
+        @param reply_seq            Последовательность символов, которой МК должен ответить на сброс [string]
+        @param max_attempts         Максимальное количество попыток сброса [int]
+        @param delta                Признак разностной загрузки [bool]
+        @param resume               Признак продолжения прерванной загрузки [bool]
+        @raise PicNotDetected  Если МК не обнаружен
+        '''
+
+        try:
+            yield self.detectPicAsync()
+        except PicNotDetected:
+            if not reset_seq:
+                raise
+            logger.warning("Bootloader is not running")
+            yield self.resetPicAsync(reset_seq, reply_seq, max_attempts)
+            yield self.detectPicAsync()
+
+        yield self.bootloadAsync(firmware_filename, delta, resume)
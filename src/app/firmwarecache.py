@@ -0,0 +1,290 @@
+# coding: utf-8
+'''
+@package app.firmwarecache
+Bootloader для микроконтроллеров PIC: дисковый и разделяемый кэши подготовленных образов прошивки
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import errno
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from flashimage import FlashImage
+
+
+class FirmwareCache(object):
+
+    '''
+    Дисковый кэш образов прошивки, разобранных из hex-файлов и подготовленных к передаче (с перемещенным вектором сброса).
+    Записи идентифицируются хэшем содержимого hex-файла и параметрами МК. Запись новых файлов атомарная (через переименование),
+    поэтому кэш может одновременно использоваться несколькими процессами. При превышении заданного объема удаляются записи,
+    к которым дольше всего не обращались
+    '''
+
+    ## Расширение файлов записей кэша
+    _ENTRY_EXT = '.img'
+    ## Имя файла блокировки, используемой при очистке кэша
+    _LOCK_FILENAME = '.lock'
+
+    def __init__(self, directory, max_size):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param directory  Каталог для хранения записей кэша [string]
+        @param max_size   Максимальный суммарный объем записей кэша, байт [int]
+        '''
+
+        self._directory = directory
+        self._max_size = max_size
+
+    @staticmethod
+    def key(firmware_hash, family, max_flash, row_size):
+        '''
+        Формирует ключ записи кэша
+
+        @param firmware_hash  Хэш (SHA-1) содержимого hex-файла [string]
+        @param family         Семейство МК [string]
+        @param max_flash      Максимальный адрес ПЗУ МК [int]
+        @param row_size       Размер строки записи, байт [int]
+        @return Ключ записи [string]
+        '''
+
+        return "{}-{}-{:x}-{:x}".format(firmware_hash, family, max_flash, row_size)
+
+    def _entryFilename(self, key):
+        '''
+        Возвращает имя файла записи кэша
+
+        @param self  Ссылка на экземпляр класса
+        @param key   Ключ записи [string]
+        '''
+
+        return os.path.join(self._directory, key + self._ENTRY_EXT)
+
+    def get(self, key):
+        '''
+        Возвращает образ прошивки из кэша
+
+        @param self  Ссылка на экземпляр класса
+        @param key   Ключ записи [string]
+        @return Образ ПЗУ МК [FlashImage] или None, если запись отсутствует или повреждена
+        '''
+
+        filename = self._entryFilename(key)
+        try:
+            with open(filename, 'rb') as f:
+                image = FlashImage.loads(f.read())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Failed to read firmware cache entry '{}' ({})".format(filename, e))
+            return None
+        except ValueError, e:
+            logger.warning("Firmware cache entry '{}' is invalid ({}), removing".format(filename, e))
+            self._remove(filename)
+            return None
+
+        # Обновляем время последнего обращения к записи (используется при очистке кэша)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        logger.info("Firmware image found in cache")
+        return image
+
+    def put(self, key, image):
+        '''
+        Сохраняет образ прошивки в кэш
+
+        @param self   Ссылка на экземпляр класса
+        @param key    Ключ записи [string]
+        @param image  Образ ПЗУ МК [FlashImage]
+        '''
+
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            # Записываем во временный файл и атомарно переименовываем, чтобы другие процессы не прочитали запись частично
+            fd, tmp_filename = tempfile.mkstemp(dir=self._directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(image.dumps())
+                os.rename(tmp_filename, self._entryFilename(key))
+            except:
+                self._remove(tmp_filename)
+                raise
+        except (IOError, OSError):
+            logger.warning("Failed to save firmware image to cache '{}' due to {} exception ({})".format(self._directory, *sys.exc_info()[:2]))
+            return
+
+        logger.debug("Firmware image saved to cache")
+        self._evict()
+
+    def cancel(self, key):
+        '''
+        Сообщает, что образ, отсутствовавший в кэше, подготовить не удалось (дисковый кэш записи не резервирует)
+
+        @param self  Ссылка на экземпляр класса
+        @param key   Ключ записи [string]
+        '''
+
+        pass
+
+    def _evict(self):
+        '''
+        Удаляет записи, к которым дольше всего не обращались, пока суммарный объем кэша превышает допустимый
+
+        @param self  Ссылка на экземпляр класса
+        '''
+
+        try:
+            with open(os.path.join(self._directory, self._LOCK_FILENAME), 'a') as lock:
+                # Очистку одновременно выполняет только один процесс
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = []
+                for name in os.listdir(self._directory):
+                    if not name.endswith(self._ENTRY_EXT):
+                        continue
+                    filename = os.path.join(self._directory, name)
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, filename))
+
+                total_size = sum(size for _, size, _ in entries)
+                # Удаляем записи, начиная с самых старых
+                for _, size, filename in sorted(entries):
+                    if total_size <= self._max_size:
+                        break
+                    logger.debug("Removing firmware cache entry '{}'".format(filename))
+                    self._remove(filename)
+                    total_size -= size
+        except (IOError, OSError):
+            logger.warning("Failed to clean up firmware cache '{}' due to {} exception ({})".format(self._directory, *sys.exc_info()[:2]))
+
+    @staticmethod
+    def _remove(filename):
+        '''
+        Удаляет файл, игнорируя ошибки
+
+        @param filename  Имя файла [string]
+        '''
+
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+
+class SharedFirmwareCache(object):
+
+    '''
+    Кэш образов прошивки в памяти, общий для нескольких потоков, загружающих прошивку в разные устройства.
+    Первый поток, не нашедший образ в кэше, резервирует запись и готовит образ; остальные потоки ожидают его готовности,
+    поэтому каждый hex-файл разбирается один раз для каждого сочетания параметров МК. Образы из кэша используются только для чтения.
+    Если задан дисковый кэш, образы, отсутствующие в памяти, ищутся в нем, а подготовленные образы сохраняются в него.
+    В памяти хранится ограниченное количество образов: при превышении удаляются образы, к которым дольше всего
+    не обращались (потоки, уже получившие образ, продолжают его использовать)
+    '''
+
+    ## Количество образов, хранимых в памяти, по умолчанию
+    DEFAULT_MAX_IMAGES = 8
+
+    def __init__(self, backend=None, max_images=DEFAULT_MAX_IMAGES):
+        '''
+        Конструктор
+
+        @param self        Ссылка на экземпляр класса
+        @param backend     Дисковый кэш образов [FirmwareCache] или None
+        @param max_images  Максимальное количество образов в памяти [int]
+        '''
+
+        self._backend = backend
+        self._max_images = max_images
+        ## Подготовленные образы в виде {ключ:образ} в порядке обращения (последний -- самый свежий)
+        self._images = OrderedDict()
+        ## Ключи записей, образы для которых готовятся в данный момент
+        self._pending = set()
+        self._condition = threading.Condition()
+
+    key = staticmethod(FirmwareCache.key)
+
+    def get(self, key):
+        '''
+        Возвращает образ прошивки из кэша, ожидая его подготовки другим потоком. Если образ отсутствует, запись резервируется:
+        вызвавший поток должен подготовить образ и сохранить его методом put() или отменить резервирование методом cancel()
+
+        @param self  Ссылка на экземпляр класса
+        @param key   Ключ записи [string]
+        @return Образ ПЗУ МК [FlashImage] или None, если образ отсутствует
+        '''
+
+        with self._condition:
+            while key in self._pending:
+                self._condition.wait()
+            image = self._images.pop(key, None)
+            if image is not None:
+                self._images[key] = image
+                return image
+            self._pending.add(key)
+
+        if self._backend:
+            image = self._backend.get(key)
+            if image is not None:
+                self._store(key, image)
+        return image
+
+    def put(self, key, image):
+        '''
+        Сохраняет образ прошивки в кэш и снимает резервирование записи
+
+        @param self   Ссылка на экземпляр класса
+        @param key    Ключ записи [string]
+        @param image  Образ ПЗУ МК [FlashImage]
+        '''
+
+        self._store(key, image)
+        if self._backend:
+            self._backend.put(key, image)
+
+    def cancel(self, key):
+        '''
+        Снимает резервирование записи, если образ подготовить не удалось (его подготовит следующий поток)
+
+        @param self  Ссылка на экземпляр класса
+        @param key   Ключ записи [string]
+        '''
+
+        with self._condition:
+            self._pending.discard(key)
+            self._condition.notify_all()
+
+    def _store(self, key, image):
+        '''
+        Помещает образ в память, удаляя образы, к которым дольше всего не обращались, и пробуждает ожидающие его потоки
+
+        @param self   Ссылка на экземпляр класса
+        @param key    Ключ записи [string]
+        @param image  Образ ПЗУ МК [FlashImage]
+        '''
+
+        with self._condition:
+            self._images.pop(key, None)
+            self._images[key] = image
+            while len(self._images) > self._max_images:
+                evicted, _ = self._images.popitem(last=False)
+                logger.debug("Firmware image '{}' evicted from memory".format(evicted))
+            self._pending.discard(key)
+            self._condition.notify_all()
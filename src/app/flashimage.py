@@ -0,0 +1,227 @@
+# coding: utf-8
+'''
+@package app.flashimage
+Bootloader для микроконтроллеров PIC: образ ПЗУ МК
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import struct
+import zlib
+from array import array
+
+
+class FlashImage(object):
+
+    '''
+    Образ ПЗУ МК в адресации hex-файла (побайтной).
+    Данные хранятся в заранее выделенном буфере, заполненном значением стертой ячейки (0xFF);
+    признак наличия каждого байта в прошивке хранится в битовой карте, а количество заполненных байт -- по строкам (блокам записи).
+    Поддерживает обращение по адресу аналогично словарю {адрес:значение}
+    '''
+
+    ## Значение стертой ячейки ПЗУ
+    ERASED = 0xFF
+    ## Заголовок сериализованного образа: сигнатура, версия формата, размер образа, размер строки
+    _HEADER = struct.Struct('<4sHII')
+    ## Сигнатура сериализованного образа
+    _MAGIC = 'PICI'
+    ## Версия формата сериализованного образа
+    _VERSION = 1
+
+    def __init__(self, size, row_size):
+        '''
+        Конструктор
+
+        @param self      Ссылка на экземпляр класса
+        @param size      Размер образа, байт [int]
+        @param row_size  Размер строки (блока записи), байт [int]
+        '''
+
+        ## Размер образа, байт
+        self.size = size
+        ## Размер строки, байт
+        self.row_size = row_size
+        # Данные образа
+        self._data = bytearray([self.ERASED]) * size
+        # Битовая карта заполненных байт
+        self._mask = bytearray((size + 7) >> 3)
+        # Количество заполненных байт в каждой строке
+        self._row_counts = array('H', [0]) * ((size + row_size - 1) // row_size)
+        # Номера строк, содержащих хотя бы один заполненный байт
+        self._rows = set()
+        # Общее количество заполненных байт
+        self._count = 0
+
+    def __len__(self):
+        '''
+        Возвращает количество заполненных байт образа
+
+        @param self  Ссылка на экземпляр класса
+        '''
+
+        return self._count
+
+    def __contains__(self, addr):
+        '''
+        Проверяет, заполнен ли байт по указанному адресу
+
+        @param self  Ссылка на экземпляр класса
+        @param addr  Адрес [int]
+        '''
+
+        return 0 <= addr < self.size and bool(self._mask[addr >> 3] & (1 << (addr & 7)))
+
+    def __getitem__(self, addr):
+        '''
+        Возвращает значение заполненного байта по указанному адресу
+
+        @param self  Ссылка на экземпляр класса
+        @param addr  Адрес [int]
+        @raise KeyError  Если байт по указанному адресу не заполнен
+        '''
+
+        if addr not in self:
+            raise KeyError(addr)
+        return self._data[addr]
+
+    def __setitem__(self, addr, value):
+        '''
+        Записывает значение байта по указанному адресу
+
+        @param self   Ссылка на экземпляр класса
+        @param addr   Адрес [int]
+        @param value  Значение [int]
+        @raise IndexError  Если адрес выходит за пределы образа
+        '''
+
+        if not 0 <= addr < self.size:
+            raise IndexError("Address {:#x} is out of flash image".format(addr))
+        self._data[addr] = value
+        self._mark(addr)
+
+    def _mark(self, addr):
+        '''
+        Отмечает байт по указанному адресу как заполненный
+
+        @param self  Ссылка на экземпляр класса
+        @param addr  Адрес [int]
+        '''
+
+        bit = 1 << (addr & 7)
+        if not self._mask[addr >> 3] & bit:
+            self._mask[addr >> 3] |= bit
+            row = addr // self.row_size
+            self._row_counts[row] += 1
+            self._rows.add(row)
+            self._count += 1
+
+    def update(self, addr, data):
+        '''
+        Записывает последовательность байт, начиная с указанного адреса. Байты за пределами образа отбрасываются
+
+        @param self  Ссылка на экземпляр класса
+        @param addr  Начальный адрес [int]
+        @param data  Данные [bytearray]
+        @return Количество отброшенных байт [int]
+        '''
+
+        end = min(addr + len(data), self.size)
+        if addr >= end:
+            return len(data)
+
+        self._data[addr:end] = data[:end - addr]
+        for a in xrange(addr, end):
+            self._mark(a)
+
+        return addr + len(data) - end
+
+    def rows(self):
+        '''
+        Возвращает номера строк, содержащих хотя бы один заполненный байт, в порядке возрастания адресов
+
+        @param self  Ссылка на экземпляр класса
+        @return Номера строк [list]
+        '''
+
+        return sorted(self._rows)
+
+    def row(self, index):
+        '''
+        Возвращает данные указанной строки (незаполненные байты имеют значение 0xFF)
+
+        @param self   Ссылка на экземпляр класса
+        @param index  Номер строки [int]
+        @return Данные строки [bytearray]
+        '''
+
+        start = index * self.row_size
+        return self._data[start:start + self.row_size]
+
+    def rowCount(self, index):
+        '''
+        Возвращает количество заполненных байт в указанной строке
+
+        @param self   Ссылка на экземпляр класса
+        @param index  Номер строки [int]
+        '''
+
+        return self._row_counts[index]
+
+    def dumps(self):
+        '''
+        Сериализует образ в сжатую строку байт
+
+        @param self  Ссылка на экземпляр класса
+        @return Сериализованный образ [string]
+        '''
+
+        header = self._HEADER.pack(self._MAGIC, self._VERSION, self.size, self.row_size)
+        return header + zlib.compress(bytes(self._data) + bytes(self._mask), 1)
+
+    @classmethod
+    def loads(cls, raw):
+        '''
+        Восстанавливает образ из строки байт, полученной с помощью dumps()
+
+        @param cls  Класс образа
+        @param raw  Сериализованный образ [string]
+        @return Образ ПЗУ МК [FlashImage]
+        @raise ValueError  Если данные повреждены или имеют другую версию формата
+        '''
+
+        try:
+            magic, version, size, row_size = cls._HEADER.unpack_from(raw)
+            payload = zlib.decompress(raw[cls._HEADER.size:])
+        except (struct.error, zlib.error):
+            raise ValueError("Corrupted flash image data")
+        if magic != cls._MAGIC or version != cls._VERSION:
+            raise ValueError("Unsupported flash image format")
+
+        image = cls(size, row_size)
+        if len(payload) != size + len(image._mask):
+            raise ValueError("Flash image data length mismatch")
+        image._data[:] = payload[:size]
+        image._mask[:] = payload[size:]
+
+        # Восстанавливаем счетчики заполненных байт по битовой карте
+        mask_row = row_size >> 3
+        for row in xrange(len(image._row_counts)):
+            chunk = image._mask[row * mask_row:(row + 1) * mask_row]
+            if any(chunk):
+                count = sum(_BIT_COUNT[b] for b in chunk)
+                image._row_counts[row] = count
+                image._rows.add(row)
+                image._count += count
+
+        return image
+
+
+## Количество установленных бит для каждого значения байта
+_BIT_COUNT = bytearray(bin(i).count('1') for i in xrange(256))
@@ -0,0 +1,174 @@
+# coding: utf-8
+'''
+@package app.flashplan
+Bootloader для микроконтроллеров PIC: план загрузки прошивки -- строки образа, которые необходимо передать в МК,
+в порядке передачи
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+from ledger import rowHash
+from transmitter import estimateTransferTime
+
+
+def erasedRowHashes(row_size, word_mask=0xFFFF):
+    '''
+    Возвращает хэши строки в стертом состоянии. У моделей с неполным словом (14 бит у PIC16) стертое слово записывается
+    в hex-файл как значение маски слова (0x3FFF) или как 0xFFFF -- в ПЗУ оба значения записываются одинаково
+
+    @param row_size   Размер строки, байт [int]
+    @param word_mask  Маска значащих бит слова ПЗУ [int]
+    @return Хэши [set]
+    '''
+
+    return set(rowHash(bytearray((word & 255, word >> 8)) * (row_size // 2)) for word in (0xFFFF, word_mask))
+
+
+class FlashPlan(object):
+
+    '''
+    План загрузки прошивки. Строки образа передаются в порядке возрастания адресов (строка с переходом в загрузчик
+    в векторе сброса -- первой). Строка не передается, если:
+      - ее содержимое уже записано в ПЗУ (по журналу устройства при разностной загрузке или по контрольной точке
+        при продолжении прерванной загрузки);
+      - строка образа стерта (например, заполнена toolchain'ом значением стертой ячейки) и соответствующая строка ПЗУ
+        по журналу устройства тоже стерта. Загрузчик не стирает ПЗУ целиком, поэтому стертая строка, прежнее содержимое
+        которой неизвестно, передается: иначе в ПЗУ осталось бы содержимое предыдущей прошивки
+    '''
+
+    def __init__(self, frame_size, chip_rows=None, skip_rows=None, erased_hashes=()):
+        '''
+        Конструктор
+
+        @param self           Ссылка на экземпляр класса
+        @param frame_size     Размер кадра записи строки (включая адрес, длину и контрольную сумму), байт [int]
+        @param chip_rows      Хэши строк ПЗУ по журналу устройства в виде {номер строки:хэш} [dict]
+        @param skip_rows      Хэши строк, которые не требуется передавать, в виде {номер строки:хэш} [dict]
+        @param erased_hashes  Хэши строки в стертом состоянии (см. erasedRowHashes()) [set]
+        '''
+
+        self.frame_size = frame_size
+        self._chip_rows = chip_rows or {}
+        self._skip_rows = skip_rows or {}
+        self._erased_hashes = erased_hashes
+        ## Строки, передаваемые в МК, в порядке передачи [list]
+        self.rows = []
+        ## Строки, содержимое которых уже записано в ПЗУ [list]
+        self.skipped = []
+        ## Стертые строки, не требующие записи [list]
+        self.elided = []
+        # Список, в котором учтена строка, {номер строки: список}
+        self._listed = {}
+
+    def accept(self, row, data):
+        '''
+        Определяет, требуется ли передавать строку, и учитывает строку в плане
+
+        @param self    Ссылка на экземпляр класса
+        @param row     Номер строки [int]
+        @param data    Данные строки [bytearray]
+        @return Признак необходимости передачи [bool]
+        '''
+
+        # Без журнала устройства и контрольной точки передаются все строки (хэш не вычисляется)
+        if self._chip_rows or self._skip_rows:
+            row_hash = rowHash(data)
+            if self._skip_rows.get(row) == row_hash:
+                self._note(row, self.skipped)
+                return False
+            if row_hash in self._erased_hashes and self._chip_rows.get(row) in self._erased_hashes:
+                self._note(row, self.elided)
+                return False
+        self._note(row, self.rows)
+        return True
+
+    def _note(self, row, rows):
+        '''
+        Учитывает строку в одном из списков плана. В потоковом режиме строка, данные которой встретились в файле
+        повторно, рассматривается повторно: она учитывается один раз, в списке по последнему решению
+
+        @param self    Ссылка на экземпляр класса
+        @param row     Номер строки [int]
+        @param rows    Список плана (rows, skipped или elided) [list]
+        '''
+
+        listed = self._listed.get(row)
+        if listed is rows:
+            return
+        if listed is not None:
+            listed.remove(row)
+        rows.append(row)
+        self._listed[row] = rows
+
+    def select(self, pic_mem, rows):
+        '''
+        Отбирает строки, которые необходимо передать, из перебираемых по мере готовности (в потоковом режиме)
+
+        @param self     Ссылка на экземпляр класса
+        @param pic_mem  Образ ПЗУ МК [FlashImage]
+        @param rows     Строки в виде кортежей (номер строки, процент выполнения после передачи строки) [iterable]
+        @return Генератор кортежей (номер строки, процент выполнения после передачи строки)
+        '''
+
+        for row, percentage in rows:
+            if self.accept(row, pic_mem.row(row)):
+                yield row, percentage
+
+    def build(self, pic_mem, row_limit):
+        '''
+        Составляет план передачи подготовленного образа. Процент выполнения рассчитывается по количеству байт прошивки
+        в передаваемых строках
+
+        @param self       Ссылка на экземпляр класса
+        @param pic_mem    Образ ПЗУ МК [FlashImage]
+        @param row_limit  Количество строк, доступных для записи [int]
+        @return Строки в порядке передачи в виде кортежей (номер строки, процент выполнения после передачи строки) [list]
+        '''
+
+        # Перебираем только строки образа, содержащие данные прошивки, до начала кода загрузчика
+        rows = [row for row in pic_mem.rows() if row < row_limit and self.accept(row, pic_mem.row(row))]
+
+        bytes_total = sum(pic_mem.rowCount(row) for row in rows)
+        bytes_sent = 0
+        result = []
+        for row in rows:
+            bytes_sent += pic_mem.rowCount(row)
+            result.append((row, int(float(bytes_sent) / bytes_total * 100)))
+        return result
+
+    def byteCount(self):
+        '''
+        Возвращает количество байт, передаваемых в МК
+
+        @param self    Ссылка на экземпляр класса
+        @return Количество байт [int]
+        '''
+
+        return len(self.rows) * self.frame_size
+
+    def estimateTime(self, baud):
+        '''
+        Оценивает время передачи строк плана
+
+        @param self    Ссылка на экземпляр класса
+        @param baud    Скорость порта [int]
+        @return Время передачи, с [float]
+        '''
+
+        return estimateTransferTime(len(self.rows), self.frame_size, baud)
+
+    def log(self):
+        '''
+        Выводит в лог итоги плана
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        logger.info("Flash plan: {} row(s) sent, {} row(s) already in flash memory skipped, {} erased row(s) elided".format(
+          len(self.rows), len(self.skipped), len(self.elided)))
@@ -0,0 +1,189 @@
+# coding: utf-8
+'''
+@package app.history
+Bootloader для микроконтроллеров PIC: журнал загрузок прошивки в локальной базе данных SQLite для анализа
+изменения длительности загрузки по портам и устройствам (например, для выявления деградирующих кабелей и адаптеров)
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+
+## Схема базы данных
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  timestamp REAL NOT NULL,
+  port TEXT,
+  device_id TEXT,
+  pic_type TEXT,
+  family TEXT,
+  firmware_hash TEXT,
+  baud INTEGER,
+  reset_method TEXT,
+  duration REAL,
+  transfer_time REAL,
+  rows INTEGER,
+  bytes INTEGER,
+  retries INTEGER,
+  exit_code INTEGER,
+  phases TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_timestamp ON runs (timestamp);
+CREATE INDEX IF NOT EXISTS runs_port ON runs (port, timestamp);
+'''
+
+## Отчеты: {имя:(описание, запрос, заголовки столбцов)}. Параметр запроса -- начало интервала (значение time.time())
+REPORTS = {
+  'runs': (
+    "last runs",
+    '''SELECT datetime(timestamp, 'unixepoch', 'localtime'), port, pic_type, baud, reset_method,
+              duration, rows, retries, exit_code
+       FROM runs WHERE timestamp >= ? ORDER BY timestamp DESC LIMIT 50''',
+    ('TIME', 'PORT', 'TYPE', 'BAUD', 'RESET', 'DURATION', 'ROWS', 'RETRIES', 'CODE'),
+  ),
+  'slowest': (
+    "ports by mean duration of successful flashing",
+    '''SELECT port, COUNT(*), AVG(duration), MAX(duration), SUM(retries),
+              SUM(bytes) / NULLIF(SUM(transfer_time), 0)
+       FROM runs WHERE timestamp >= ? AND exit_code = 0
+       GROUP BY port ORDER BY AVG(duration) DESC''',
+    ('PORT', 'RUNS', 'MEAN', 'MAX', 'RETRIES', 'BYTES/S'),
+  ),
+  'baud': (
+    "row transfer throughput by baud rate",
+    '''SELECT baud, COUNT(*), SUM(bytes) / NULLIF(SUM(transfer_time), 0), AVG(duration), SUM(retries)
+       FROM runs WHERE timestamp >= ? AND exit_code = 0
+       GROUP BY baud ORDER BY baud''',
+    ('BAUD', 'RUNS', 'BYTES/S', 'MEAN', 'RETRIES'),
+  ),
+  'failures': (
+    "failed runs by port and exit code",
+    '''SELECT port, exit_code, COUNT(*), datetime(MAX(timestamp), 'unixepoch', 'localtime')
+       FROM runs WHERE timestamp >= ? AND exit_code != 0
+       GROUP BY port, exit_code ORDER BY COUNT(*) DESC''',
+    ('PORT', 'CODE', 'RUNS', 'LAST'),
+  ),
+}
+
+
+class FlashHistory(object):
+
+    '''
+    Журнал загрузок прошивки. Каждая загрузка добавляет в базу одну запись; соединение с базой открывается на время
+    операции, поэтому объект может использоваться из нескольких потоков (в многопортовом режиме и в режиме сервера)
+    '''
+
+    ## Время ожидания освобождения базы, заблокированной другим процессом, с
+    _LOCK_TIMEOUT = 10
+
+    def __init__(self, filename):
+        '''
+        Конструктор
+
+        @param self      Ссылка на экземпляр класса
+        @param filename  Имя файла базы данных [string]
+        '''
+
+        self._filename = filename
+
+    def _connect(self):
+        '''
+        Открывает базу данных, создавая ее при необходимости
+
+        @param self    Ссылка на экземпляр класса
+        @return Соединение с базой [sqlite3.Connection]
+        '''
+
+        directory = os.path.dirname(self._filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(self._filename, timeout=self._LOCK_TIMEOUT)
+        connection.executescript(_SCHEMA)
+        return connection
+
+    def addRun(self, port, device_id, loader, exit_code, baud=None):
+        '''
+        Добавляет в журнал запись о загрузке прошивки. Ошибки работы с базой не прерывают работу приложения
+
+        @param self       Ссылка на экземпляр класса
+        @param port       Имя порта [string]
+        @param device_id  Идентификатор устройства [string]
+        @param loader     Объект bootloader, выполнивший загрузку [bootloader]
+        @param exit_code  Код завершения загрузки [int]
+        @param baud       Скорость порта [int]
+        @return Признак успешного добавления записи [bool]
+        '''
+
+        pic_type, family = loader.picType()
+        metrics = loader.metrics
+        phases = dict(metrics.phases)
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute(
+                      '''INSERT INTO runs (timestamp, port, device_id, pic_type, family, firmware_hash, baud, reset_method,
+                                           duration, transfer_time, rows, bytes, retries, exit_code, phases)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (time.time(), port, device_id, pic_type, family, loader.firmware_hash, baud, loader.reset_method,
+                       sum(phases.itervalues()), metrics.transfer_time, metrics.rows, metrics.bytes, metrics.retries,
+                       exit_code, json.dumps(phases, sort_keys=True))
+                    )
+            finally:
+                connection.close()
+        except (sqlite3.Error, OSError):
+            logger.warning("Failed to add run to history '{}' due to {} exception ({})".format(
+              self._filename, *sys.exc_info()[:2]))
+            return False
+
+        return True
+
+    def report(self, name, since):
+        '''
+        Формирует отчет по записям журнала
+
+        @param self    Ссылка на экземпляр класса
+        @param name    Имя отчета (ключ REPORTS) [string]
+        @param since   Начало интервала (значение time.time()) [float]
+        @return Заголовки столбцов и строки отчета [tuple(tuple, list)]
+        '''
+
+        _, query, columns = REPORTS[name]
+        connection = self._connect()
+        try:
+            return columns, connection.execute(query, (since, )).fetchall()
+        finally:
+            connection.close()
+
+
+def formatReport(columns, rows):
+    '''
+    Форматирует отчет в виде таблицы
+
+    @param columns  Заголовки столбцов [tuple]
+    @param rows     Строки отчета [list]
+    @return Текст [string]
+    '''
+
+    def cell(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return '{:.2f}'.format(value)
+        return unicode(value)
+
+    table = [columns] + [tuple(cell(value) for value in row) for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in xrange(len(columns))]
+    return ''.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n' for row in table)
@@ -0,0 +1,110 @@
+# coding: utf-8
+'''
+@package app.intelhex
+Bootloader для микроконтроллеров PIC: разбор файлов прошивки в формате Intel HEX
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import binascii
+from lib.myexception import MyException
+
+
+## Запись данных
+REC_DATA = 0x00
+## Запись конца файла
+REC_EOF = 0x01
+## Запись расширенного адреса сегмента
+REC_EXT_SEGMENT_ADDR = 0x02
+## Запись стартового адреса сегмента
+REC_START_SEGMENT_ADDR = 0x03
+## Запись расширенного линейного адреса
+REC_EXT_LINEAR_ADDR = 0x04
+## Запись стартового линейного адреса
+REC_START_LINEAR_ADDR = 0x05
+
+
+class HexRecordError(MyException):
+
+    '''
+    Класс исключений для ситуации, когда запись hex-файла имеет неверный формат
+    '''
+
+    ## Номер строки hex-файла, содержащей ошибочную запись
+    line_number = None
+
+    def __init__(self, line_number, message):
+        '''
+        Конструктор
+
+        @param self         Ссылка на экземпляр класса
+        @param line_number  Номер строки hex-файла (начиная с 1) [int]
+        @param message      Описание ошибки [string]
+        '''
+
+        self.line_number = line_number
+        MyException.__init__(self, "line {}: {}".format(line_number, message))
+
+
+def decodeRecord(line, line_number=None):
+    '''
+    Декодирует одну запись (строку) hex-файла
+
+    @param line         Строка hex-файла [string]
+    @param line_number  Номер строки (используется в сообщениях об ошибках) [int]
+    @return Кортеж (тип записи, адрес, данные) [tuple(int, int, bytearray)] или None, если строка пустая либо является комментарием
+    @raise HexRecordError  Если формат записи неверный или не совпадает контрольная сумма
+    '''
+
+    line = line.strip()
+    # Пустая строка или комментарий?
+    if not line or line[0] == ';':
+        return None
+    # Некорректное начало записи?
+    if line[0] != ':':
+        raise HexRecordError(line_number, "record does not start with ':'")
+
+    # Преобразуем запись из текстового шестнадцатеричного вида в байты за один шаг
+    try:
+        raw = bytearray(binascii.unhexlify(line[1:]))
+    except (TypeError, ValueError, binascii.Error):
+        raise HexRecordError(line_number, "record contains non-hexadecimal characters or odd number of digits")
+
+    # Запись должна содержать как минимум длину, адрес, тип и контрольную сумму
+    if len(raw) < 5:
+        raise HexRecordError(line_number, "record is too short")
+    # Длина записи не соответствует количеству байт данных?
+    if len(raw) != raw[0] + 5:
+        raise HexRecordError(line_number, "byte count {} does not match record length".format(raw[0]))
+    # Сумма всех байт записи, включая контрольную сумму, должна быть равна нулю
+    if sum(raw) & 255:
+        raise HexRecordError(line_number, "checksum mismatch")
+
+    return raw[3], (raw[1] << 8) | raw[2], raw[4:-1]
+
+
+def iterRecords(lines):
+    '''
+    Перебирает записи hex-файла до записи конца файла
+
+    @param lines  Строки hex-файла [iterable]
+    @return Генератор кортежей (номер строки, тип записи, адрес, данные)
+    @raise HexRecordError  Если формат какой-либо записи неверный
+    '''
+
+    for line_number, line in enumerate(lines, 1):
+        record = decodeRecord(line, line_number)
+        # Пропускаем пустые строки и комментарии
+        if record is None:
+            continue
+        record_type, address, data = record
+        # Конец файла?
+        if record_type == REC_EOF:
+            return
+        yield line_number, record_type, address, data
@@ -0,0 +1,132 @@
+# coding: utf-8
+'''
+@package app.ledger
+Bootloader для микроконтроллеров PIC: журнал содержимого ПЗУ устройств для разностной (delta) загрузки прошивки
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import hashlib
+import os
+from lib.statefile import safeName, loadState, saveState, removeState
+
+
+def rowHash(data):
+    '''
+    Возвращает хэш данных строки образа
+
+    @param data  Данные строки [bytearray]
+    @return Хэш [string]
+    '''
+
+    return hashlib.sha1(bytes(data)).hexdigest()[:20]
+
+
+def imageRowHashes(image, row_limit):
+    '''
+    Возвращает хэши всех заполненных строк образа, доступных для записи
+
+    @param image      Образ ПЗУ МК [FlashImage]
+    @param row_limit  Количество строк, доступных для записи [int]
+    @return Хэши строк в виде {номер строки:хэш} [dict]
+    '''
+
+    return dict((row, rowHash(image.row(row))) for row in image.rows() if row < row_limit)
+
+
+def diffImages(old_image, new_image, row_limit):
+    '''
+    Сравнивает два образа построчно
+
+    @param old_image  Исходный образ ПЗУ МК [FlashImage]
+    @param new_image  Новый образ ПЗУ МК [FlashImage]
+    @param row_limit  Количество строк, доступных для записи [int]
+    @return Номера строк в виде (измененные, добавленные, удаленные, неизмененные) [tuple(list, list, list, list)]
+    '''
+
+    old_rows = imageRowHashes(old_image, row_limit)
+    new_rows = imageRowHashes(new_image, row_limit)
+
+    changed = sorted(row for row in new_rows if row in old_rows and new_rows[row] != old_rows[row])
+    added = sorted(row for row in new_rows if row not in old_rows)
+    removed = sorted(row for row in old_rows if row not in new_rows)
+    unchanged = sorted(row for row in new_rows if old_rows.get(row) == new_rows[row])
+
+    return changed, added, removed, unchanged
+
+
+class FlashLedger(object):
+
+    '''
+    Журнал содержимого ПЗУ устройства: хэши строк, записанных в ПЗУ при последней успешной загрузке прошивки.
+    Хранится в отдельном файле для каждого устройства (идентифицируется именем порта или заданным идентификатором).
+    Перед началом загрузки журнал удаляется, после успешной загрузки -- сохраняется заново, поэтому прерванная загрузка
+    приводит к полной перезаписи при следующем запуске
+    '''
+
+    def __init__(self, directory, device_id):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param directory  Каталог для хранения журналов [string]
+        @param device_id  Идентификатор устройства (имя порта или заданный в настройках идентификатор) [string]
+        '''
+
+        self._device_id = device_id
+        self._filename = os.path.join(directory, 'ledger', safeName(device_id) + '.json')
+
+    def load(self, pic_type, max_flash):
+        '''
+        Загружает хэши строк, записанных в ПЗУ устройства
+
+        @param self       Ссылка на экземпляр класса
+        @param pic_type   Тип МК, обнаруженного на устройстве [string]
+        @param max_flash  Максимальный адрес ПЗУ МК [int]
+        @return Хэши строк в виде {номер строки:хэш} [dict]; пустой, если журнал отсутствует или относится к другому МК
+        '''
+
+        state = loadState(self._filename, {})
+        if not state:
+            return {}
+        if state.get('type') != pic_type or state.get('max_flash') != max_flash:
+            logger.warning("Flash ledger of device '{}' belongs to another PIC type, ignoring".format(self._device_id))
+            return {}
+
+        return dict((int(row), value) for row, value in state.get('rows', {}).iteritems())
+
+    def invalidate(self):
+        '''
+        Удаляет журнал устройства (перед изменением содержимого ПЗУ). Удаление сбрасывается на диск до возврата:
+        иначе после отключения питания во время загрузки прежний журнал мог бы вернуться, и при разностной загрузке
+        были бы пропущены строки, запись которых не завершена
+
+        @param self       Ссылка на экземпляр класса
+        '''
+
+        removeState(self._filename)
+
+    def save(self, pic_type, max_flash, rows, firmware_hash=None):
+        '''
+        Сохраняет журнал устройства
+
+        @param self           Ссылка на экземпляр класса
+        @param pic_type       Тип МК [string]
+        @param max_flash      Максимальный адрес ПЗУ МК [int]
+        @param rows           Хэши строк в виде {номер строки:хэш} [dict]
+        @param firmware_hash  Хэш загруженного hex-файла [string]
+        '''
+
+        if saveState(self._filename, {
+            'type': pic_type,
+            'max_flash': max_flash,
+            'firmware': firmware_hash,
+            'rows': dict((str(row), value) for row, value in rows.iteritems()),
+        }):
+            logger.debug("Flash ledger of device '{}' saved ({} rows)".format(self._device_id, len(rows)))
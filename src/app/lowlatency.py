@@ -0,0 +1,187 @@
+# coding: utf-8
+'''
+@package app.lowlatency
+Bootloader для микроконтроллеров PIC: настройка последовательного порта Linux для уменьшения задержки приема
+(режим ASYNC_LOW_LATENCY драйвера, таймер задержки приема USB-преобразователей FTDI)
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import array
+import fcntl
+import os
+
+
+## Коды ioctl чтения и установки параметров последовательного порта (linux/include/uapi/asm-generic/ioctls.h)
+_TIOCGSERIAL = 0x541E
+_TIOCSSERIAL = 0x541F
+## Флаг режима низкой задержки в поле flags структуры serial_struct
+_ASYNC_LOW_LATENCY = 1 << 13
+## Индекс поля flags в структуре serial_struct (поля type, line, port, irq предшествуют ему)
+_FLAGS_INDEX = 4
+## Размер буфера для структуры serial_struct (в значениях int; с запасом)
+_SERIAL_STRUCT_SIZE = 32
+## Шаблон пути к таймеру задержки приема USB-преобразователя FTDI в sysfs
+_LATENCY_TIMER_PATH = '/sys/bus/usb-serial/devices/{}/latency_timer'
+
+
+class LowLatencyTuning(object):
+
+    '''
+    Настройка открытого последовательного порта для уменьшения задержки приема. Каждая настройка применяется, только если
+    она поддерживается драйвером и у процесса достаточно прав; неподдерживаемые настройки пропускаются. Исходные значения
+    запоминаются и восстанавливаются при закрытии порта
+    '''
+
+    def __init__(self, port, latency_timer=1, buffer_size=None):
+        '''
+        Конструктор
+
+        @param self           Ссылка на экземпляр класса
+        @param port           Открытый последовательный порт [serial.Serial]
+        @param latency_timer  Значение таймера задержки приема FTDI, мс [int] или None (не изменяется)
+        @param buffer_size    Размер буферов приема и передачи драйвера, байт [int] или None (не изменяется)
+        '''
+
+        self._port = port
+        self._latency_timer = latency_timer
+        self._buffer_size = buffer_size
+        ## Исходные значения измененных настроек: флаги serial_struct, путь и значение таймера задержки
+        self._saved_flags = None
+        self._saved_timer = None
+        ## Описание выполненных изменений [list]
+        self.changes = []
+
+    def apply(self):
+        '''
+        Применяет настройки
+
+        @param self    Ссылка на экземпляр класса
+        @return Описание выполненных изменений [list]
+        '''
+
+        self._setLowLatency()
+        self._setLatencyTimer()
+        self._setBufferSize()
+        if self.changes:
+            logger.info("Serial port '{}' tuned for low latency: {}".format(self._port.port, '; '.join(self.changes)))
+        else:
+            logger.info("Serial port '{}': no low latency tuning applied".format(self._port.port))
+        return self.changes
+
+    def restore(self):
+        '''
+        Восстанавливает исходные значения измененных настроек (вызывается перед закрытием порта)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if self._saved_flags is not None:
+            try:
+                self._ioctlFlags(self._saved_flags)
+            except (IOError, OSError), e:
+                logger.warning("Failed to restore serial port flags ({})".format(e))
+            self._saved_flags = None
+        if self._saved_timer is not None:
+            path, value = self._saved_timer
+            try:
+                with open(path, 'w') as f:
+                    f.write(value)
+            except IOError, e:
+                logger.warning("Failed to restore '{}' ({})".format(path, e))
+            self._saved_timer = None
+
+    def _ioctlFlags(self, flags=None):
+        '''
+        Читает (и при необходимости устанавливает) флаги драйвера последовательного порта
+
+        @param self    Ссылка на экземпляр класса
+        @param flags   Новые флаги [int] или None (только чтение)
+        @return Флаги до изменения [int]
+        @raise IOError  Если драйвер не поддерживает TIOCGSERIAL/TIOCSSERIAL или недостаточно прав
+        '''
+
+        fd = self._port.fileno()
+        buf = array.array('i', [0] * _SERIAL_STRUCT_SIZE)
+        fcntl.ioctl(fd, _TIOCGSERIAL, buf, True)
+        previous = buf[_FLAGS_INDEX]
+        if flags is not None:
+            buf[_FLAGS_INDEX] = flags
+            fcntl.ioctl(fd, _TIOCSSERIAL, buf)
+        return previous
+
+    def _setLowLatency(self):
+        '''
+        Включает режим ASYNC_LOW_LATENCY драйвера (данные передаются приложению без отложенной обработки)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        try:
+            flags = self._ioctlFlags()
+            if flags & _ASYNC_LOW_LATENCY:
+                logger.debug("ASYNC_LOW_LATENCY is already set")
+                return
+            self._ioctlFlags(flags | _ASYNC_LOW_LATENCY)
+        except (IOError, OSError, AttributeError), e:
+            logger.debug("ASYNC_LOW_LATENCY is not supported ({})".format(e))
+            return
+        self._saved_flags = flags
+        self.changes.append("ASYNC_LOW_LATENCY set")
+
+    def _setLatencyTimer(self):
+        '''
+        Устанавливает таймер задержки приема USB-преобразователя FTDI (по умолчанию 16 мс: принятые байты передаются
+        компьютеру не чаще одного раза за период таймера)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if self._latency_timer is None:
+            return
+        # Имя порта может быть символической ссылкой udev (например, /dev/serial/by-id/...)
+        path = _LATENCY_TIMER_PATH.format(os.path.basename(os.path.realpath(self._port.port)))
+        try:
+            with open(path) as f:
+                previous = f.read().strip()
+        except IOError:
+            logger.debug("Latency timer is not supported by '{}'".format(self._port.port))
+            return
+        if previous == str(self._latency_timer):
+            logger.debug("Latency timer is already {} ms".format(previous))
+            return
+        try:
+            with open(path, 'w') as f:
+                f.write(str(self._latency_timer))
+        except IOError, e:
+            logger.warning("Failed to set latency timer of '{}' ({})".format(self._port.port, e))
+            return
+        self._saved_timer = (path, previous)
+        self.changes.append("latency timer {} -> {} ms".format(previous, self._latency_timer))
+
+    def _setBufferSize(self):
+        '''
+        Устанавливает размер буферов драйвера (поддерживается pyserial только в Windows; в Linux размер буферов tty
+        фиксирован)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if not self._buffer_size:
+            return
+        set_buffer_size = getattr(self._port, 'set_buffer_size', None) or getattr(self._port, 'setBufferSize', None)
+        if not set_buffer_size:
+            logger.debug("Setting driver buffer size is not supported on this platform")
+            return
+        try:
+            set_buffer_size(rx_size=self._buffer_size, tx_size=self._buffer_size)
+        except (IOError, OSError, ValueError), e:
+            logger.debug("Failed to set driver buffer size ({})".format(e))
+            return
+        self.changes.append("driver buffers {} bytes".format(self._buffer_size))
@@ -0,0 +1,245 @@
+# coding: utf-8
+'''
+@package app.metrics
+Bootloader для микроконтроллеров PIC: метрики загрузки прошивки (длительность этапов, задержка подтверждений,
+скорость передачи) и их сохранение в формате JSON и в текстовом формате Prometheus (node_exporter textfile collector)
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import bisect
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+class FlashMetrics(object):
+
+    '''
+    Метрики одного запуска загрузки прошивки в устройство
+    '''
+
+    ## Верхние границы интервалов гистограммы задержки подтверждения записи строки, с
+    ACK_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+    def __init__(self):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        ## Длительность этапов в порядке их первого выполнения: [(этап, с), ...]
+        self.phases = []
+        ## Количество подтверждений по интервалам гистограммы (последний элемент -- сверх последней границы)
+        self.ack_counts = [0] * (len(self.ACK_BUCKETS) + 1)
+        ## Суммарная задержка подтверждений, с
+        self.ack_sum = 0.0
+        ## Количество переданных строк
+        self.rows = 0
+        ## Количество переданных байт
+        self.bytes = 0
+        ## Время передачи строк, с
+        self.transfer_time = 0.0
+        ## Количество повторных отправок кадров
+        self.retries = 0
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Измеряет длительность этапа (повторные измерения одного этапа суммируются)
+
+        @param self    Ссылка на экземпляр класса
+        @param name    Имя этапа [string]
+        '''
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.addPhase(name, time.time() - started)
+
+    def addPhase(self, name, duration):
+        '''
+        Учитывает длительность этапа
+
+        @param self      Ссылка на экземпляр класса
+        @param name      Имя этапа [string]
+        @param duration  Длительность, с [float]
+        '''
+
+        for i, (phase, total) in enumerate(self.phases):
+            if phase == name:
+                self.phases[i] = (phase, total + duration)
+                return
+        self.phases.append((name, duration))
+
+    def observeAck(self, latency):
+        '''
+        Учитывает задержку подтверждения записи строки
+
+        @param self     Ссылка на экземпляр класса
+        @param latency  Время от отправки кадра до получения подтверждения, с [float]
+        '''
+
+        self.ack_counts[bisect.bisect_left(self.ACK_BUCKETS, latency)] += 1
+        self.ack_sum += latency
+
+    def addTransfer(self, stats):
+        '''
+        Учитывает статистику передачи строк
+
+        @param self     Ссылка на экземпляр класса
+        @param stats    Статистика передачи [TransferStats]
+        '''
+
+        self.rows += stats.rows
+        self.bytes += stats.bytes
+        self.transfer_time += stats.elapsed
+        self.retries += stats.retries
+
+    def summary(self):
+        '''
+        Возвращает метрики в виде словаря (для сохранения в JSON)
+
+        @param self    Ссылка на экземпляр класса
+        @return Метрики [dict]
+        '''
+
+        acks = sum(self.ack_counts)
+        return {
+          'phases': dict(self.phases),
+          'rows': self.rows,
+          'bytes': self.bytes,
+          'transfer_time': self.transfer_time,
+          'bytes_per_second': self.bytes / self.transfer_time if self.transfer_time else 0.0,
+          'retries': self.retries,
+          'ack_latency': {
+            'count': acks,
+            'mean': self.ack_sum / acks if acks else 0.0,
+            'buckets': dict(
+              [(str(bound), count) for bound, count in zip(self.ACK_BUCKETS, self.ack_counts)] + [('+Inf', self.ack_counts[-1])]
+            ),
+          },
+        }
+
+
+def _formatLabels(labels):
+    '''
+    Формирует перечень меток метрики в текстовом формате Prometheus
+
+    @param labels  Метки [dict]
+    @return Строка вида {имя="значение",...} [string]
+    '''
+
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.iteritems())) + '}'
+
+
+def formatTextfile(runs):
+    '''
+    Формирует метрики нескольких запусков в текстовом формате Prometheus
+
+    @param runs  Запуски в виде списка кортежей (метки, метрики, код завершения) [list of (dict, FlashMetrics, int)]
+    @return Текст [string]
+    '''
+
+    # Значения группируются по именам метрик: {имя:(тип, описание, [(метки, значение), ...])}
+    families = []
+    index = {}
+
+    def add(name, kind, description, labels, value):
+        if name not in index:
+            index[name] = (kind, description, [])
+            families.append(name)
+        index[name][2].append((labels, value))
+
+    now = time.time()
+    for labels, metrics, exit_code in runs:
+        for phase, duration in metrics.phases:
+            add('pic_loader_phase_duration_seconds', 'gauge', 'Duration of flashing phase',
+                dict(labels, phase=phase), duration)
+        cumulative = 0
+        for bound, count in zip(metrics.ACK_BUCKETS + ('+Inf', ), metrics.ack_counts):
+            cumulative += count
+            add('pic_loader_row_ack_latency_seconds_bucket', 'histogram', 'Time from sending row frame to acknowledgement',
+                dict(labels, le=bound), cumulative)
+        add('pic_loader_row_ack_latency_seconds_sum', None, None, labels, metrics.ack_sum)
+        add('pic_loader_row_ack_latency_seconds_count', None, None, labels, cumulative)
+        add('pic_loader_rows_sent', 'gauge', 'Rows sent to PIC', labels, metrics.rows)
+        add('pic_loader_bytes_sent', 'gauge', 'Bytes sent to PIC including frame overhead', labels, metrics.bytes)
+        add('pic_loader_throughput_bytes_per_second', 'gauge', 'Row transfer throughput', labels,
+            metrics.bytes / metrics.transfer_time if metrics.transfer_time else 0.0)
+        add('pic_loader_write_retries', 'gauge', 'Row frames sent again after missing acknowledgement', labels, metrics.retries)
+        add('pic_loader_exit_code', 'gauge', 'Exit code of last flashing', labels, exit_code)
+        add('pic_loader_last_run_timestamp_seconds', 'gauge', 'Time of last flashing', labels, now)
+
+    lines = []
+    for name in families:
+        kind, description, samples = index[name]
+        if kind:
+            family = name[:-len('_bucket')] if kind == 'histogram' else name
+            lines.append('# HELP {} {}'.format(family, description))
+            lines.append('# TYPE {} {}'.format(family, kind))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, _formatLabels(labels), repr(float(value)) if isinstance(value, float) else value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def writeFile(filename, content):
+    '''
+    Атомарно записывает файл метрик (node_exporter не должен прочитать файл частично)
+
+    @param filename  Имя файла [string]
+    @param content   Содержимое [string]
+    @return Признак успешной записи [bool]
+    '''
+
+    directory = os.path.dirname(filename) or '.'
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_filename, 0644)
+            os.rename(tmp_filename, filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+    except (IOError, OSError):
+        logger.warning("Failed to write metrics to '{}' due to {} exception ({})".format(filename, *sys.exc_info()[:2]))
+        return False
+
+    return True
+
+
+def summaryJson(runs):
+    '''
+    Формирует сводку метрик нескольких запусков в формате JSON
+
+    @param runs  Запуски в виде списка кортежей (метки, метрики, код завершения) [list of (dict, FlashMetrics, int)]
+    @return Текст [string]
+    '''
+
+    summaries = []
+    for labels, metrics, exit_code in runs:
+        summary = metrics.summary()
+        summary.update(labels)
+        summary['exit_code'] = exit_code
+        summaries.append(summary)
+
+    return json.dumps({'timestamp': time.time(), 'runs': summaries}, indent=2, sort_keys=True) + '\n'
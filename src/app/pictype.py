@@ -1,87 +1,169 @@
 # coding: utf-8
 '''
 @package app.pictype
-Bootloader для микроконтроллеров PIC: определение модели PIC
+Bootloader для микроконтроллеров PIC: определение модели PIC по базе данных моделей (файл pic_devices.yaml)
+
+@author Denis Shatov
 '''
 
 
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import os
+import threading
+import yaml
+from lib.myexception import MyException
+
+
+## Имя файла базы данных моделей МК, поставляемого вместе с приложением
+DATABASE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pic_devices.yaml')
+
+
+class DeviceDatabaseError(MyException):
+
+    '''
+    Ошибка чтения базы данных моделей МК
+    '''
+
+    pass
+
+
+class PicDevice(object):
+
+    '''
+    Параметры модели МК: размеры ПЗУ и строки записи, размещение загрузчика, формат адреса в кадре записи,
+    области адресного пространства hex-файла. Размеры и адреса задаются в адресации hex-файла (в байтах)
+    '''
+
+    def __init__(self, device_id, params):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param device_id  Код модели МК, передаваемый загрузчиком в ответ на запрос 0xC1 [int]
+        @param params     Параметры модели с учетом параметров семейства (см. pic_devices.yaml) [dict]
+        @raise KeyError   Если не задан обязательный параметр
+        '''
+
+        ## Код модели
+        self.device_id = device_id
+        ## Название модели
+        self.name = params['name']
+        ## Семейство
+        self.family = params['family']
+        ## Максимальный адрес ПЗУ (в словах для 16F, в байтах для 18F)
+        self.max_flash = params['max-flash']
+        ## Длина адреса в кадре записи, байт
+        self.address_bytes = params['address-bytes']
+        ## Признак задания адреса в кадре записи в словах (2 байта hex-файла)
+        self.word_addressing = params['word-addressing']
+        ## Размер строки записи, байт
+        self.row_size = params['row-size']
+        ## Размер области загрузчика в конце ПЗУ, байт
+        self.bootloader_size = params['bootloader-size']
+        ## Размер перемещенного вектора сброса, байт
+        self.vector_size = params['vector-size']
+        ## Маска значащих бит слова ПЗУ (стертое слово имеет значение маски)
+        self.word_mask = params.get('word-mask', 0xFFFF)
+        ## Размер ПЗУ, байт
+        self.flash_size = 2 * self.max_flash if self.word_addressing else self.max_flash
+        ## Области адресного пространства hex-файла {имя: (начальный адрес, конечный адрес)}
+        self.regions = dict((name, tuple(bounds)) for name, bounds in (params.get('regions') or {}).iteritems())
+        self.regions['flash'] = (0, self.flash_size)
+        ## Области, запись которых поддерживается загрузчиком
+        self.writable = tuple(params.get('writable') or ('flash', ))
+
+    def bootloaderAddr(self):
+        '''
+        Возвращает начальный адрес области загрузчика (адрес перемещенного вектора сброса)
+
+        @param self    Ссылка на экземпляр класса
+        @return Адрес, байт [int]
+        '''
+
+        return self.flash_size - self.bootloader_size
+
+    def region(self, addr):
+        '''
+        Определяет область адресного пространства hex-файла, в которую попадает адрес
+
+        @param self    Ссылка на экземпляр класса
+        @param addr    Адрес в hex-файле [int]
+        @return Имя области [string] или None, если адрес не попадает ни в одну из областей
+        '''
+
+        for name, (start, end) in self.regions.iteritems():
+            if start <= addr < end:
+                return name
+        return None
+
+
+## Модели МК, загруженные из базы данных {код модели: PicDevice} (загружаются при первом обращении)
+_devices = None
+## Блокировка загрузки базы данных (обращения возможны из нескольких потоков)
+_devices_lock = threading.Lock()
+
+
+def loadDevices(filename=DATABASE_FILENAME):
+    '''
+    Загружает базу данных моделей МК
+
+    @param filename  Имя файла базы данных [string]
+    @return Модели МК {код модели: PicDevice} [dict]
+    @raise DeviceDatabaseError  Если файл не удалось прочитать или его содержимое неверно
+    '''
+
+    try:
+        with open(filename) as f:
+            database = yaml.safe_load(f)
+        families = database.get('families') or {}
+        devices = {}
+        for device_id, device_params in (database.get('devices') or {}).iteritems():
+            # Параметры модели дополняют (и переопределяют) параметры ее семейства
+            params = dict(families[device_params['family']])
+            params.update(device_params)
+            devices[int(device_id)] = PicDevice(int(device_id), params)
+    except (IOError, yaml.YAMLError), e:
+        logger.error("Failed to read PIC device database '{}' ({})".format(filename, e))
+        raise DeviceDatabaseError("Failed to read PIC device database", initial_exc=e)
+    except (AttributeError, KeyError, TypeError, ValueError), e:
+        logger.error("Wrong format of PIC device database '{}' ({}: {})".format(filename, type(e).__name__, e))
+        raise DeviceDatabaseError("Wrong format of PIC device database", initial_exc=e)
+
+    logger.debug("Loaded {} PIC models from '{}'".format(len(devices), filename))
+    return devices
+
+
+def pic_device(pt):
+    '''
+    Возвращает параметры модели МК по коду, переданному загрузчиком
+
+    @param pt      Код модели МК [int]
+    @return Параметры модели [PicDevice] или None, если модель неизвестна
+    @raise DeviceDatabaseError  Если не удалось загрузить базу данных моделей МК
+    '''
+
+    global _devices
+    if _devices is None:
+        with _devices_lock:
+            if _devices is None:
+                _devices = loadDevices()
+    return _devices.get(pt)
+
+
 def pic_type(pt):
+    '''
+    Возвращает название, максимальный адрес ПЗУ и семейство модели МК по коду, переданному загрузчиком
 
-    if pt == 0x31:
-        PicType = "16F 876A/877A"
-        max_flash = 0x2000
-    elif pt == 0x32:
-        PicType = "16F 873A/874A"
-        max_flash = 0x1000
-    elif pt == 0x33:
-        PicType = "16F 87/F88"
-        max_flash = 0x1000
-    elif pt == 0x36:
-        PicType = "16F 882/883/884/886/887"
-        max_flash = 0x2000
-        # Объем ПЗУ, слов
-    elif pt == 0x41:
-        PicType = "18F 252o/452o"
-        max_flash = 0x8000
-    elif pt == 0x42:
-        PicType = "18F 242o/442o"
-        max_flash = 0x4000
-    elif pt == 0x43:
-        PicType = "18F 258/458"
-        max_flash = 0x8000
-    elif pt == 0x44:
-        PicType = "18F 248/448"
-        max_flash = 0x4000
-    elif pt == 0x45:
-        PicType = "18F 1320/2320"
-        max_flash = 0x2000
-    elif pt == 0x46:
-        PicType = "18F 1220/2220"
-        max_flash = 0x1000
-    elif pt == 0x47:
-        PicType = "18F 4320"
-        max_flash = 0x2000
-    elif pt == 0x48:
-        PicType = "18F 4220"
-        max_flash = 0x1000
-    elif pt == 0x4A:
-        PicType = "18F 6720/8720"
-        max_flash = 0x20000
-    elif pt == 0x4B:
-        PicType = "18F 6620/8620"
-        max_flash = 0x10000
-    elif pt == 0x4C:
-        PicType = "18F 6520/8520"
-        max_flash = 0x8000
-    elif pt == 0x4D:
-        PicType = "18F 8680"
-        max_flash = 0x10000
-    elif pt == 0x4E:
-        PicType = "18F 2525/4525"
-        max_flash = 0xC000
-    elif pt == 0x4F:
-        PicType = "18F 2620/4620"
-        max_flash = 0x10000
-    elif pt == 0x55:
-        PicType = "18F 2550/4550"
-        max_flash = 0x8000
-    elif pt == 0x56:
-        PicType = "18F 2455/4455"
-        max_flash = 0x6000
-    else:
-        PicType = None
-        max_flash = None
-
-    family = None
-
-    if (pt == 0x31) or (pt == 0x32) or (pt == 0x36):
-        family = "16F8XX"
-
-    elif (pt == 0x33):
-        family = "16F8X"
-
-    elif (pt > 0x40) and (pt < 0x60):
-        family = "18F"
-
-    return PicType, max_flash, family
+    @param pt      Код модели МК [int]
+    @return Название модели, максимальный адрес ПЗУ (в словах для 16F, в байтах для 18F) и семейство
+            [tuple(string, int, string)]; (None, None, None), если модель неизвестна
+    '''
 
+    device = pic_device(pt)
+    if device is None:
+        return None, None, None
+    return device.name, device.max_flash, device.family
@@ -0,0 +1,93 @@
+# coding: utf-8
+'''
+@package app.resetmemory
+Bootloader для микроконтроллеров PIC: запоминание способа перевода МК в режим загрузчика, сработавшего при последней
+загрузке прошивки в устройство
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import os
+from lib.statefile import safeName, loadState, saveState
+
+
+class ResetMemory(object):
+
+    '''
+    Способ перевода МК в режим загрузчика (обнаружение работающего загрузчика, сброс командой, аппаратный сброс),
+    сработавший при последней загрузке прошивки в устройство, и доля загрузок, при которых запомненный способ сработал
+    с первой попытки. Хранится в отдельном файле для каждого устройства
+    '''
+
+    def __init__(self, directory, device_id):
+        '''
+        Конструктор
+
+        @param self       Ссылка на экземпляр класса
+        @param directory  Каталог для хранения состояния устройств [string]
+        @param device_id  Идентификатор устройства (имя порта или заданный в настройках идентификатор) [string]
+        '''
+
+        self._device_id = device_id
+        self._filename = os.path.join(directory, 'reset', safeName(device_id) + '.json')
+        self._state = loadState(self._filename, {})
+
+    def lastMethod(self):
+        '''
+        Возвращает способ, сработавший при последней загрузке
+
+        @param self     Ссылка на экземпляр класса
+        @return Имя способа [string] или None
+        '''
+
+        return self._state.get('method')
+
+    def order(self, methods):
+        '''
+        Упорядочивает способы перевода МК в режим загрузчика: запомненный способ -- первым, остальные -- в исходном порядке
+
+        @param self     Ссылка на экземпляр класса
+        @param methods  Имена способов в порядке по умолчанию [list]
+        @return Имена способов в порядке выполнения [list]
+        '''
+
+        method = self.lastMethod()
+        if method not in methods:
+            return list(methods)
+        return [method] + [name for name in methods if name != method]
+
+    def update(self, method):
+        '''
+        Запоминает результат перевода МК в режим загрузчика и учитывает его в доле попаданий
+
+        @param self     Ссылка на экземпляр класса
+        @param method   Сработавший способ [string] или None, если не сработал ни один
+        '''
+
+        remembered = self.lastMethod()
+        # Доля попаданий учитывается, только если способ был запомнен ранее
+        if remembered:
+            self._state['attempts'] = self._state.get('attempts', 0) + 1
+            self._state['hits'] = self._state.get('hits', 0) + (method == remembered)
+        if method:
+            self._state['method'] = method
+        if saveState(self._filename, self._state):
+            logger.debug("Reset method of device '{}' is '{}', hit rate {}/{}".format(
+              self._device_id, self.lastMethod(), self._state.get('hits', 0), self._state.get('attempts', 0)))
+
+    def hitRate(self):
+        '''
+        Возвращает долю загрузок, при которых запомненный способ сработал с первой попытки
+
+        @param self     Ссылка на экземпляр класса
+        @return Доля попаданий [float] или None, если статистика отсутствует
+        '''
+
+        attempts = self._state.get('attempts', 0)
+        return float(self._state.get('hits', 0)) / attempts if attempts else None
@@ -0,0 +1,298 @@
+# coding: utf-8
+'''
+@package app.serialtrace
+Bootloader для микроконтроллеров PIC: запись обмена через последовательный порт в файл и воспроизведение записи
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import struct
+import time
+from lib.myexception import MyException
+
+
+class TraceException(MyException):
+
+    '''
+    Класс исключений для модуля
+    '''
+    pass
+
+
+class TraceFormatError(TraceException):
+
+    '''
+    Класс исключений для ситуации, когда файл записи поврежден или имеет неизвестный формат
+    '''
+    pass
+
+
+class ReplayMismatch(TraceException):
+
+    '''
+    Класс исключений для ситуации, когда данные, передаваемые в порт при воспроизведении, отличаются от записанных
+    '''
+    pass
+
+
+## Заголовок файла записи: сигнатура, версия формата, время начала записи (значение time.time())
+_HEADER = struct.Struct('<4sHd')
+_MAGIC = 'PICT'
+_VERSION = 1
+## Заголовок события: тип, время от начала записи в микросекундах, длина данных
+_EVENT = struct.Struct('<cII')
+
+## Типы событий
+EVENT_WRITE = 'W'
+EVENT_READ = 'R'
+EVENT_FLUSH = 'F'
+
+
+def readTrace(filename):
+    '''
+    Читает файл записи обмена
+
+    @param filename  Имя файла [string]
+    @return Время начала записи и события в виде кортежей (тип, время от начала записи в секундах, данные) [tuple(float, list)]
+    @raise TraceFormatError  Если файл поврежден или имеет неизвестный формат
+    '''
+
+    with open(filename, 'rb') as f:
+        content = f.read()
+
+    if len(content) < _HEADER.size:
+        raise TraceFormatError("Trace file '{}' is too short".format(filename))
+    magic, version, started = _HEADER.unpack_from(content)
+    if magic != _MAGIC or version != _VERSION:
+        raise TraceFormatError("Unknown format of trace file '{}'".format(filename))
+
+    events = []
+    offset = _HEADER.size
+    while offset < len(content):
+        if offset + _EVENT.size > len(content):
+            # Последнее событие записано не полностью (аварийное завершение) -- отбрасываем
+            logger.warning("Trace file '{}' is truncated".format(filename))
+            break
+        kind, timestamp, size = _EVENT.unpack_from(content, offset)
+        offset += _EVENT.size
+        if offset + size > len(content):
+            logger.warning("Trace file '{}' is truncated".format(filename))
+            break
+        events.append((kind, timestamp / 1e6, content[offset:offset + size]))
+        offset += size
+
+    return started, events
+
+
+class SerialRecorder(object):
+
+    '''
+    Обертка последовательного порта, записывающая в файл все данные, переданные в порт и полученные из него,
+    с отметками времени. Атрибуты и методы, не связанные с передачей данных, передаются порту без изменений
+    '''
+
+    def __init__(self, port, filename):
+        '''
+        Конструктор
+
+        @param self      Ссылка на экземпляр класса
+        @param port      Последовательный порт [serial.Serial]
+        @param filename  Имя файла записи [string]
+        '''
+
+        self._port = port
+        self._filename = filename
+        self._started = time.time()
+        # Файл без буферизации: при аварийном завершении сохраняется весь обмен до последнего события
+        self._file = open(filename, 'wb', 0)
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, self._started))
+        logger.info("Recording serial traffic to '{}'".format(filename))
+
+    def _record(self, kind, data=''):
+        '''
+        Записывает событие в файл
+
+        @param self    Ссылка на экземпляр класса
+        @param kind    Тип события [string]
+        @param data    Данные [string]
+        '''
+
+        timestamp = int((time.time() - self._started) * 1e6)
+        self._file.write(_EVENT.pack(kind, timestamp, len(data)) + data)
+
+    def write(self, data):
+        '''
+        Передает данные в порт
+
+        @param self    Ссылка на экземпляр класса
+        @param data    Данные [string]
+        '''
+
+        self._record(EVENT_WRITE, bytes(data))
+        return self._port.write(data)
+
+    def read(self, size=1):
+        '''
+        Читает данные из порта (время события -- момент завершения чтения)
+
+        @param self    Ссылка на экземпляр класса
+        @param size    Количество байт [int]
+        @return Данные [string]
+        '''
+
+        data = self._port.read(size)
+        self._record(EVENT_READ, data)
+        return data
+
+    def flushInput(self):
+        '''
+        Сбрасывает буфер чтения порта
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._record(EVENT_FLUSH)
+        self._port.flushInput()
+
+    def close(self):
+        '''
+        Закрывает порт и файл записи
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._port.close()
+        self._file.close()
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def __setattr__(self, name, value):
+        # Параметры порта (например, таймаут чтения) устанавливаются порту
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._port, name, value)
+
+
+class SerialReplay(object):
+
+    '''
+    Последовательный порт, воспроизводящий записанный обмен: чтение возвращает записанные ответы МК в исходном порядке,
+    данные, передаваемые в порт, сравниваются с записанными. Задержка ответа МК относительно предшествующей
+    передачи воспроизводится с указанным коэффициентом
+    '''
+
+    def __init__(self, filename, speed=1.0, strict=False):
+        '''
+        Конструктор
+
+        @param self      Ссылка на экземпляр класса
+        @param filename  Имя файла записи [string]
+        @param speed     Коэффициент ускорения воспроизведения [float]; 0 -- без задержек
+        @param strict    Прерывать воспроизведение при расхождении переданных данных с записанными [bool]
+        @raise TraceFormatError  Если файл поврежден или имеет неизвестный формат
+        '''
+
+        ## Имя "порта" (используется в сообщениях и метриках)
+        self.port = filename
+        self.timeout = None
+        self._speed = speed
+        self._strict = strict
+        _, events = readTrace(filename)
+        self._writes = [(timestamp, data) for kind, timestamp, data in events if kind == EVENT_WRITE]
+        self._reads = [(timestamp, data) for kind, timestamp, data in events if kind == EVENT_READ]
+        self._write_index = 0
+        self._read_index = 0
+        # Время последней передачи: по записи и фактическое
+        self._last_write = (0.0, time.time())
+        ## Количество передач, отличающихся от записанных
+        self.mismatches = 0
+        logger.info("Replaying serial traffic from '{}' ({} writes, {} reads)".format(filename, len(self._writes), len(self._reads)))
+
+    def write(self, data):
+        '''
+        Сравнивает передаваемые данные с записанными
+
+        @param self    Ссылка на экземпляр класса
+        @param data    Данные [string]
+        @raise ReplayMismatch  Если данные отличаются от записанных и задано строгое воспроизведение
+        '''
+
+        data = bytes(data)
+        if self._write_index < len(self._writes):
+            timestamp, expected = self._writes[self._write_index]
+        else:
+            timestamp, expected = self._last_write[0], None
+        self._write_index += 1
+        self._last_write = (timestamp, time.time())
+
+        if data != expected:
+            self.mismatches += 1
+            message = "Write #{} differs from trace: {} instead of {}".format(
+              self._write_index, repr(data[:16]), repr(expected[:16]) if expected is not None else 'end of trace')
+            if self._strict:
+                raise ReplayMismatch(message)
+            logger.warning(message)
+        return len(data)
+
+    def read(self, size=1):
+        '''
+        Возвращает очередной записанный ответ МК, выдерживая записанную задержку относительно последней передачи
+
+        @param self    Ссылка на экземпляр класса
+        @param size    Количество байт (не используется: возвращается записанный ответ целиком) [int]
+        @return Данные [string]; пустая строка, если записанные ответы закончились
+        '''
+
+        if not size:
+            return ''
+        if self._read_index >= len(self._reads):
+            logger.warning("Trace has no more replies")
+            return ''
+        timestamp, data = self._reads[self._read_index]
+        self._read_index += 1
+
+        if self._speed:
+            written_at, written_real = self._last_write
+            delay = written_real + max(0.0, timestamp - written_at) / self._speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def inWaiting(self):
+        '''
+        Количество принятых байт, доступных для чтения без ожидания (записанный ответ МК возвращается целиком
+        при следующем чтении)
+
+        @param self    Ссылка на экземпляр класса
+        @return Количество байт [int]
+        '''
+
+        return 0
+
+    def flushInput(self):
+        '''
+        Сброс буфера чтения (при воспроизведении не требуется)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        pass
+
+    def close(self):
+        '''
+        Завершает воспроизведение
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if self._write_index != len(self._writes) or self._read_index != len(self._reads):
+            logger.warning("Replay finished at write {} of {}, read {} of {}".format(
+              self._write_index, len(self._writes), self._read_index, len(self._reads)))
@@ -0,0 +1,178 @@
+# coding: utf-8
+'''
+@package app.transmitter
+Bootloader для микроконтроллеров PIC: подготовка кадров для передачи в МК в отдельном потоке и статистика передачи
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import sys
+import threading
+from Queue import Queue, Empty, Full
+
+
+class TransferStats(object):
+
+    '''
+    Статистика передачи прошивки: количество переданных строк, суммарное время ожидания подтверждения от загрузчика
+    и суммарное время работы хоста между получением подтверждения и отправкой следующего кадра (простой линии по вине хоста)
+    '''
+
+    def __init__(self):
+        '''
+        Конструктор
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        ## Количество переданных строк
+        self.rows = 0
+        ## Количество переданных байт (включая служебные байты кадров)
+        self.bytes = 0
+        ## Суммарное время ожидания подтверждения, с
+        self.ack_wait = 0.0
+        ## Суммарное время простоя линии из-за работы хоста, с
+        self.host_time = 0.0
+        ## Общее время передачи, с
+        self.elapsed = 0.0
+        ## Количество повторных отправок кадров
+        self.retries = 0
+        ## Количество строк, потребовавших повторной отправки
+        self.retried_rows = 0
+
+    def log(self):
+        '''
+        Выводит статистику передачи в лог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        if not self.rows:
+            return
+        logger.info("Sent {} rows ({} bytes) in {:.3f}s: ack wait {:.2f}ms/row, host work {:.2f}ms/row, {} retries in {} rows".format(
+            self.rows, self.bytes, self.elapsed, 1000 * self.ack_wait / self.rows, 1000 * self.host_time / self.rows,
+            self.retries, self.retried_rows))
+
+
+class FramePipeline(object):
+
+    '''
+    Готовит кадры для передачи в МК в отдельном потоке, пока основной поток ожидает подтверждения записи предыдущих кадров.
+    Перебор строк (в т.ч. разбор hex-файла в потоковом режиме) и формирование кадров выполняются заранее, с опережением
+    на заданное количество кадров. Исключения, возникшие в рабочем потоке, передаются в основной поток
+    '''
+
+    ## Период опроса очереди кадров, с (позволяет прерывать ожидание по Ctrl+C)
+    _POLL_INTERVAL = 0.1
+
+    def __init__(self, rows, build_frame, depth=4):
+        '''
+        Конструктор
+
+        @param self         Ссылка на экземпляр класса
+        @param rows         Строки для передачи в виде кортежей (номер строки, процент выполнения) [iterable]
+        @param build_frame  Функция формирования кадра по номеру строки [callable(row) -> (addr, bytearray)]
+        @param depth        Максимальное количество подготовленных заранее кадров [int]
+        '''
+
+        self._rows = rows
+        self._build_frame = build_frame
+        self._queue = Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name='FramePipeline')
+        self._thread.daemon = True
+
+    def _put(self, item):
+        '''
+        Помещает элемент в очередь, ожидая освобождения места, пока не запрошена остановка
+
+        @param self    Ссылка на экземпляр класса
+        @param item    Элемент очереди
+        @return False, если запрошена остановка [bool]
+        '''
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, True, self._POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _worker(self):
+        '''
+        Функция рабочего потока: формирует кадры и помещает их в очередь. Окончание передачи обозначается элементом None,
+        ошибка -- кортежем с информацией об исключении
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        try:
+            for row, percentage in self._rows:
+                addr, frame = self._build_frame(row)
+                if not self._put((row, addr, bytes(frame), percentage)):
+                    return
+        except:
+            self._put(('error', sys.exc_info()))
+            return
+        self._put(None)
+
+    def __iter__(self):
+        '''
+        Перебирает подготовленные кадры
+
+        @param self    Ссылка на экземпляр класса
+        @return Генератор кортежей (номер строки, адрес, кадр, процент выполнения)
+        '''
+
+        self._thread.start()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(True, self._POLL_INTERVAL)
+                except Empty:
+                    continue
+                if item is None:
+                    return
+                if item[0] == 'error':
+                    exc_type, exc_value, exc_tb = item[1]
+                    raise exc_type, exc_value, exc_tb
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Останавливает рабочий поток
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+## Оценка задержки получения подтверждения записи строки (задержка USB-последовательного адаптера и время записи в ПЗУ), с
+DEFAULT_ACK_LATENCY = 0.02
+
+
+def estimateTransferTime(rows, frame_size, baud, ack_latency=DEFAULT_ACK_LATENCY):
+    '''
+    Оценивает время передачи строк образа в МК
+
+    @param rows         Количество строк [int]
+    @param frame_size   Размер кадра (включая адрес, длину и контрольную сумму), байт [int]
+    @param baud         Скорость порта [int]
+    @param ack_latency  Задержка получения подтверждения записи строки, с [float]
+    @return Время передачи, с [float]
+    '''
+
+    # Каждый байт передается 10 битами (старт-бит, 8 бит данных, стоп-бит)
+    return rows * (frame_size * 10.0 / baud + ack_latency)
@@ -0,0 +1,116 @@
+# coding: utf-8
+'''
+@package statefile
+Функции хранения состояния приложения между запусками в файлах формата JSON
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+import json
+import os
+import re
+import sys
+import tempfile
+
+
+def safeName(name):
+    '''
+    Преобразует произвольную строку (например, имя последовательного порта) в имя файла
+
+    @param name  Исходная строка [string]
+    @return Имя файла, содержащее только латинские буквы, цифры и символы '.', '_', '-' [string]
+    '''
+
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_') or '_'
+
+
+def loadState(filename, default=None):
+    '''
+    Загружает состояние из файла
+
+    @param filename  Имя файла [string]
+    @param default   Значение, возвращаемое при отсутствии или повреждении файла
+    @return Загруженное состояние
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            return json.load(f)
+    except IOError:
+        return default
+    except ValueError:
+        logger.warning("State file '{}' is corrupted, ignoring".format(filename))
+        return default
+
+
+def saveState(filename, state):
+    '''
+    Атомарно сохраняет состояние в файл: данные записываются во временный файл, который сбрасывается на диск
+    и затем переименовывается; после переименования на диск сбрасывается каталог. Таким образом, при аварийном
+    завершении или отключении питания файл содержит либо прежнее, либо новое состояние целиком, а после возврата
+    из функции -- только новое
+
+    @param filename  Имя файла [string]
+    @param state     Состояние (должно сериализоваться в JSON)
+    @return Признак успешного сохранения [bool]
+    '''
+
+    directory = os.path.dirname(filename) or '.'
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(state, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_filename, filename)
+        except:
+            os.unlink(tmp_filename)
+            raise
+    except (IOError, OSError):
+        logger.warning("Failed to save state to '{}' due to {} exception ({})".format(filename, *sys.exc_info()[:2]))
+        return False
+
+    syncDirectory(directory)
+    return True
+
+
+def removeState(filename):
+    '''
+    Удаляет файл состояния, если он существует. После удаления на диск сбрасывается каталог, чтобы при отключении
+    питания удаленный файл не был восстановлен
+
+    @param filename  Имя файла [string]
+    '''
+
+    try:
+        os.unlink(filename)
+    except OSError:
+        return
+    syncDirectory(os.path.dirname(filename) or '.')
+
+
+def syncDirectory(directory):
+    '''
+    Сбрасывает на диск содержимое каталога (созданные, переименованные и удаленные файлы)
+
+    @param directory  Имя каталога [string]
+    '''
+
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        # Файловая система может не поддерживать сброс каталога; состояние при этом уже сохранено
+        logger.debug("Failed to sync directory '{}' due to {} exception ({})".format(directory, *sys.exc_info()[:2]))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+@package pic_bench
+Измерение производительности pic_loader на синтетических образах и эмуляторе МК
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+import getopt
+import json
+import sys
+from lib.loggingConfigurator import loggingConfigurator
+from app.benchmark import runBenchmarks, compareResults, IMAGE_SIZES, CASES
+
+
+USAGE = '''
+pic_loader benchmark
+
+Options are:
+-h, --help           show this message
+-v, --loglevel=      debug output loglevel (default ERROR)
+-s, --sizes=         comma-separated image sizes to measure ({sizes}; all by default)
+-k, --cases=         comma-separated stages to measure ({cases}; all by default)
+-n, --repeats=       number of runs of each measurement (default 5)
+-b, --baud=          baud rate emulated in end-to-end runs (no transfer delays by default)
+-l, --row-latency=   row write time emulated in end-to-end runs, ms (default 0)
+-o, --output=        file to save results to (JSON); printed to stdout by default
+-c, --compare=       baseline results file (JSON) to compare with
+-t, --threshold=     allowed slowdown or memory growth against baseline, percent (default 10)
+
+Exit code is 1 if any measurement is slower or grows peak memory more than baseline by more than threshold
+'''.format(sizes=','.join(sorted(IMAGE_SIZES, key=lambda name: IMAGE_SIZES[name][1])), cases=','.join(CASES))
+
+
+def main():
+    '''
+    Выполняет измерения с параметрами, заданными в командной строке, и сравнивает результаты с базовыми
+    '''
+
+    lc = loggingConfigurator()
+    lc.setupLogging('ERROR')
+
+    try:
+        options, _ = getopt.gnu_getopt(
+          sys.argv[1:],
+          'hv:s:k:n:b:l:o:c:t:',
+          'help loglevel= sizes= cases= repeats= baud= row-latency= output= compare= threshold='.split()
+        )
+    except getopt.GetoptError, e:
+        logger.error("Illegal option (%s)" % e)
+        raise SystemExit(4)
+
+    sizes = cases = None
+    repeats = 5
+    baud = None
+    row_latency = 0.0
+    output_filename = baseline_filename = None
+    threshold = 10.0
+    for option, value in options:
+        if option in ('-h', '--help'):
+            sys.stderr.write(USAGE + "\n")
+            raise SystemExit(0)
+        elif option in ('-v', '--loglevel'):
+            lc.setupLogging(value)
+        elif option in ('-s', '--sizes'):
+            sizes = value.split(',')
+        elif option in ('-k', '--cases'):
+            cases = value.split(',')
+        elif option in ('-n', '--repeats'):
+            repeats = int(value)
+        elif option in ('-b', '--baud'):
+            baud = int(value)
+        elif option in ('-l', '--row-latency'):
+            row_latency = float(value) / 1000
+        elif option in ('-o', '--output'):
+            output_filename = value
+        elif option in ('-c', '--compare'):
+            baseline_filename = value
+        elif option in ('-t', '--threshold'):
+            threshold = float(value)
+
+    unknown = [name for name in sizes or () if name not in IMAGE_SIZES] + [name for name in cases or () if name not in CASES]
+    if unknown:
+        logger.error("Unknown image size or stage: {}".format(', '.join(unknown)))
+        raise SystemExit(4)
+
+    results = runBenchmarks(sizes, cases, repeats, baud, row_latency)
+    if output_filename:
+        with open(output_filename, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if not baseline_filename:
+        return
+    with open(baseline_filename, 'rb') as f:
+        baseline = json.load(f)
+    regressions = 0
+    for name, metric, base, current, ratio, regression in compareResults(results, baseline, threshold / 100):
+        if metric == 'time':
+            values = "{:>10.4f}s {:>10.4f}s".format(base, current)
+        else:
+            values = "{:>8d}KB {:>8d}KB".format(base, current)
+        sys.stderr.write("{:<16} {:<7}{} {:>7.2f}x{}\n".format(name, metric, values, ratio, '  REGRESSION' if regression else ''))
+        regressions += regression
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
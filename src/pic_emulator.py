@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+@package pic_emulator
+Эмулятор МК PIC с загрузчиком TinyBootloader на псевдотерминале: позволяет проверять pic_loader без аппаратуры
+
+@author Denis Shatov
+'''
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+import getopt
+import os
+import sys
+from lib.loggingConfigurator import loggingConfigurator
+from lib.CfgHandler import CfgHandler, CfgHandlerError
+from app.emulator import TinyBootloaderEmulator
+
+
+USAGE = '''
+TinyBootloader emulator
+
+Options are:
+-h, --help           show this message
+-v, --loglevel=      debug output loglevel. Could be either DEBUG,INFO,WARNING,ERROR or CRITICAL
+-i, --device-id=     PIC type code returned to 0xC1 request (default 0x31, 16F876A/877A)
+-b, --baud=          emulated baud rate (no transfer delays by default)
+-l, --row-latency=   emulated row write time, ms (default 0)
+-c, --config=        pic_loader configuration file to read reset sequences from
+-n, --no-reset       start in bootloader instead of waiting for reset sequence
+-o, --output=        file to save emulated flash contents to on exit
+'''
+
+
+def main():
+    '''
+    Запускает эмулятор с параметрами, заданными в командной строке, и обслуживает его до прерывания по Ctrl+C
+    '''
+
+    lc = loggingConfigurator()
+    lc.setupLogging('INFO')
+
+    try:
+        options, _ = getopt.gnu_getopt(
+          sys.argv[1:],
+          'hv:i:b:l:c:no:',
+          'help loglevel= device-id= baud= row-latency= config= no-reset output='.split()
+        )
+    except getopt.GetoptError, e:
+        logger.error("Illegal option (%s)" % e)
+        raise SystemExit(4)
+
+    device_id = 0x31
+    baud = None
+    row_latency = 0.0
+    cfg_filenames = (
+      os.path.join(os.path.dirname(sys.argv[0]), 'pic_loader.yaml'),
+      '/etc/pic_loader/pic_loader.yaml',
+    )
+    use_reset = True
+    output_filename = None
+    for option, value in options:
+        if option in ('-h', '--help'):
+            sys.stderr.write(USAGE + "\n")
+            raise SystemExit(0)
+        elif option in ('-v', '--loglevel'):
+            lc.setupLogging(value)
+        elif option in ('-i', '--device-id'):
+            device_id = int(value, 0)
+        elif option in ('-b', '--baud'):
+            baud = int(value)
+        elif option in ('-l', '--row-latency'):
+            row_latency = float(value) / 1000
+        elif option in ('-c', '--config'):
+            cfg_filenames = (value, )
+        elif option in ('-n', '--no-reset'):
+            use_reset = False
+        elif option in ('-o', '--output'):
+            output_filename = value
+
+    # Последовательности сброса берутся из настроек pic_loader
+    reset_seq = reply_seq = None
+    if use_reset:
+        cfg = CfgHandler(filenames=cfg_filenames)
+        try:
+            cfg.loadConfig()
+            reset_seq = cfg.get('pic', {}).get('reset-sequence')
+            reply_seq = cfg.get('pic', {}).get('reset-reply-sequence')
+        except CfgHandlerError:
+            logger.warning("No reset sequence loaded, starting in bootloader")
+
+    emulator = TinyBootloaderEmulator(device_id, baud, row_latency, reset_seq, reply_seq)
+    port = emulator.open()
+    logger.message("Emulating PIC type {:#04x} ({} family) on {}{}".format(
+      device_id, emulator.family, port, ", waiting for reset sequence {}".format(repr(reset_seq)) if reset_seq else ""))
+    try:
+        emulator.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.message("Received {} frames ({} with wrong checksum), {} resets".format(
+          emulator.frames, emulator.bad_frames, emulator.resets))
+        if output_filename:
+            with open(output_filename, 'wb') as f:
+                f.write(emulator.flash)
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+'''
+@package tests
+Тесты приложения, выполняемые на эмуляторе МК с загрузчиком TinyBootloader (запуск: make test)
+
+@author Denis Shatov
+'''
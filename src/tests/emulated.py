@@ -0,0 +1,231 @@
+# coding: utf-8
+'''
+@package tests.emulated
+Bootloader для микроконтроллеров PIC: общие средства тестов, выполняемых на эмуляторе МК с загрузчиком TinyBootloader
+
+@author Denis Shatov
+'''
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from app.bootloader import bootloader
+from app.emulator import TinyBootloaderEmulator
+
+
+## Скорость порта эмулятора (задержки передачи не моделируются)
+BAUD = 115200
+## Количество байт данных в записи hex-файла
+RECORD_SIZE = 16
+
+
+def hexRecord(addr, record_type, data):
+    '''
+    Формирует запись hex-файла
+
+    @param addr         Адрес (младшие 16 бит) [int]
+    @param record_type  Тип записи [int]
+    @param data         Данные [bytearray]
+    @return Строка записи [string]
+    '''
+
+    record = bytearray((len(data), (addr >> 8) & 255, addr & 255, record_type)) + data
+    record.append(-sum(record) & 255)
+    return ':' + str(record).encode('hex').upper()
+
+
+def makeHex(blocks):
+    '''
+    Формирует содержимое hex-файла. Адреса за пределами 64 КБ задаются записями расширенного линейного адреса
+
+    @param blocks  Данные в виде {адрес в hex-файле: данные} [dict]
+    @return Содержимое hex-файла [string]
+    '''
+
+    lines = []
+    upper = 0
+    for start in sorted(blocks):
+        data = bytearray(blocks[start])
+        for offset in xrange(0, len(data), RECORD_SIZE):
+            addr = start + offset
+            if addr >> 16 != upper:
+                upper = addr >> 16
+                lines.append(hexRecord(0, 0x04, bytearray(((upper >> 8) & 255, upper & 255))))
+            lines.append(hexRecord(addr & 0xFFFF, 0x00, data[offset:offset + RECORD_SIZE]))
+    lines.append(hexRecord(0, 0x01, bytearray()))
+
+    return '\n'.join(lines) + '\n'
+
+
+def randomData(size, seed=0):
+    '''
+    Формирует случайные данные прошивки
+
+    @param size  Объем данных, байт [int]
+    @param seed  Начальное значение генератора случайных чисел [int]
+    @return Данные [bytearray]
+    '''
+
+    rnd = random.Random(seed)
+    return bytearray(rnd.getrandbits(8) for _ in xrange(size))
+
+
+def firmware16F(size, seed=0):
+    '''
+    Формирует прошивку PIC16F: вектор сброса (clrf PCLATH; goto 0x10) и программа со слова 0x10
+
+    @param size  Объем программы, байт [int]
+    @param seed  Начальное значение генератора случайных чисел [int]
+    @return Данные в виде {адрес в hex-файле: данные} [dict]
+    '''
+
+    return {0: bytearray((0x8a, 0x01, 0x10, 0x28)), 0x20: randomData(size, seed)}
+
+
+class RecordingEmulator(TinyBootloaderEmulator):
+
+    '''
+    Эмулятор, сохраняющий принятые кадры записи в том виде, в котором они переданы по линии. Перед обработкой
+    каждого кадра вызывается функция, заданная тестом (on_frame): она может, например, отклонить кадр или запросить
+    остановку загрузки
+    '''
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Конструктор (параметры -- см. TinyBootloaderEmulator)
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        TinyBootloaderEmulator.__init__(self, *args, **kwargs)
+        ## Принятые кадры в порядке приема [list of bytearray]
+        self.received = []
+        ## Функция, вызываемая для каждого принятого кадра до его обработки: принимает адрес кадра и количество ранее
+        ## принятых кадров; если она возвращает False, на кадр передается отказ (NAK) без записи [callable] или None
+        self.on_frame = None
+
+    def frameAddress(self, frame):
+        '''
+        Возвращает адрес кадра записи
+
+        @param self    Ссылка на экземпляр класса
+        @param frame   Кадр [bytearray]
+        @return Адрес в единицах адресации кадров (для 16F -- в словах) [int]
+        '''
+
+        addr = 0
+        for byte in frame[:self._addr_size]:
+            addr = (addr << 8) | byte
+        return addr
+
+    def _processFrame(self, frame):
+        '''
+        Сохраняет кадр, вызывает функцию on_frame и обрабатывает кадр или отклоняет его
+
+        @param self    Ссылка на экземпляр класса
+        @param frame   Кадр [bytearray]
+        '''
+
+        count = len(self.received)
+        self.received.append(bytearray(frame))
+        if self.on_frame and self.on_frame(self.frameAddress(frame), count) is False:
+            self.frames += 1
+            self._send(self._NAK)
+            return
+        TinyBootloaderEmulator._processFrame(self, frame)
+
+
+class EmulatedTestCase(unittest.TestCase):
+
+    '''
+    Тест на эмуляторе: перед каждым тестом запускается эмулятор МК заданной модели и создается временный каталог
+    для hex-файлов и состояния устройств
+    '''
+
+    ## Код модели МК эмулятора
+    device_id = 0x31
+    ## Класс эмулятора
+    emulator_class = RecordingEmulator
+
+    def setUp(self):
+        '''
+        Запускает эмулятор и создает временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self.directory = tempfile.mkdtemp(prefix='pic_loader_test_')
+        self.emulator = self.emulator_class(self.device_id)
+        self.port = self.emulator.start()
+
+    def tearDown(self):
+        '''
+        Останавливает эмулятор и удаляет временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self.emulator.stop()
+        shutil.rmtree(self.directory, True)
+
+    def writeHex(self, blocks, name='firmware.hex'):
+        '''
+        Записывает hex-файл во временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        @param blocks  Данные в виде {адрес в hex-файле: данные} [dict]
+        @param name    Имя файла [string]
+        @return Полное имя файла [string]
+        '''
+
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(makeHex(blocks))
+        return filename
+
+    def openLoader(self, loader=None):
+        '''
+        Открывает порт эмулятора и определяет модель МК
+
+        @param self    Ссылка на экземпляр класса
+        @param loader  Объект bootloader [bootloader] или None (создается новый)
+        @return Объект bootloader [bootloader]
+        '''
+
+        loader = loader or bootloader()
+        loader.openSerial(self.port, BAUD, 1)
+        self.addCleanup(loader.closeSerial)
+        loader.detectPic()
+        return loader
+
+    def frameAddresses(self):
+        '''
+        Возвращает адреса принятых эмулятором кадров и очищает список кадров
+
+        @param self    Ссылка на экземпляр класса
+        @return Адреса кадров в порядке приема [list]
+        '''
+
+        addresses = [self.emulator.frameAddress(frame) for frame in self.emulator.received]
+        del self.emulator.received[:]
+        return addresses
+
+    def checkFlash(self, filename):
+        '''
+        Проверяет, что повторная полная загрузка прошивки (без функции on_frame эмулятора) не изменяет ПЗУ эмулятора,
+        т. е. прошивка уже записана полностью
+
+        @param self      Ссылка на экземпляр класса
+        @param filename  Имя файла прошивки [string]
+        @return Адреса кадров полной загрузки [list]
+        '''
+
+        flash = bytearray(self.emulator.flash)
+        self.emulator.on_frame = None
+        del self.emulator.received[:]
+        self.openLoader().bootload(filename)
+        self.assertEqual(self.emulator.flash, flash)
+        return self.frameAddresses()
@@ -0,0 +1,119 @@
+# coding: utf-8
+'''
+@package tests.test_checkpoint
+Bootloader для микроконтроллеров PIC: продолжение прерванной загрузки по контрольной точке
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from app.bootloader import bootloader, FlashingInterrupted
+from app.checkpoint import FlashCheckpoint
+from tests.emulated import EmulatedTestCase, firmware16F
+
+
+## Количество кадров, после приема которых загрузка прерывается
+STOP_AFTER = 5
+
+
+class CheckpointResumeTest(EmulatedTestCase):
+
+    '''
+    Прерванная загрузка продолжается с первой неподтвержденной строки
+    '''
+
+    def setUp(self):
+        '''
+        Записывает прошивку
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        EmulatedTestCase.setUp(self)
+        self.filename = self.writeHex(firmware16F(0x400))
+
+    def createLoader(self):
+        '''
+        Создает объект bootloader с контрольной точкой во временном каталоге
+
+        @param self    Ссылка на экземпляр класса
+        @return Объект bootloader [bootloader]
+        '''
+
+        return self.openLoader(bootloader(checkpoint=FlashCheckpoint(self.directory, 'device')))
+
+    def interrupt(self, **kwargs):
+        '''
+        Выполняет загрузку, остановка которой запрашивается при приеме эмулятором кадра номер STOP_AFTER
+        (до подтверждения его записи)
+
+        @param self    Ссылка на экземпляр класса
+        @param kwargs  Параметры bootloader.bootload()
+        @return Адреса принятых кадров [list]
+        '''
+
+        loader = self.createLoader()
+
+        def onFrame(addr, received):
+            if received == STOP_AFTER - 1:
+                loader.requestStop()
+
+        self.emulator.on_frame = onFrame
+        self.assertRaises(FlashingInterrupted, loader.bootload, self.filename, **kwargs)
+        self.emulator.on_frame = None
+        return self.frameAddresses()
+
+    def testResumeSendsRemainingRows(self):
+        '''
+        Продолжение загрузки передает только строки, не подтвержденные до остановки
+        '''
+
+        interrupted = self.interrupt()
+        self.assertEqual(len(interrupted), STOP_AFTER)
+
+        self.createLoader().bootload(self.filename, resume=True)
+        resumed = self.frameAddresses()
+
+        self.assertEqual(sorted(interrupted + resumed), sorted(self.checkFlash(self.filename)))
+
+    def testResumeStreaming(self):
+        '''
+        Продолжение загрузки в потоковом режиме передает только строки, не подтвержденные до остановки
+        '''
+
+        interrupted = self.interrupt(stream=True)
+
+        self.createLoader().bootload(self.filename, stream=True, resume=True)
+        resumed = self.frameAddresses()
+
+        self.assertEqual(sorted(interrupted + resumed), sorted(self.checkFlash(self.filename)))
+
+    def testCheckpointOfOtherFirmwareIgnored(self):
+        '''
+        Контрольная точка другой прошивки не используется: передаются все строки
+        '''
+
+        self.interrupt()
+        self.filename = self.writeHex(firmware16F(0x400, seed=1), 'other.hex')
+
+        self.createLoader().bootload(self.filename, resume=True)
+
+        self.assertEqual(sorted(self.frameAddresses()), sorted(self.checkFlash(self.filename)))
+
+    def testCheckpointRemovedAfterCompletion(self):
+        '''
+        После завершения загрузки контрольная точка удаляется: повторное продолжение передает все строки
+        '''
+
+        self.interrupt()
+        self.createLoader().bootload(self.filename, resume=True)
+        self.frameAddresses()
+
+        self.createLoader().bootload(self.filename, resume=True)
+
+        self.assertEqual(len(self.frameAddresses()), 0x420 // 64 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
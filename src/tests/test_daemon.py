@@ -0,0 +1,83 @@
+# coding: utf-8
+'''
+@package tests.test_daemon
+Bootloader для микроконтроллеров PIC: права доступа к сокету сервера загрузки прошивки
+
+@author Denis Shatov
+'''
+
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from app.daemon import FlashDaemon, DaemonException
+
+
+class SocketPermissionsTest(unittest.TestCase):
+
+    '''
+    Сервер создает каталог и сокет с заданными правами и отказывается работать в небезопасном каталоге
+    '''
+
+    def setUp(self):
+        '''
+        Создает временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self.directory = tempfile.mkdtemp(prefix='pic_loader_test_')
+        self.socket_dir = os.path.join(self.directory, 'run')
+        self.socket_path = os.path.join(self.socket_dir, 'pic_loader.sock')
+
+    def tearDown(self):
+        '''
+        Удаляет временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        shutil.rmtree(self.directory, True)
+
+    def testCreatedWithRestrictedModes(self):
+        '''
+        Каталог и сокет создаются с правами SOCKET_DIR_MODE и SOCKET_MODE независимо от umask
+        '''
+
+        umask = os.umask(0)
+        try:
+            daemon = FlashDaemon(self.socket_path, [])
+        finally:
+            os.umask(umask)
+        self.addCleanup(daemon.server_close)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_dir).st_mode), FlashDaemon.SOCKET_DIR_MODE)
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), FlashDaemon.SOCKET_MODE)
+
+    def testWritableDirectoryRejected(self):
+        '''
+        Каталог, доступный для записи другим пользователям, не используется
+        '''
+
+        os.mkdir(self.socket_dir)
+        os.chmod(self.socket_dir, 0777)
+
+        self.assertRaises(DaemonException, FlashDaemon, self.socket_path, [])
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def testForeignFileNotRemoved(self):
+        '''
+        Файл, не являющийся сокетом, по пути сокета не удаляется
+        '''
+
+        os.mkdir(self.socket_dir, 0700)
+        open(self.socket_path, 'w').close()
+
+        self.assertRaises(DaemonException, FlashDaemon, self.socket_path, [])
+        self.assertTrue(os.path.isfile(self.socket_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# coding: utf-8
+'''
+@package tests.test_delta
+Bootloader для микроконтроллеров PIC: разностная загрузка по журналу устройства
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from app.bootloader import bootloader
+from app.ledger import FlashLedger
+from tests.emulated import EmulatedTestCase, firmware16F
+
+
+class DeltaFlashingTest(EmulatedTestCase):
+
+    '''
+    При разностной загрузке передаются только строки, отличающиеся от записанных при последней загрузке
+    '''
+
+    def setUp(self):
+        '''
+        Записывает исходную и измененную (в строке 4) прошивки
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        EmulatedTestCase.setUp(self)
+        self.old_blocks = firmware16F(0x400)
+        self.new_blocks = firmware16F(0x400)
+        # Байт 0x120 hex-файла -- в строке 4 (0x100-0x13f)
+        self.new_blocks[0x20][0x100] ^= 0xff
+        self.old_filename = self.writeHex(self.old_blocks, 'old.hex')
+        self.new_filename = self.writeHex(self.new_blocks, 'new.hex')
+
+    def createLoader(self):
+        '''
+        Создает объект bootloader с журналом устройства во временном каталоге
+
+        @param self    Ссылка на экземпляр класса
+        @return Объект bootloader [bootloader]
+        '''
+
+        return self.openLoader(bootloader(ledger=FlashLedger(self.directory, 'device')))
+
+    def testOnlyChangedRowsSent(self):
+        '''
+        Повторная загрузка с измененной строкой передает только эту строку
+        '''
+
+        self.createLoader().bootload(self.old_filename)
+        full_flash = bytearray(self.emulator.flash)
+        self.frameAddresses()
+
+        self.createLoader().bootload(self.new_filename, delta=True)
+
+        self.assertEqual(self.frameAddresses(), [4 * 32])
+        full_flash[0x120] ^= 0xff
+        self.assertEqual(self.emulator.flash, full_flash)
+
+    def testUnchangedFirmwareSendsNothing(self):
+        '''
+        Повторная загрузка той же прошивки не передает ни одной строки
+        '''
+
+        self.createLoader().bootload(self.old_filename)
+        self.frameAddresses()
+
+        self.createLoader().bootload(self.old_filename, delta=True)
+
+        self.assertEqual(self.frameAddresses(), [])
+
+    def testWithoutLedgerAllRowsSent(self):
+        '''
+        Без журнала устройства (первая загрузка) передаются все строки
+        '''
+
+        self.createLoader().bootload(self.new_filename, delta=True)
+
+        self.assertEqual(len(self.emulator.received), 0x420 // 64 + 2)
+
+    def testDiffMatchesDeltaFlashing(self):
+        '''
+        Сравнение прошивок (команда diff) находит ту же строку, что передается при разностной загрузке
+        '''
+
+        loader = bootloader()
+        loader.selectPic(self.device_id)
+        changed, added, removed, unchanged = loader.diffFirmware(self.old_filename, self.new_filename)
+
+        self.assertEqual((changed, added, removed), ([4], [], []))
+        self.assertEqual(len(unchanged), 0x420 // 64 + 1)
+        self.assertEqual(loader.frameSize(), 2 + 64 + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# coding: utf-8
+'''
+@package tests.test_eventdriver
+Bootloader для микроконтроллеров PIC: загрузка прошивки неблокирующим драйвером (AsyncBootloader, SerialLoop)
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from app.bootloader import FlashingInterrupted
+from app.checkpoint import FlashCheckpoint
+from app.eventdriver import AsyncBootloader, SerialLoop
+from app.ledger import FlashLedger
+from tests.emulated import EmulatedTestCase, RecordingEmulator, BAUD, firmware16F
+
+
+class EventDriverTest(EmulatedTestCase):
+
+    '''
+    Неблокирующий драйвер передает те же кадры, что и bootloader, и обслуживает несколько портов в одном потоке
+    '''
+
+    def setUp(self):
+        '''
+        Записывает прошивку
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        EmulatedTestCase.setUp(self)
+        self.filename = self.writeHex(firmware16F(0x400))
+
+    def spawn(self, loop, port, loader=None, **kwargs):
+        '''
+        Создает задачу загрузки прошивки в МК, подключенный к порту
+
+        @param self    Ссылка на экземпляр класса
+        @param loop    Цикл обработки событий [SerialLoop]
+        @param port    Имя порта [string]
+        @param loader  Объект AsyncBootloader [AsyncBootloader] или None (создается новый)
+        @param kwargs  Параметры AsyncBootloader.flashAsync()
+        @return Задача [Task]
+        '''
+
+        loader = loader or AsyncBootloader()
+        loader.openSerial(port, BAUD, 1)
+        self.addCleanup(loader.closeSerial)
+        return loop.spawn(loader.fileno(), loader.flashAsync(self.filename, **kwargs), name=port)
+
+    def createLoader(self):
+        '''
+        Создает объект AsyncBootloader с журналом устройства и контрольной точкой во временном каталоге
+
+        @param self    Ссылка на экземпляр класса
+        @return Объект AsyncBootloader [AsyncBootloader]
+        '''
+
+        return AsyncBootloader(ledger=FlashLedger(self.directory, 'device'),
+                               checkpoint=FlashCheckpoint(self.directory, 'device'))
+
+    def testFramesMatchBlockingDriver(self):
+        '''
+        Кадры и содержимое ПЗУ после загрузки совпадают с результатом загрузки bootloader
+        '''
+
+        loop = SerialLoop()
+        task = self.spawn(loop, self.port)
+        self.assertTrue(loop.run(10))
+        self.assertIsNone(task.exception())
+
+        received = list(self.emulator.received)
+        flash = bytearray(self.emulator.flash)
+        del self.emulator.received[:]
+        self.openLoader().bootload(self.filename)
+
+        self.assertEqual(received, self.emulator.received)
+        self.assertEqual(flash, self.emulator.flash)
+
+    def testSeveralPortsInOneLoop(self):
+        '''
+        Прошивка загружается одновременно в несколько МК одним циклом обработки событий
+        '''
+
+        other = RecordingEmulator(self.device_id)
+        other_port = other.start()
+        self.addCleanup(other.stop)
+
+        loop = SerialLoop()
+        tasks = [self.spawn(loop, self.port), self.spawn(loop, other_port)]
+        self.assertTrue(loop.run(10))
+
+        self.assertEqual([task.exception() for task in tasks], [None, None])
+        self.assertEqual(len(other.received), 0x420 // 64 + 2)
+        self.assertEqual(other.received, self.emulator.received)
+        self.assertEqual(other.flash, self.emulator.flash)
+        self.assertEqual(self.emulator.bad_frames, 0)
+
+
+    def testCheckpointAndLedgerSaved(self):
+        '''
+        Подтвержденные строки сохраняются в контрольной точке до завершения прерванной задачи, а журнал устройства --
+        после завершения загрузки
+        '''
+
+        loader = self.createLoader()
+
+        def onFrame(addr, received):
+            if received == 4:
+                loader.requestStop()
+
+        self.emulator.on_frame = onFrame
+        loop = SerialLoop()
+        task = self.spawn(loop, self.port, loader)
+        self.assertTrue(loop.run(10))
+        self.assertIsInstance(task.exception(), FlashingInterrupted)
+        interrupted = self.frameAddresses()
+        # Максимальный адрес ПЗУ 16F876A -- 0x2000 слов
+        acked = FlashCheckpoint(self.directory, 'device').load(loader.firmware_hash, loader.picType()[0], 0x2000)
+        self.assertEqual(len(acked), 5)
+
+        self.emulator.on_frame = None
+        task = self.spawn(loop, self.port, self.createLoader(), resume=True)
+        self.assertTrue(loop.run(10))
+        self.assertIsNone(task.exception())
+        resumed = self.frameAddresses()
+        self.assertEqual(sorted(interrupted + resumed), sorted(self.checkFlash(self.filename)))
+
+        task = self.spawn(loop, self.port, self.createLoader(), delta=True)
+        self.assertTrue(loop.run(10))
+        self.assertIsNone(task.exception())
+        self.assertEqual(self.frameAddresses(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# coding: utf-8
+'''
+@package tests.test_flashplan
+Bootloader для микроконтроллеров PIC: учет строк в плане загрузки при повторной передаче в потоковом режиме
+
+@author Denis Shatov
+'''
+
+
+import os
+import unittest
+from app.bootloader import bootloader
+from app.flashplan import FlashPlan
+from app.ledger import rowHash
+from tests.emulated import EmulatedTestCase, hexRecord, makeHex, firmware16F
+
+
+## Размер кадра записи строки 16F (адрес, длина, 64 байта данных, контрольная сумма), байт
+FRAME_SIZE = 2 + 1 + 64 + 1
+
+
+class PlanRecordingLoader(bootloader):
+
+    '''
+    Загрузчик, сохраняющий план последней загрузки
+    '''
+
+    ## План последней загрузки [FlashPlan]
+    plan = None
+
+    def _newPlan(self, chip_rows=None, skip_rows=None):
+        '''
+        Создает план загрузки (см. bootloader._newPlan()) и сохраняет его
+
+        @param self       Ссылка на экземпляр класса
+        @param chip_rows  Хэши строк ПЗУ по журналу устройства [dict]
+        @param skip_rows  Хэши строк, которые не требуется передавать [dict]
+        @return План загрузки [FlashPlan]
+        '''
+
+        self.plan = bootloader._newPlan(self, chip_rows, skip_rows)
+        return self.plan
+
+
+class FlashPlanTest(unittest.TestCase):
+
+    '''
+    Строка, рассмотренная планом повторно, учитывается один раз -- в списке по последнему решению
+    '''
+
+    def testRepeatedRowCountedOnce(self):
+        '''
+        Повторно переданная строка учитывается в списке передаваемых строк один раз
+        '''
+
+        plan = FlashPlan(FRAME_SIZE)
+
+        self.assertTrue(plan.accept(2, bytearray(64)))
+        self.assertTrue(plan.accept(3, bytearray(64)))
+        self.assertTrue(plan.accept(2, bytearray('\x01' * 64)))
+
+        self.assertEqual(plan.rows, [2, 3])
+        self.assertEqual(plan.byteCount(), 2 * FRAME_SIZE)
+
+    def testSkippedRowMovedWhenChanged(self):
+        '''
+        Пропущенная строка, данные которой изменились, переносится в список передаваемых строк
+        '''
+
+        plan = FlashPlan(FRAME_SIZE, skip_rows={2: rowHash(bytearray(64))})
+
+        self.assertFalse(plan.accept(2, bytearray(64)))
+        self.assertTrue(plan.accept(2, bytearray('\x01' * 64)))
+
+        self.assertEqual((plan.rows, plan.skipped, plan.elided), ([2], [], []))
+
+
+class StreamedResendTest(EmulatedTestCase):
+
+    '''
+    Загрузка в потоковом режиме прошивки, данные строки 2 которой повторно встречаются в конце hex-файла
+    '''
+
+    def testResentRowCountedOnce(self):
+        '''
+        Строка передается в МК дважды, но в плане загрузки (количество строк и байт) учитывается один раз
+        '''
+
+        blocks = firmware16F(0x400)
+        lines = makeHex(blocks).splitlines()
+        # Записи до окончания файла: байты 0x90-0x9f hex-файла -- в строке 2 (0x80-0xbf), которая уже передана
+        lines.insert(-1, hexRecord(0x90, 0x00, bytearray('\x55' * 16)))
+        filename = os.path.join(self.directory, 'resend.hex')
+        with open(filename, 'wb') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        loader = self.openLoader(PlanRecordingLoader())
+        loader.bootload(filename, stream=True)
+
+        addresses = self.frameAddresses()
+        rows = 0x420 // 64 + 2
+        self.assertEqual(len(addresses), rows + 1)
+        self.assertEqual(addresses.count(2 * 32), 2)
+        self.assertEqual(sorted(loader.plan.rows), sorted(set(addr // 32 for addr in addresses)))
+        self.assertEqual(loader.plan.byteCount(), rows * FRAME_SIZE)
+        self.assertEqual(self.emulator.flash[0x90:0xa0], bytearray('\x55' * 16))
+
+
+if __name__ == '__main__':
+    unittest.main()
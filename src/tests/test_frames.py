@@ -0,0 +1,63 @@
+# coding: utf-8
+'''
+@package tests.test_frames
+Bootloader для микроконтроллеров PIC: совместимость кадров записи с исходной реализацией (побайтная передача)
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from tests.emulated import EmulatedTestCase, firmware16F
+
+
+def legacyFrame(family, addr, data):
+    '''
+    Формирует кадр записи так же, как исходная реализация _write_mem(): адрес (у PIC18F -- с нулевым старшим байтом),
+    длина блока, данные и контрольная сумма
+
+    @param family  Семейство МК [string]
+    @param addr    Адрес блока [int]
+    @param data    Данные [bytearray]
+    @return Кадр [bytearray]
+    '''
+
+    addr_high = (addr / 256) & 255
+    addr_low = addr & 255
+    checksum = addr_high + addr_low + len(data) + sum(data)
+    header = bytearray((addr_high, addr_low, len(data)))
+    if family == "18F":
+        header.insert(0, 0)
+    return header + data + bytearray(((-checksum) & 255, ))
+
+
+class FrameCompatibilityTest(EmulatedTestCase):
+
+    '''
+    Кадры, передаваемые целиком, совпадают с кадрами исходной реализации; содержимое ПЗУ после загрузки совпадает
+    с прошивкой (с перемещенным вектором сброса)
+    '''
+
+    def testFramesMatchLegacyFormat(self):
+        '''
+        Загрузка прошивки PIC16F: кадры, принятые эмулятором, и содержимое его ПЗУ
+        '''
+
+        filename = self.writeHex(firmware16F(0x400))
+        self.openLoader().bootload(filename)
+
+        # Ожидаемое содержимое ПЗУ 16F876A (8К слов, загрузчик -- последние 200 байт, вход -- слово 0x1fa0)
+        expected = bytearray('\xff' * 0x4000)
+        expected[0:6] = bytearray((0x1f, 0x30, 0x8a, 0x00, 0xa0, 0x2f))
+        expected[0x20:0x420] = firmware16F(0x400)[0x20]
+        expected[0x3f38:0x3f3c] = bytearray((0x8a, 0x01, 0x10, 0x28))
+
+        rows = range(0x420 // 64 + 1) + [0x3f38 // 64]
+        frames = [legacyFrame("16F8XX", row * 32, expected[row * 64:(row + 1) * 64]) for row in rows]
+        self.assertEqual(self.emulator.received, frames)
+        self.assertEqual(self.emulator.bad_frames, 0)
+        self.assertEqual(self.emulator.flash, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# coding: utf-8
+'''
+@package tests.test_pic18
+Bootloader для микроконтроллеров PIC: загрузка прошивки PIC18F с ПЗУ более 64 КБ (трехбайтовый адрес в кадре записи)
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from tests.emulated import EmulatedTestCase, randomData
+
+
+def frame18F(addr, data):
+    '''
+    Формирует кадр записи PIC18F: трехбайтовый адрес (старшим байтом вперед), длина блока, данные и контрольная сумма
+
+    @param addr    Адрес блока, байт [int]
+    @param data    Данные [bytearray]
+    @return Кадр [bytearray]
+    '''
+
+    frame = bytearray(((addr >> 16) & 255, (addr >> 8) & 255, addr & 255, len(data))) + data
+    frame.append(-sum(frame) & 255)
+    return frame
+
+
+def firmware18F():
+    '''
+    Формирует прошивку PIC18F: вектор сброса (goto 0x20), программа с адреса 0x20 и данные за пределами 64 КБ
+
+    @return Данные в виде {адрес в hex-файле: данные} [dict]
+    '''
+
+    return {0: bytearray((0x10, 0xef, 0x00, 0xf0)), 0x20: randomData(0x200), 0x10000: randomData(0x80, 1)}
+
+
+class Pic18AddressingTest(EmulatedTestCase):
+
+    '''
+    Загрузка прошивки в 18F6720/8720 (128 КБ ПЗУ): адреса кадров и содержимое ПЗУ после загрузки
+    '''
+
+    device_id = 0x4A
+
+    def setUp(self):
+        '''
+        Записывает прошивку и загружает ее в эмулятор
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        EmulatedTestCase.setUp(self)
+        self.openLoader().bootload(self.writeHex(firmware18F()))
+
+        # Ожидаемое содержимое ПЗУ (загрузчик -- последние 200 байт, вход -- адрес 0x1ff40)
+        blocks = firmware18F()
+        self.expected = bytearray('\xff' * 0x20000)
+        self.expected[0:4] = bytearray((0xa0, 0xef, 0xff, 0xf0))
+        self.expected[0x20:0x220] = blocks[0x20]
+        self.expected[0x10000:0x10080] = blocks[0x10000]
+        self.expected[0x1ff38:0x1ff3c] = blocks[0]
+
+    def testFramesUseThreeByteAddress(self):
+        '''
+        Кадры передаются с полным трехбайтовым адресом, в том числе за пределами 64 КБ
+        '''
+
+        addresses = range(0, 0x240, 64) + [0x10000, 0x10040, 0x1ff00]
+        frames = [frame18F(addr, self.expected[addr:addr + 64]) for addr in addresses]
+        self.assertEqual(self.emulator.received, frames)
+        self.assertEqual(self.emulator.bad_frames, 0)
+
+    def testResetVectorRelocated(self):
+        '''
+        Вектор сброса заменен переходом в загрузчик, исходный вектор перемещен в начало области загрузчика
+        '''
+
+        self.assertEqual(self.emulator.flash[0:8], bytearray((0xa0, 0xef, 0xff, 0xf0)) + '\xff' * 4)
+        self.assertEqual(self.emulator.flash[0x1ff38:0x1ff40], bytearray((0x10, 0xef, 0x00, 0xf0)) + '\xff' * 4)
+
+    def testFlashContents(self):
+        '''
+        Содержимое ПЗУ совпадает с прошивкой, в том числе за пределами 64 КБ
+        '''
+
+        self.assertEqual(self.emulator.flash, self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
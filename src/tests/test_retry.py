@@ -0,0 +1,114 @@
+# coding: utf-8
+'''
+@package tests.test_retry
+Bootloader для микроконтроллеров PIC: повторная отправка строки при отказе загрузчика в записи
+
+@author Denis Shatov
+'''
+
+
+import unittest
+from app.bootloader import FlashWriteFailed
+from tests.emulated import EmulatedTestCase, firmware16F
+
+
+## Адрес кадра (в словах), запись которого отклоняется эмулятором: строка 4
+FAILING_ADDR = 4 * 32
+
+
+class RetryTest(EmulatedTestCase):
+
+    '''
+    Строка, запись которой отклонена загрузчиком, передается повторно в соответствии с заданной политикой
+    '''
+
+    def setUp(self):
+        '''
+        Записывает прошивку
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        EmulatedTestCase.setUp(self)
+        self.filename = self.writeHex(firmware16F(0x400))
+
+    def reject(self, count):
+        '''
+        Задает отказ эмулятора на первые попытки записи кадра по адресу FAILING_ADDR
+
+        @param self    Ссылка на экземпляр класса
+        @param count   Количество отказов [int]
+        '''
+
+        rejects = [count]
+
+        def onFrame(addr, received):
+            if addr != FAILING_ADDR or not rejects[0]:
+                return True
+            rejects[0] -= 1
+            return False
+
+        self.emulator.on_frame = onFrame
+
+    def flashWithRejectedRow(self, stream):
+        '''
+        Выполняет загрузку, при которой запись одной строки отклоняется один раз, и проверяет ее результат
+
+        @param self    Ссылка на экземпляр класса
+        @param stream  Признак потокового режима [bool]
+        '''
+
+        self.reject(1)
+        loader = self.openLoader()
+        loader.setRetryPolicy(2, 0.01)
+
+        loader.bootload(self.filename, stream=stream)
+
+        self.assertEqual(self.frameAddresses().count(FAILING_ADDR), 2)
+        self.assertEqual(loader.transfer_stats.retries, 1)
+        self.assertEqual(loader.transfer_stats.retried_rows, 1)
+        self.checkFlash(self.filename)
+
+    def testRejectedRowResent(self):
+        '''
+        Отклоненная строка передается повторно, загрузка завершается
+        '''
+
+        self.flashWithRejectedRow(False)
+
+    def testRejectedRowResentStreaming(self):
+        '''
+        Отклоненная строка передается повторно в потоковом режиме
+        '''
+
+        self.flashWithRejectedRow(True)
+
+    def testRetriesExhausted(self):
+        '''
+        Загрузка прерывается, если запись строки отклонена после всех повторных попыток
+        '''
+
+        self.reject(3)
+        loader = self.openLoader()
+        loader.setRetryPolicy(2)
+
+        self.assertRaises(FlashWriteFailed, loader.bootload, self.filename)
+
+        self.assertEqual(self.frameAddresses().count(FAILING_ADDR), 3)
+        self.assertNotIn(FAILING_ADDR, self.emulator.writes)
+
+    def testNoRetriesByDefault(self):
+        '''
+        Без заданной политики повторных попыток загрузка прерывается при первом отказе
+        '''
+
+        self.reject(1)
+
+        self.assertRaises(FlashWriteFailed, self.openLoader().bootload, self.filename)
+
+        self.assertEqual(self.frameAddresses()[-1], FAILING_ADDR)
+        self.assertEqual(self.emulator.writes.count(FAILING_ADDR), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+'''
+@package tests.test_statefile
+Bootloader для микроконтроллеров PIC: сброс на диск файлов состояния (журнала устройства)
+
+@author Denis Shatov
+'''
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from lib.statefile import loadState, saveState, removeState
+
+
+class StateFileSyncTest(unittest.TestCase):
+
+    '''
+    Файл состояния и его каталог сбрасываются на диск при сохранении и удалении
+    '''
+
+    def setUp(self):
+        '''
+        Создает временный каталог и перехватывает операции os.fsync и os.rename
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        self.directory = tempfile.mkdtemp(prefix='pic_loader_test_')
+        self.filename = os.path.join(self.directory, 'state.json')
+        ## Выполненные операции в виде (операция, имя файла) [list]
+        self.operations = []
+
+        fsync, rename = os.fsync, os.rename
+
+        def recordFsync(fd):
+            self.operations.append(('fsync', os.readlink('/proc/self/fd/{}'.format(fd))))
+            fsync(fd)
+
+        def recordRename(src, dst):
+            self.operations.append(('rename', dst))
+            rename(src, dst)
+
+        os.fsync, os.rename = recordFsync, recordRename
+        self.addCleanup(setattr, os, 'fsync', fsync)
+        self.addCleanup(setattr, os, 'rename', rename)
+
+    def tearDown(self):
+        '''
+        Удаляет временный каталог
+
+        @param self    Ссылка на экземпляр класса
+        '''
+
+        shutil.rmtree(self.directory, True)
+
+    def testSaveSyncsFileAndDirectory(self):
+        '''
+        Временный файл сбрасывается на диск до переименования, каталог -- после
+        '''
+
+        self.assertTrue(saveState(self.filename, {'rows': {}}))
+
+        self.assertEqual([operation for operation, _ in self.operations], ['fsync', 'rename', 'fsync'])
+        self.assertEqual(os.path.dirname(self.operations[0][1]), self.directory)
+        self.assertEqual(self.operations[2], ('fsync', self.directory))
+        self.assertEqual(loadState(self.filename), {'rows': {}})
+
+    def testRemoveSyncsDirectory(self):
+        '''
+        После удаления файла каталог сбрасывается на диск
+        '''
+
+        saveState(self.filename, {})
+        del self.operations[:]
+
+        removeState(self.filename)
+
+        self.assertEqual(self.operations, [('fsync', self.directory)])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def testRemoveMissingFile(self):
+        '''
+        Удаление отсутствующего файла не выполняет операций
+        '''
+
+        removeState(self.filename)
+
+        self.assertEqual(self.operations, [])
+
+
+if __name__ == '__main__':
+    unittest.main()